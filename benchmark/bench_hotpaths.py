@@ -0,0 +1,317 @@
+#!/bin/env python
+#coding=utf8
+
+"""
+synthetic-data benchmark of the python hot paths.
+
+Generates paired FASTQ of a chemistry in data/chemistry.json and
+name-sorted, XT-tagged BAMs with a given cell/gene/UMI depth, then times
+barcode.extract_barcode, count.bam2table, count.correct_umi, count.downsample,
+count.expression_matrix and annotation.IntervalIndex.query at several scales. Every case runs in a fresh
+process so that its peak RSS is its own.
+
+    python3 benchmark/bench_hotpaths.py --scales 10000,100000 --out bench.json
+    python3 benchmark/bench_hotpaths.py --scales 10000,100000 --baseline bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from argparse import Namespace
+from collections import defaultdict
+
+basedir = os.path.realpath(os.path.dirname(os.path.abspath(__file__)) + '/..')
+toolsdir = basedir + '/tools'
+sys.path.insert(0, toolsdir)
+
+CASES = ['barcode', 'bam2table', 'correct_umi', 'downsample', 'expression_matrix', 'interval_query']
+
+# chemistries of data/chemistry.json with whitelist and linker files
+def chemistries():
+    from chemistry import load_registry
+    return dict((name, c) for name, c in load_registry().items() if c.get('whitelist') and c.get('linker'))
+
+
+BASES = 'ACGT'
+
+
+def read_list(path):
+    with open(path) as fh:
+        return [line.strip() for line in fh if line.strip()]
+
+
+def mutate(seq, rng):
+    i = rng.randrange(len(seq))
+    return seq[:i] + rng.choice([b for b in BASES if b != seq[i]]) + seq[i + 1:]
+
+
+def random_seq(n, rng):
+    return ''.join(rng.choice(BASES) for _ in range(n))
+
+
+def generate_fastq(chemistry, n_reads, fq1, fq2, n_cells=500, error_rate=0.05, seed=0):
+    """
+    paired fastq: read1 follows the chemistry pattern with error_rate of reads
+    carrying a barcode mismatch, a broken linker, missing polyT or low quality
+    """
+    from chemistry import parse_pattern, read_seqs
+    rng = random.Random(seed)
+    chemistry = chemistries()[chemistry]
+    bclists = [read_seqs(f) for f in chemistry['whitelist']]
+    linkers = [read_seqs(f)[0] for f in chemistry['linker']]
+    pattern_dict = parse_pattern(chemistry['pattern'])
+    umi_len = sum(e - s for s, e in pattern_dict['U'])
+    polyT_len = sum(e - s for s, e in pattern_dict['T'])
+    n_segments = len(pattern_dict['C'])
+    cells = [[rng.choice(bclists[j]) for j in range(n_segments)] for _ in range(n_cells)]
+
+    with open(fq1, 'w') as fh1, open(fq2, 'w') as fh2:
+        for i in range(n_reads):
+            segments = list(rng.choice(cells))
+            read_linkers = list(linkers)
+            polyT = 'T' * polyT_len
+            qual_char = 'F'
+            if rng.random() < error_rate:
+                kind = rng.randrange(4)
+                if kind == 0:
+                    j = rng.randrange(n_segments)
+                    segments[j] = mutate(segments[j], rng)
+                elif kind == 1:
+                    read_linkers[0] = random_seq(len(read_linkers[0]), rng)
+                elif kind == 2:
+                    polyT = random_seq(polyT_len, rng)
+                else:
+                    qual_char = '#'
+            seq1 = ''
+            for j, seg in enumerate(segments):
+                seq1 += seg + (read_linkers[j] if j < len(read_linkers) else '')
+            seq1 += random_seq(umi_len, rng) + polyT
+            seq2 = random_seq(100, rng)
+            fh1.write('@r%s 1\n%s\n+\n%s\n' % (i, seq1, qual_char * len(seq1)))
+            fh2.write('@r%s 2\n%s\n+\n%s\n' % (i, seq2, 'F' * len(seq2)))
+
+
+def synthetic_molecules(n_cells, n_genes, umis_per_cell, depth, umi_len=8, error_rate=0.05, seed=0):
+    """
+    yield (barcode, [(geneID, umi, reads)]) per cell. reads per UMI are geometric
+    with mean depth, error_rate of UMIs get a 1-mismatch copy with a single read
+    """
+    rng = random.Random(seed)
+    for c in range(n_cells):
+        barcode = random_seq(24, rng)
+        molecules = []
+        # a few cells carry most of the UMIs, like real libraries
+        n_umi = max(1, int(umis_per_cell * (2.0 if c < n_cells // 2 else 0.1)))
+        for _ in range(n_umi):
+            gene = 'G%05d' % (int(rng.paretovariate(1.2)) % n_genes)
+            umi = random_seq(umi_len, rng)
+            reads = 1
+            while rng.random() > 1.0 / depth:
+                reads += 1
+            molecules.append((gene, umi, reads))
+            if rng.random() < error_rate:
+                molecules.append((gene, mutate(umi, rng), 1))
+        yield barcode, molecules
+
+
+def generate_bam(bam, n_cells, n_genes, umis_per_cell, depth, unassigned=0.1, seed=0):
+    """
+    name-sorted bam with @barcode_umi_readID names and XT tags, as featureCounts writes
+    """
+    import pysam
+    rng = random.Random(seed + 1)
+    header = {'HD': {'VN': '1.0', 'SO': 'queryname'}, 'SQ': [{'SN': 'chr1', 'LN': 100000}]}
+    n_reads = 0
+    with pysam.AlignmentFile(bam, 'wb', header=header) as outfile:
+        for barcode, molecules in synthetic_molecules(n_cells, n_genes, umis_per_cell, depth, seed=seed):
+            for gene, umi, reads in molecules:
+                for _ in range(reads):
+                    seg = pysam.AlignedSegment()
+                    seg.query_name = '%s_%s_r%s' % (barcode, umi, n_reads)
+                    seg.flag = 0
+                    seg.reference_id = 0
+                    seg.reference_start = rng.randrange(99900)
+                    seg.mapping_quality = 255
+                    seg.cigarstring = '50M'
+                    seg.query_sequence = 'A' * 50
+                    if rng.random() >= unassigned:
+                        seg.set_tag('XT', gene)
+                    outfile.write(seg)
+                    n_reads += 1
+    return n_reads
+
+
+def run_case(params):
+    """
+    time one hot path in this process; returns reads, seconds and peak rss
+    """
+    case, inputs, workdir = params
+    import count
+    import barcode
+
+    if case == 'barcode':
+        args = Namespace(fq1=inputs['fq1'], fq2=inputs['fq2'], outdir=workdir,
+            lowQual=barcode.ord2chr(0), lowNum=2, nopolyT=False, noLinker=False)
+        from chemistry import get_plan
+        plan = get_plan(Namespace(bcType=inputs['chemistry'], pattern=None, whitelist=None, linker=None))
+        start = time.time()
+        res = barcode.extract_barcode(args, plan, workdir + '/out_2.fq.gz')
+        seconds = time.time() - start
+        reads = res['total_num']
+
+    elif case == 'bam2table':
+        start = time.time()
+        count.bam2table(inputs['bam'], workdir + '/detail.txt')
+        seconds = time.time() - start
+        reads = inputs['bam_reads']
+
+    elif case == 'correct_umi':
+        cells = []
+        reads = 0
+        for barcode_seq, molecules in synthetic_molecules(**inputs['molecules']):
+            gene_umi_dict = defaultdict(lambda: defaultdict(int))
+            for gene, umi, n in molecules:
+                gene_umi_dict[gene][umi] += n
+                reads += n
+            cells.append((barcode_seq, gene_umi_dict))
+        start = time.time()
+        for barcode_seq, gene_umi_dict in cells:
+            count.correct_umi(None, barcode_seq, gene_umi_dict)
+        seconds = time.time() - start
+
+    elif case == 'downsample':
+        import pandas as pd
+        validated_barcodes = set(pd.read_table(inputs['detail'], usecols=['Barcode'])['Barcode'].unique())
+        start = time.time()
+        count.downsample(inputs['detail'], validated_barcodes, workdir + '/downsample.txt')
+        seconds = time.time() - start
+        reads = inputs['detail_reads']
+
+    elif case == 'expression_matrix':
+        import pandas as pd
+        df = pd.read_table(inputs['detail'], header=0)
+        validated_barcodes = df['Barcode'].unique()
+        start = time.time()
+        count.expression_matrix(df, validated_barcodes, workdir + '/matrix')
+        seconds = time.time() - start
+        reads = inputs['detail_reads']
+
+    elif case == 'interval_query':
+        # one gene per read, behind a chromosome-long interval that every query overlaps
+        from annotation import IntervalIndex
+        rng = random.Random(inputs['seed'])
+        span = 10 ** 8
+        index = IntervalIndex()
+        index.add('chr1', 0, span, 'long')
+        for i in range(inputs['scale']):
+            start = rng.randrange(span)
+            index.add('chr1', start, start + rng.randrange(1, 3000), 'g%s' % (i))
+        index.build()
+        queries = [rng.randrange(span) for _ in range(inputs['scale'])]
+        start = time.time()
+        for q in queries:
+            index.query('chr1', q, q + 100)
+        seconds = time.time() - start
+        reads = len(queries)
+
+    # kilobytes on linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return {'reads': reads, 'seconds': round(seconds, 3),
+        'reads_per_sec': round(reads / seconds, 1) if seconds > 0 else None,
+        'peak_rss_mb': round(peak_rss_mb, 1)}
+
+
+def prepare_inputs(args, scale, workdir):
+    """
+    synthetic inputs of one scale, scale is the number of reads
+    """
+    import count
+    inputs = {'scale': scale, 'seed': args.seed}
+    inputs.update({'chemistry': args.chemistry, 'fq1': workdir + '/in_1.fq', 'fq2': workdir + '/in_2.fq'})
+    generate_fastq(args.chemistry, scale, inputs['fq1'], inputs['fq2'], seed=args.seed)
+
+    # same read depth per umi at every scale, the cell number grows with the scale
+    n_cells = max(1, scale // int(args.umis_per_cell * 1.05 * args.depth))
+    molecules = {'n_cells': n_cells, 'n_genes': args.genes, 'umis_per_cell': args.umis_per_cell,
+        'depth': args.depth, 'seed': args.seed}
+    inputs['molecules'] = molecules
+    inputs['bam'] = workdir + '/in.bam'
+    inputs['bam_reads'] = generate_bam(inputs['bam'], n_cells, args.genes, args.umis_per_cell, args.depth, seed=args.seed)
+    inputs['detail'] = workdir + '/in_detail.txt'
+    count.bam2table(inputs['bam'], inputs['detail'])
+    with open(inputs['detail']) as fh:
+        next(fh)
+        inputs['detail_reads'] = sum(int(line.rsplit('\t', 1)[1]) for line in fh)
+    return inputs
+
+
+def main():
+    parser = argparse.ArgumentParser('hot path benchmark on synthetic data')
+    parser.add_argument('--scales', help='reads per run, seperated by comma, default=10000,100000',
+        default='10000,100000')
+    parser.add_argument('--cases', help='hot paths to time, default=all', default=','.join(CASES))
+    parser.add_argument('--chemistry', help='chemistry of the fastq, default=test',
+        choices=sorted(chemistries()), default='test')
+    parser.add_argument('--genes', type=int, help='genes in the bam, default=2000', default=2000)
+    parser.add_argument('--umis_per_cell', type=int, help='mean UMIs per cell, default=200', default=200)
+    parser.add_argument('--depth', type=float, help='mean reads per UMI, default=2', default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='dir of synthetic inputs, default is a temp dir')
+    parser.add_argument('--out', help='write results as json')
+    parser.add_argument('--baseline', help='json of an earlier run, fail on slower reads/sec')
+    parser.add_argument('--tolerance', type=float, help='allowed reads/sec drop against baseline, default=0.2',
+        default=0.2)
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_hotpaths.')
+    cases = args.cases.split(',')
+    results = []
+    # spawn, so that every case starts with a fresh peak rss
+    ctx = multiprocessing.get_context('spawn')
+    print('\t'.join(['case', 'scale', 'reads', 'seconds', 'reads_per_sec', 'peak_rss_mb']))
+    for scale in [int(i) for i in args.scales.split(',')]:
+        scale_dir = '%s/%s' % (workdir, scale)
+        if not os.path.exists(scale_dir):
+            os.makedirs(scale_dir)
+        inputs = prepare_inputs(args, scale, scale_dir)
+        for case in cases:
+            pool = ctx.Pool(1)
+            res = pool.apply(run_case, ((case, inputs, scale_dir),))
+            pool.close()
+            pool.join()
+            res.update({'case': case, 'scale': scale})
+            results.append(res)
+            print('\t'.join(str(res[k]) for k in ['case', 'scale', 'reads', 'seconds', 'reads_per_sec', 'peak_rss_mb']))
+            sys.stdout.flush()
+
+    if not args.workdir:
+        shutil.rmtree(workdir)
+
+    if args.out:
+        with open(args.out, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = dict(((r['case'], r['scale']), r) for r in json.load(fh))
+        slower = []
+        for res in results:
+            old = baseline.get((res['case'], res['scale']))
+            if not old or not old['reads_per_sec'] or not res['reads_per_sec']:
+                continue
+            if res['reads_per_sec'] < old['reads_per_sec'] * (1 - args.tolerance):
+                slower.append('%s@%s: %.0f -> %.0f reads/sec' % (
+                    res['case'], res['scale'], old['reads_per_sec'], res['reads_per_sec']))
+        if slower:
+            sys.exit('performance regression:\n' + '\n'.join(slower))
+
+
+if __name__ == '__main__':
+    main()
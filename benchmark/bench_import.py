@@ -0,0 +1,75 @@
+#!/bin/env python
+#coding=utf8
+
+"""
+import-time benchmark of tools/scope.py.
+
+Runs `scope.py <subcommand> --help` under `python -X importtime` and fails if
+any heavy module gets imported just to build the command line, or if the
+startup time goes over the budget.
+"""
+
+import os
+import sys
+import re
+import argparse
+import subprocess
+
+toolsdir = os.path.realpath(os.path.dirname(os.path.abspath(__file__)) + '/../tools')
+
+HEAVY_MODULES = ['pandas', 'numpy', 'scipy', 'pysam', 'jinja2', 'matplotlib', 'xopen']
+
+def all_subcommands():
+    # every subcommand registered in scope.py, which only imports argparse and opts
+    sys.path.insert(0, toolsdir)
+    from scope import subcommands
+    return subcommands()
+
+def import_profile(argv):
+    """
+    return total wall time(ms) and {top-level module: cumulative import time(us)}
+    """
+    cmd = [sys.executable, '-X', 'importtime', toolsdir + '/scope.py'] + argv
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    modules = {}
+    p = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+    for line in res.stderr.splitlines():
+        m = p.match(line)
+        if not m:
+            continue
+        name = m.group(4).split('.')[0]
+        modules[name] = max(modules.get(name, 0), int(m.group(2)))
+    return modules
+
+def startup_ms(argv, repeat):
+    import time
+    cmd = [sys.executable, toolsdir + '/scope.py'] + argv
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elapsed = (time.time() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser('scope.py import-time benchmark')
+    parser.add_argument('--max_ms', type=float, help='startup budget of --help in ms, default=500', default=500)
+    parser.add_argument('--repeat', type=int, help='runs per subcommand, best is kept, default=5', default=5)
+    args = parser.parse_args()
+
+    failed = False
+    print('\t'.join(['subcommand', 'startup_ms', 'heavy_imports']))
+    for sub in [None] + all_subcommands():
+        argv = ['--help'] if sub is None else [sub, '--help']
+        modules = import_profile(argv)
+        heavy = [m for m in HEAVY_MODULES if m in modules]
+        ms = startup_ms(argv, args.repeat)
+        print('\t'.join([sub or '-', '%.1f' % ms, ','.join(heavy) or '-']))
+        if heavy or ms > args.max_ms:
+            failed = True
+    if failed:
+        sys.exit('import-time regression: heavy imports or startup over %sms' % args.max_ms)
+
+if __name__ == '__main__':
+    main()
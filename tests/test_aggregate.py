@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.io import mmread, mmwrite
+
+import scope
+from sparse_analysis import read_list
+
+DETAIL_HEADER = 'Barcode\tgeneID\tUMI\tcount\n'
+
+
+def write_sample(workdir, sample, genes, barcodes, umis, reads):
+    """
+    05.count of a sample with umis {(gene, barcode): [reads of each UMI]}
+    and reads {barcode: transcriptome reads}
+    """
+    count_dir = workdir / sample / '05.count'
+    count_dir.mkdir(parents=True)
+    prefix = str(count_dir / sample)
+    matrix = np.zeros((len(genes), len(barcodes)), dtype=int)
+    detail = [DETAIL_HEADER]
+    for (gene, barcode), counts in sorted(umis.items()):
+        matrix[genes.index(gene), barcodes.index(barcode)] = len(counts)
+        for i, c in enumerate(counts):
+            detail.append('%s\t%s\tUMI%s\t%s\n' % (barcode, gene, i, c))
+    mmwrite(prefix + '.mtx', sparse.csr_matrix(matrix), field='integer')
+    with open(prefix + '_genes.tsv', 'w') as fh:
+        fh.write('geneID\n' + ''.join(g + '\n' for g in genes))
+    with open(prefix + '_cellbarcode.tsv', 'w') as fh:
+        fh.write('Barcode\n' + ''.join(b + '\n' for b in barcodes))
+    with open(prefix + '_count_detail.txt', 'w') as fh:
+        fh.write(''.join(detail))
+    pd.DataFrame({'Barcode': barcodes, 'readcount': [reads[b] for b in barcodes], 'mark': 'CB'}).to_csv(
+        prefix + '_counts.txt', sep='\t', index=False)
+
+
+def two_samples(workdir):
+    write_sample(workdir, 'S1', ['g1', 'g2'], ['AAA', 'CCC'],
+        {('g1', 'AAA'): [2, 2], ('g2', 'CCC'): [1]}, {'AAA': 4, 'CCC': 1})
+    write_sample(workdir, 'S2', ['g2', 'g3'], ['AAA'],
+        {('g2', 'AAA'): [10, 10, 10], ('g3', 'AAA'): [5]}, {'AAA': 35})
+
+
+def run(*argv):
+    args = scope.get_parser().parse_args(['aggregate'] + list(argv))
+    return args.func(args)
+
+
+def load(prefix):
+    matrix = mmread(prefix + '.mtx').toarray()
+    return (matrix, list(read_list(prefix + '_genes.tsv', 'geneID')),
+        list(read_list(prefix + '_cellbarcode.tsv', 'Barcode')))
+
+
+def test_aggregate_two_samples(tmp_path):
+    two_samples(tmp_path)
+    shape, nnz = run('--samples', 'S1,S2', '--workdir', str(tmp_path))
+    matrix, genes, barcodes = load(str(tmp_path / 'aggr'))
+    assert genes == ['g1', 'g2', 'g3']
+    assert barcodes == ['S1_AAA', 'S1_CCC', 'S2_AAA']
+    assert matrix.tolist() == [[2, 0, 0], [0, 1, 3], [0, 0, 1]]
+    assert shape == (3, 3) and nnz == 4
+    samples = pd.read_table(str(tmp_path / 'aggr_samples.tsv'))
+    assert samples['Sample'].tolist() == ['S1', 'S2']
+    assert samples['read_fraction'].tolist() == [1.0, 1.0]
+
+
+def test_aggregate_normalize_mapped(tmp_path):
+    two_samples(tmp_path)
+    out_prefix = str(tmp_path / 'norm')
+    run('--samples', 'S1,S2', '--workdir', str(tmp_path), '--outPrefix', out_prefix,
+        '--normalize', 'mapped', '--seed', '1')
+    matrix, genes, barcodes = load(out_prefix)
+    assert barcodes == ['S1_AAA', 'S1_CCC', 'S2_AAA']
+    samples = pd.read_table(out_prefix + '_samples.tsv')
+    # S1 is the shallowest, 2.5 reads per cell against 35
+    assert samples['read_fraction'].tolist() == [1.0, round(2.5 / 35, 4)]
+    # the shallowest sample is counted again as it was
+    assert matrix[:, :2].tolist() == [[2, 0], [0, 1], [0, 0]]
+    # downsampling only drops UMIs
+    assert (matrix[:, 2] <= [0, 3, 1]).all()
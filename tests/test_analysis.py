@@ -0,0 +1,16 @@
+from analysis import gene_convert
+
+GTF = ''.join('chr1\tsrc\tgene\t%s\t%s\t.\t+\t.\tgene_id "%s"; gene_name "%s";\n' % (s, s + 100, i, n)
+    for s, i, n in [(1, 'G1', 'A'), (201, 'G2', 'B'), (401, 'G3', 'A'), (601, 'G4', 'D')])
+
+
+def test_gene_convert(tmp_path):
+    gtf = tmp_path / 'genes.gtf'
+    gtf.write_text(GTF)
+    # GX is not annotated, G3 repeats the name of G1
+    names, keep = gene_convert(str(gtf), ['G2', 'GX', 'G1', 'G3', 'G4'])
+    assert names.tolist() == ['B', 'A', 'D']
+    assert keep.tolist() == [0, 2, 4]
+
+    names, keep = gene_convert(str(gtf), [])
+    assert names.tolist() == [] and keep.tolist() == []
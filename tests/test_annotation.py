@@ -0,0 +1,103 @@
+import os
+import glob
+import shutil
+
+import numpy as np
+
+import annotation
+from annotation import IntervalIndex
+
+
+def brute_force(intervals, start, end):
+    return set(v for s, e, v in intervals if s < end and e > start)
+
+
+def random_intervals(rs, n, span):
+    starts = rs.randint(0, span, n)
+    lengths = rs.randint(1, 3000, n)
+    return [(int(s), int(s + l), 'g%d' % (i)) for i, (s, l) in enumerate(zip(starts, lengths))]
+
+
+def test_query_matches_brute_force():
+    rs = np.random.RandomState(0)
+    intervals = random_intervals(rs, 2000, 10 ** 6) + [(10, 900000, 'long'), (500000, 500000, 'empty')]
+    index = IntervalIndex()
+    for s, e, v in intervals:
+        index.add('chr1', s, e, v)
+    index.build()
+    for start in rs.randint(0, 10 ** 6, 500):
+        end = start + int(rs.randint(1, 200))
+        assert index.query('chr1', start, end) == brute_force(intervals, start, end)
+    assert index.query('chr2', 0, 100) == set()
+
+
+def test_from_arrays_matches_build():
+    rs = np.random.RandomState(1)
+    intervals = sorted(random_intervals(rs, 500, 10 ** 5) + [(0, 90000, 'long')])
+    built = IntervalIndex()
+    for s, e, v in intervals:
+        built.add('chr1', s, e, v)
+    built.build()
+    starts, ends, values = zip(*intervals)
+    loaded = IntervalIndex.from_arrays('chr1', np.array(starts), np.array(ends), list(values))
+    for start in range(0, 10 ** 5, 997):
+        assert loaded.query('chr1', start, start + 100) == built.query('chr1', start, start + 100)
+
+
+def test_long_interval_found_everywhere():
+    # one long interval before all others, the case that made queries walk
+    # back over all intervals; timed in benchmark/bench_hotpaths.py
+    rs = np.random.RandomState(2)
+    span = 10 ** 6
+    intervals = [(0, span, 'long')] + random_intervals(rs, 5000, span)
+    index = IntervalIndex()
+    for s, e, v in intervals:
+        index.add('chr1', s, e, v)
+    index.build()
+    for start in rs.randint(0, span, 300):
+        start = int(start)
+        assert index.query('chr1', start, start + 100) == brute_force(intervals, start, start + 100)
+
+
+GTF = (
+    'chr1\tsrc\tgene\t101\t500\t.\t+\t.\tgene_id "G1"; gene_name "A";\n'
+    'chr1\tsrc\texon\t101\t200\t.\t+\t.\tgene_id "G1"; gene_name "A";\n'
+    'chr1\tsrc\texon\t301\t500\t.\t+\t.\tgene_id "G1"; gene_name "A";\n'
+)
+
+
+def no_compile(gtf_file, outdir):
+    raise AssertionError('compiled again')
+
+
+def test_store_compiled_once(tmp_path, monkeypatch):
+    gtf = tmp_path / 'genes.gtf'
+    gtf.write_text(GTF)
+    store = annotation.load_annotation(str(gtf)).path
+    monkeypatch.setattr(annotation, 'compile_gtf', no_compile)
+    loaded = annotation.load_annotation(str(gtf))
+    assert loaded.path == store
+    assert loaded.id_name == {'G1': 'A'}
+
+    # a copy, as on another node or in another reference dir, has the same key
+    copy_dir = tmp_path / 'copy'
+    copy_dir.mkdir()
+    shutil.copyfile(str(gtf), str(copy_dir / 'genes.gtf'))
+    assert os.path.basename(annotation.store_dir(str(copy_dir / 'genes.gtf'))) == os.path.basename(store)
+
+
+def test_store_of_edited_gtf(tmp_path):
+    gtf = tmp_path / 'genes.gtf'
+    gtf.write_text(GTF)
+    os.utime(str(gtf), ns=(10 ** 18, 10 ** 18))
+    old = annotation.load_annotation(str(gtf)).path
+
+    # same size, same first and last bytes, rewritten within the same second
+    gtf.write_text(GTF.replace('"A"', '"B"', 2))
+    os.utime(str(gtf), ns=(10 ** 18 + 1, 10 ** 18 + 1))
+    new = annotation.load_annotation(str(gtf))
+    assert new.path != old
+    assert new.id_name == {'G1': 'B'}
+    # the store of the old content is removed
+    assert not os.path.exists(old)
+    assert glob.glob(str(tmp_path / 'genes.gtf.*.store')) == [new.path]
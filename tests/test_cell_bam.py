@@ -0,0 +1,79 @@
+import random
+
+import pysam
+import pytest
+
+from cell_bam import load_barcode_index, write_cell_bam
+from count import bam2table
+
+
+def write_bam(path, barcodes, seed=0):
+    """
+    name sorted bam of unmapped reads {barcode}_{umi}_{n}, most with a gene
+    in XT. returns the read names of each barcode
+    """
+    rng = random.Random(seed)
+    header = {'HD': {'VN': '1.0', 'SO': 'queryname'}, 'SQ': [{'SN': 'chr1', 'LN': 10000}]}
+    names = {}
+    n = 0
+    with pysam.AlignmentFile(path, 'wb', header=header) as out:
+        for barcode in barcodes:
+            names[barcode] = []
+            # enough reads that barcodes span several bgzf blocks
+            for _ in range(rng.randint(1, 200)):
+                seg = pysam.AlignedSegment()
+                seg.query_name = '%s_%s_%s' % (barcode, ''.join(rng.choice('ACGT') for _ in range(8)), n)
+                seg.query_sequence = ''.join(rng.choice('ACGT') for _ in range(100))
+                seg.query_qualities = pysam.qualitystring_to_array('F' * 100)
+                seg.flag = 4
+                if rng.random() < 0.8:
+                    seg.set_tag('XT', 'G%s' % (rng.randint(0, 20)))
+                out.write(seg)
+                names[barcode].append(seg.query_name)
+                n += 1
+    return names
+
+
+def fetched(path):
+    with pysam.AlignmentFile(path, 'rb') as fh:
+        return [seg.query_name for seg in fh]
+
+
+@pytest.fixture
+def indexed_bam(tmp_path):
+    barcodes = ['BC%03d' % (i) for i in range(60)]
+    bam = str(tmp_path / 'S1_name_sorted.bam')
+    names = write_bam(bam, barcodes)
+    index_file = str(tmp_path / 'S1_barcode_index.tsv')
+    bam2table(bam, str(tmp_path / 'S1_count_detail.txt'), index_file=index_file)
+    return tmp_path, bam, index_file, names
+
+
+def test_index_covers_every_barcode(indexed_bam):
+    tmp_path, bam, index_file, names = indexed_bam
+    index = load_barcode_index(index_file)
+    assert sorted(index) == sorted(names)
+    assert all(index[b][2] == len(names[b]) for b in names)
+    # each barcode ends where the next one starts
+    barcodes = sorted(names)
+    assert all(index[a][1] == index[b][0] for a, b in zip(barcodes, barcodes[1:]))
+
+
+@pytest.mark.parametrize('barcode', ['BC000', 'BC031', 'BC059'])
+def test_fetch_one_barcode(indexed_bam, barcode):
+    tmp_path, bam, index_file, names = indexed_bam
+    out_bam = str(tmp_path / 'cell.bam')
+    assert write_cell_bam(bam, index_file, [barcode], out_bam) == len(names[barcode])
+    assert fetched(out_bam) == names[barcode]
+
+
+def test_fetch_run_and_topup(indexed_bam):
+    tmp_path, bam, index_file, names = indexed_bam
+    topup_bam = str(tmp_path / 'topup.bam')
+    topup_names = write_bam(topup_bam, ['BC001', 'BC059', 'BC070'], seed=1)
+    topup_index = str(tmp_path / 'S1_topup1_barcode_index.tsv')
+    bam2table(topup_bam, str(tmp_path / 'topup_detail.txt'), index_file=topup_index)
+
+    out_bam = str(tmp_path / 'cells.bam')
+    write_cell_bam([bam, topup_bam], [index_file, topup_index], ['BC059', 'BC002', 'BC070', 'none'], out_bam)
+    assert fetched(out_bam) == names['BC059'] + topup_names['BC059'] + names['BC002'] + topup_names['BC070']
@@ -0,0 +1,83 @@
+import numpy as np
+
+from chemistry import ExtractionPlan, SegmentMatcher, datadir, get_chemistry, read_seqs, seq_dict
+
+BARCODES = ['AACCGGTT', 'ACGTACGT', 'TTGGCCAA', 'GATCGATC']
+# C8L4C8L4C8
+PATTERN = [(0, 8), (12, 20), (24, 32)]
+LINKER = 'ACTG'
+
+
+def read(*segments, linker=LINKER):
+    return linker.join(segments)
+
+
+def barcode_matcher(**kwargs):
+    index = seq_dict(BARCODES, 1)
+    return SegmentMatcher(PATTERN, [index] * 3, ExtractionPlan.BARCODE_MAX_MISMATCH, **kwargs)
+
+
+def mismatch(seq, i):
+    return seq[:i] + ('A' if seq[i] != 'A' else 'C') + seq[i + 1:]
+
+
+def test_barcode_segments():
+    matcher = barcode_matcher()
+    a, b, c = BARCODES[:3]
+    assert matcher.match(read(a, b, c)) == (a + b + c, 0)
+    # one mismatch in any segment is corrected
+    for i in range(3):
+        segments = [a, b, c]
+        segments[i] = mismatch(segments[i], 3)
+        assert matcher.match(read(*segments)) == (a + b + c, 1)
+    # two in one segment, or one in each of two segments, is over budget
+    assert matcher.match(read(mismatch(mismatch(a, 0), 5), b, c)) is None
+    assert matcher.match(read(mismatch(a, 0), mismatch(b, 0), c)) is None
+    assert matcher.match(read(a, b, 'NNNNNNNN')) is None
+
+
+def test_linker_segments():
+    # L4 at 8 and 20, one mismatch per segment and two in total
+    ranges = [(8, 12), (20, 24)]
+    matcher = SegmentMatcher(ranges, [seq_dict([LINKER], 1)] * 2, ExtractionPlan.LINKER_MAX_MISMATCH)
+    a, b, c = BARCODES[:3]
+    assert matcher.match(read(a, b, c)) == (LINKER * 2, 0)
+    bad = mismatch(LINKER, 1)
+    assert matcher.match(a + bad + b + LINKER + c) == (LINKER * 2, 1)
+    assert matcher.match(a + bad + b + bad + c) == (LINKER * 2, 2)
+    # two mismatches in one linker, used to pass as two over the joined linkers
+    assert matcher.match(a + mismatch(bad, 2) + b + LINKER + c) is None
+
+
+def test_exact_set_matches_indexed_path():
+    rs = np.random.RandomState(0)
+    reads = []
+    for _ in range(3000):
+        segments = [BARCODES[i] for i in rs.randint(0, len(BARCODES), 3)]
+        seq = list(read(*segments))
+        for i in rs.randint(0, len(seq), rs.poisson(0.8)):
+            seq[i] = 'ACGTN'[rs.randint(5)]
+        reads.append(''.join(seq))
+    fast = barcode_matcher(reorder=7)
+    assert fast.exact is not None
+    indexed = barcode_matcher()
+    indexed.exact = None
+    results = [fast.match(r) for r in reads]
+    assert results == [indexed.match(r) for r in reads]
+    assert any(r is None for r in results) and any(r and r[1] == 1 for r in results)
+    # the segments are reordered by rejections on the way
+    assert sum(fast.rejects) == results.count(None)
+
+
+def test_scope_registry_matches_1_0_files():
+    scope = get_chemistry('scope')
+    plan = ExtractionPlan(scope['pattern'], scope['whitelist'], scope['linker'])
+    old = ExtractionPlan(scope['pattern'], [datadir + '/1.0/bclist'], [datadir + '/1.0/linker_withC'])
+
+    def exact(matcher):
+        return [sorted(k for k, v in index.items() if v[1] == 0) for index in matcher.indexes]
+
+    bclist = sorted(read_seqs(datadir + '/1.0/bclist'))
+    assert exact(plan.barcode_matcher) == [bclist] * 3
+    assert exact(plan.linker_matcher) == exact(old.linker_matcher)
+    assert ''.join(s[0] for s in exact(plan.linker_matcher)) == read_seqs(datadir + '/1.0/linker_withC')[0]
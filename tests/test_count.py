@@ -0,0 +1,28 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from count import barcode_filter_with_magnitude
+from figures import render_figures
+
+
+def test_cell_calling_figure(tmp_path):
+    count_dir = tmp_path / '05.count'
+    count_dir.mkdir()
+    umi = np.concatenate([np.arange(1000, 900, -1), np.arange(50, 0, -1)])
+    df = pd.DataFrame({'UMI': umi}, index=['CB%s' % (i) for i in range(len(umi))])
+    plot = str(count_dir / 'barcode_filter_magnitude.pdf')
+
+    barcodes, threshold, cell_num = barcode_filter_with_magnitude(df, plot=plot, col='UMI',
+        expected_cell_num=100)
+    # 10% of the UMI of the barcode at rank 1% of the expected cells
+    assert threshold == 100
+    assert cell_num == 100
+    assert list(barcodes) == ['CB%s' % (i) for i in range(100)]
+    assert not os.path.exists(plot)
+
+    assert render_figures(str(tmp_path)) == ['barcode_filter_magnitude']
+    assert os.path.getsize(plot) > 0
+    # cached, nothing drawn again
+    assert render_figures(str(tmp_path)) == []
@@ -0,0 +1,22 @@
+import gzip
+
+import pytest
+
+from decompress import open_input
+
+
+def write_gzip(path, n):
+    with gzip.open(str(path), 'wt') as fh:
+        for i in range(n):
+            fh.write('@r%d\nACGT\n+\nIIII\n' % (i))
+
+
+def test_open_input_truncated(tmp_path):
+    fq = tmp_path / 'reads.fq.gz'
+    write_gzip(fq, 100000)
+    data = fq.read_bytes()
+    truncated = tmp_path / 'truncated.fq.gz'
+    truncated.write_bytes(data[:len(data) // 2])
+    assert sum(1 for _ in open_input(str(fq))) == 400000
+    with pytest.raises(IOError):
+        sum(1 for _ in open_input(str(truncated)))
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+h5py = pytest.importorskip('h5py')
+
+from h5matrix import read_cells, read_genes, write_h5
+
+
+@pytest.fixture
+def h5_file(tmp_path):
+    rs = np.random.RandomState(0)
+    matrix = sparse.random(50, 30, density=0.2, format='csc', random_state=rs)
+    matrix.data = rs.randint(1, 100, matrix.nnz).astype(float)
+    # an empty cell and an empty gene
+    matrix = matrix.tolil()
+    matrix[:, 7] = 0
+    matrix[11, :] = 0
+    matrix = sparse.csc_matrix(matrix)
+    barcodes = np.array(['CELL%02d' % (i) for i in range(30)])
+    gene_ids = np.array(['G%02d' % (i) for i in range(50)])
+    cell_qc = pd.DataFrame({'readcount': np.arange(30) * 10, 'mark': ['CB'] * 30}, index=barcodes)
+    path = str(tmp_path / 'S1_matrix.h5')
+    write_h5(path, matrix, barcodes, gene_ids, gene_names=np.char.add('name', gene_ids), cell_qc=cell_qc)
+    return path, matrix.toarray(), barcodes, gene_ids
+
+
+def test_read_cells(h5_file):
+    path, dense, barcodes, gene_ids = h5_file
+    matrix, names = read_cells(path)
+    assert (matrix.toarray() == dense).all()
+    assert names.tolist() == barcodes.tolist()
+
+    # positions with runs and gaps, and barcodes in any order
+    for cells in [[0, 1, 2, 7, 20, 29], ['CELL29', 'CELL03', 'CELL07'], slice(5, 15, 3)]:
+        matrix, names = read_cells(path, cells)
+        positions = np.arange(30)[cells] if isinstance(cells, slice) else \
+            [int(c[4:]) if isinstance(c, str) else c for c in cells]
+        assert (matrix.toarray() == dense[:, positions]).all()
+        assert names.tolist() == barcodes[positions].tolist()
+
+
+def test_read_genes(h5_file):
+    path, dense, barcodes, gene_ids = h5_file
+    matrix, names = read_genes(path, ['G11', 'G00', 'G49'])
+    assert sparse.isspmatrix_csr(matrix)
+    assert (matrix.toarray() == dense[[11, 0, 49], :]).all()
+    assert names.tolist() == ['G11', 'G00', 'G49']
+    matrix, _ = read_genes(path)
+    assert (matrix.toarray() == dense).all()
+
+
+def test_empty_selection(h5_file):
+    path, dense, barcodes, gene_ids = h5_file
+    matrix, names = read_cells(path, [])
+    assert matrix.shape == (50, 0) and len(names) == 0
+    matrix, names = read_genes(path, [])
+    assert matrix.shape == (0, 30) and len(names) == 0
+
+
+def test_layout(h5_file):
+    path, dense, barcodes, gene_ids = h5_file
+    with h5py.File(path, 'r') as fh:
+        by_gene = sparse.csr_matrix((fh['matrix_by_gene/data'][:], fh['matrix_by_gene/indices'][:],
+            fh['matrix_by_gene/indptr'][:]), shape=dense.shape)
+        assert (by_gene.toarray() == dense).all()
+        assert fh['matrix/shape'][:].tolist() == [50, 30]
+        assert fh['matrix/features/name'][0] == b'nameG00'
+        assert fh['cell_qc/readcount'][:].tolist() == list(range(0, 300, 10))
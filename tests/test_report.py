@@ -0,0 +1,16 @@
+import json
+
+from report import load_data, render_report, update_fragment
+
+
+def test_data_json_has_arrays_inline(tmp_path):
+    outdir = str(tmp_path)
+    umi = list(range(1000, 0, -1))
+    update_fragment(outdir, 'count', {'Cells': umi, 'CB_num': 10})
+    assert load_data(outdir)['Cells'] == {'$array': 'Cells'}
+
+    render_report(outdir)
+    with open(outdir + '/.data.json') as fh:
+        data = json.load(fh)
+    assert data['Cells'] == umi
+    assert data['CB_num'] == 10
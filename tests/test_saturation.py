@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from saturation import (extrapolate, fit_genes, fit_reads_per_molecule, fold_for_genes, fold_for_saturation,
+    genes_at, poisson_rate, saturation_at)
+
+
+def reads_per_molecule(m, a, n=50000, seed=0):
+    # gamma-Poisson reads of n molecules, the ones seen
+    rs = np.random.RandomState(seed)
+    reads = rs.poisson(rs.gamma(a, m / a, size=n))
+    return reads[reads > 0], rs
+
+
+def observed_saturation(reads):
+    return (1 - (reads == 1).sum() / float(len(reads))) * 100
+
+
+@pytest.mark.parametrize('m,a', [(1.5, 2.0), (0.8, 50.0), (3.0, 1.0)])
+def test_saturation_at_observed_depth(m, a):
+    reads, rs = reads_per_molecule(m, a)
+    model = fit_reads_per_molecule(reads)
+    assert saturation_at(model, 1) == pytest.approx(observed_saturation(reads), abs=0.5)
+    # half of the reads, as downsampling keeps them
+    half = rs.binomial(reads, 0.5)
+    assert saturation_at(model, 0.5) == pytest.approx(observed_saturation(half[half > 0]), abs=1)
+
+
+def test_fold_for_saturation_is_monotonic():
+    reads, _ = reads_per_molecule(1.5, 2.0)
+    model = fit_reads_per_molecule(reads)
+    targets = [10, 30, 50, 70, 80, 90, 95]
+    folds = [fold_for_saturation(model, t) for t in targets]
+    assert all(f1 < f2 for f1, f2 in zip(folds, folds[1:]))
+    for target, fold in zip(targets, folds):
+        assert saturation_at(model, fold) == pytest.approx(target, abs=1e-6)
+    # the current depth is between the targets below and above it
+    current = saturation_at(model, 1)
+    assert fold_for_saturation(model, current - 5) < 1 < fold_for_saturation(model, current + 5)
+    assert fold_for_saturation(model, 99.99999) is None
+
+
+def test_unfit_histograms():
+    # every molecule seen once, or none
+    assert fit_reads_per_molecule(np.ones(100, dtype=int)) is None
+    assert fit_reads_per_molecule(np.full(100, 3)) is None
+    assert poisson_rate(0, 100) == np.inf
+    assert poisson_rate(100, 100) == 0
+
+
+def test_genes_fit():
+    fractions = np.arange(0.1, 1.05, 0.1)
+    medians = genes_at((2000, 0.8), fractions)
+    params = fit_genes(np.r_[0, fractions], np.r_[0, medians])
+    assert params == pytest.approx((2000, 0.8), rel=1e-3)
+    folds = [fold_for_genes(params, t) for t in [500, 1000, 1500, 1900]]
+    assert all(f1 < f2 for f1, f2 in zip(folds, folds[1:]))
+    assert genes_at(params, folds[1]) == pytest.approx(1000)
+    assert fold_for_genes(params, 2500) is None
+    assert fit_genes([0, 0.5], [0, 100]) is None
+
+
+def test_extrapolate_table():
+    reads, _ = reads_per_molecule(1.5, 2.0, n=5000)
+    fractions = np.arange(0.1, 1.05, 0.1)
+    table, model, params = extrapolate(reads, fractions, genes_at((2000, 0.8), fractions), folds=[0.5, 1, 2])
+    assert table['fold'].tolist() == [0.5, 1, 2]
+    assert table['saturation'].is_monotonic_increasing
+    assert table['median_geneNum'].is_monotonic_increasing
@@ -0,0 +1,14 @@
+import argparse
+
+import scope
+
+
+def test_profiled_subcommands_take_profile():
+    parser = scope.get_parser()
+    action = [a for a in parser._actions if isinstance(a, argparse._SubParsersAction)][0]
+    for name, sub_parser in action.choices.items():
+        func = sub_parser.get_default('func')
+        options = [o for a in sub_parser._actions for o in a.option_strings]
+        if func.profiled:
+            assert '--profile' in options, name
+            assert '--outdir' in options, name
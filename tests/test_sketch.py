@@ -0,0 +1,53 @@
+from collections import Counter
+
+from sketch import SpaceSaving
+
+
+def test_prune_keeps_k_of_tied_singletons():
+    sketch = SpaceSaving(k=10)
+    for i in range(19):
+        sketch.add('CB%03d' % (i))
+    sketch.add('CB019')
+    assert len(sketch) == 10
+    assert sketch.floor == 1
+
+
+def test_heavy_hitters_survive_ties():
+    sketch = SpaceSaving(k=5)
+    # seen more than n / k times
+    for _ in range(300):
+        sketch.add('HEAVY')
+    for i in range(1000):
+        sketch.add('S%04d' % (i))
+    assert 'HEAVY' in sketch
+    assert 300 <= sketch['HEAVY'] <= 300 + sketch.floor
+
+
+def test_merge_overestimates_by_at_most_floor():
+    lanes = [['A'] * 50 + ['B'] * 30 + ['X%d' % (i) for i in range(40)],
+        ['B'] * 40 + ['C'] * 20 + ['Y%d' % (i) for i in range(40)] + ['A'] * 3]
+    truth = Counter()
+    merged = None
+    for reads in lanes:
+        truth.update(reads)
+        sketch = SpaceSaving(k=4)
+        for key in reads:
+            sketch.add(key)
+        if merged is None:
+            merged = sketch
+        else:
+            merged.update(sketch)
+    assert len(merged) < 2 * merged.k
+    for key, n in truth.items():
+        assert n <= merged[key] <= n + merged.floor
+    assert merged.most_common()[0][0] == 'B'
+
+
+def test_merge_of_unpruned_sketches_is_exact():
+    a, b = SpaceSaving(k=100), SpaceSaving(k=100)
+    for key in 'AAB':
+        a.add(key)
+    for key in 'BC':
+        b.add(key)
+    a.update(b)
+    assert dict(a.items()) == {'A': 2, 'B': 2, 'C': 1}
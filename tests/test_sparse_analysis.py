@@ -0,0 +1,105 @@
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from sparse_analysis import column_ranks, find_markers, normalize, run_analysis
+
+
+def two_groups(n_cells=80, n_genes=300, seed=0):
+    # background counts plus 30 genes high in each half of the cells
+    rs = np.random.RandomState(seed)
+    counts = rs.poisson(0.3, size=(n_cells, n_genes))
+    half = n_cells // 2
+    counts[:half, :30] += rs.poisson(6, size=(half, 30))
+    counts[half:, 30:60] += rs.poisson(6, size=(n_cells - half, 30))
+    group = np.r_[np.zeros(half, dtype=int), np.ones(n_cells - half, dtype=int)]
+    return sparse.csr_matrix(counts), group
+
+
+def test_python_backend_finds_two_clusters(tmp_path, caplog):
+    X, group = two_groups()
+    genes = np.array(['g%s' % (i) for i in range(X.shape[1])])
+    barcodes = np.array(['C%s' % (i) for i in range(X.shape[0])])
+    with caplog.at_level(logging.WARNING):
+        run_analysis(X, genes, barcodes, str(tmp_path), k=10)
+
+    tsne = pd.read_table(str(tmp_path / 'tsne_coord.tsv'), index_col=0)
+    assert tsne.columns.tolist() == ['tSNE_1', 'tSNE_2', 'cluster', 'Gene_Counts']
+    assert tsne.index.tolist() == barcodes.tolist()
+    assert tsne['Gene_Counts'].tolist() == np.diff(X.indptr).tolist()
+    assert np.isfinite(tsne[['tSNE_1', 'tSNE_2']].values).all()
+    # one cluster per group
+    assert pd.crosstab(tsne['cluster'], group).gt(0).sum(axis=1).eq(1).all()
+    assert tsne['cluster'].nunique() == 2
+    # the embedding separates the groups along one of its axes
+    coord = tsne[['tSNE_1', 'tSNE_2']].values
+    assert any(coord[group == 0, i].max() < coord[group == 1, i].min() or
+        coord[group == 1, i].max() < coord[group == 0, i].min() for i in range(2))
+
+    markers = pd.read_table(str(tmp_path / 'markers.tsv'))
+    top = markers.groupby('cluster').head(10)
+    for cluster, genes_up in top.groupby('cluster')['gene']:
+        cells = tsne.index[tsne['cluster'] == cluster]
+        up = set(range(30)) if group[tsne.index.get_indexer(cells)].mean() == 0 else set(range(30, 60))
+        assert set(int(g[1:]) for g in genes_up) <= up
+
+    try:
+        import sklearn
+    except ImportError:
+        assert any('spectral embedding' in r.getMessage() for r in caplog.records if r.levelno == logging.WARNING)
+
+
+def reference_markers(X, clusters):
+    # per cluster and gene, one scipy wilcoxon test against the other cells
+    from scipy.stats import mannwhitneyu
+    D = X.toarray()
+    E = np.expm1(D)
+    rows = []
+    for c in np.unique(clusters):
+        inside, outside = D[clusters == c], D[clusters != c]
+        for g in range(D.shape[1]):
+            p = mannwhitneyu(inside[:, g], outside[:, g], use_continuity=True, alternative='two-sided',
+                method='asymptotic')[1]
+            logfc = np.log1p(E[clusters == c, g].mean()) - np.log1p(E[clusters != c, g].mean())
+            rows.append([c, g, p, logfc, (inside[:, g] > 0).mean(), (outside[:, g] > 0).mean()])
+    return pd.DataFrame(rows, columns=['cluster', 'g', 'p_val', 'avg_logFC', 'pct.1', 'pct.2'])
+
+
+def test_find_markers_matches_reference():
+    X, group = two_groups(n_cells=30, n_genes=70, seed=1)
+    X = normalize(X)
+    rs = np.random.RandomState(2)
+    clusters = rs.randint(0, 3, X.shape[0])
+    clusters[group == 1] = 3
+    genes = np.array(['g%s' % (i) for i in range(X.shape[1])])
+
+    # every gene of every cluster, in blocks of 25 genes
+    markers = find_markers(X, clusters, genes, min_pct=0, logfc_threshold=0, return_thresh=2, block=25)
+    markers['g'] = markers['gene'].str[1:].astype(int)
+    merged = reference_markers(X, clusters).merge(markers, on=['cluster', 'g'], suffixes=('', '_fast'))
+    assert len(merged) == len(markers) == 4 * X.shape[1]
+    np.testing.assert_allclose(merged['p_val_fast'], merged['p_val'], rtol=1e-6)
+    np.testing.assert_allclose(merged['avg_logFC_fast'], merged['avg_logFC'], rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(merged['pct.1_fast'], merged['pct.1'].round(3))
+    np.testing.assert_allclose(merged['pct.2_fast'], merged['pct.2'].round(3))
+    np.testing.assert_allclose(markers['p_val_adj'], np.minimum(markers['p_val'] * X.shape[1], 1))
+
+    # ranks within each cluster follow the fold change
+    for _, cluster_markers in markers.groupby('cluster'):
+        assert cluster_markers['avg_logFC'].is_monotonic_decreasing
+
+
+def test_column_ranks_match_rankdata():
+    from scipy.stats import rankdata
+    rs = np.random.RandomState(3)
+    D = rs.poisson(0.7, size=(50, 8)).astype(float)
+    D[:, 5] = 0
+    R, zero_rank, tie = column_ranks(sparse.csc_matrix(D))
+    for g in range(D.shape[1]):
+        expected = rankdata(D[:, g])
+        ranks = np.where(D[:, g] > 0, R[:, g].toarray().ravel(), zero_rank[g])
+        np.testing.assert_allclose(ranks, expected)
+        t = np.unique(D[:, g], return_counts=True)[1].astype(float)
+        assert tie[g] == (t ** 3 - t).sum()
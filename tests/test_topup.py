@@ -0,0 +1,106 @@
+from argparse import Namespace
+
+import pandas as pd
+import pytest
+from scipy.io import mmread
+
+import count
+from report import load_fragment
+
+HEADER = 'Barcode\tgeneID\tUMI\tcount\n'
+
+
+@pytest.fixture
+def sample(tmp_path, monkeypatch):
+    count_dir = tmp_path / 'S1' / '05.count'
+    count_dir.mkdir(parents=True)
+    (count_dir / 'S1_count_detail.txt').write_text(HEADER + 'AAA\tg1\tACGT\t3\nCCC\tg2\tTTTT\t1\n')
+    for d in ['T1', 'T2']:
+        (tmp_path / d).mkdir()
+
+    raw = {'T1': 'AAA\tg1\tACGT\t2\nCCC\tg3\tGGGG\t1\n', 'T2': 'CCC\tg2\tTTTT\t4\n'}
+
+    def bam2table(bam, detail_file, args=None, index_file=None, correct=True):
+        with open(detail_file, 'w') as fh:
+            fh.write(HEADER + raw[bam.split('/')[-3]])
+        open(index_file, 'w').close()
+
+    monkeypatch.setattr(count, 'bam2table', bam2table)
+    monkeypatch.setattr(count, 'valid_reads', lambda outdir: 100)
+    return tmp_path, raw
+
+
+@pytest.fixture
+def counted(monkeypatch):
+    counted = []
+    monkeypatch.setattr(count, 'count_from_detail',
+        lambda args, detail_file, valid_read_number=None: counted.append(valid_read_number))
+    return counted
+
+
+def topup(tmp_path, topup_dir):
+    count.topup(Namespace(outdir=str(tmp_path / 'S1' / '05.count'), sample='S1', h5=False, cells=100,
+        topupDir=str(tmp_path / topup_dir)))
+
+
+def umi_reads(tmp_path):
+    df = pd.read_table(str(tmp_path / 'S1' / '05.count' / 'S1_count_detail.txt'))
+    return df.set_index(['Barcode', 'geneID', 'UMI'])['count'].to_dict()
+
+
+def test_topup_twice_counts_once(sample, counted):
+    tmp_path, _ = sample
+    topup(tmp_path, 'T1')
+    once = umi_reads(tmp_path)
+    topup(tmp_path, 'T1')
+    assert umi_reads(tmp_path) == once == {
+        ('AAA', 'g1', 'ACGT'): 5, ('CCC', 'g2', 'TTTT'): 1, ('CCC', 'g3', 'GGGG'): 1}
+    assert counted == [200, 200]
+
+
+def test_topup_rerun_after_crash(sample, counted, monkeypatch):
+    tmp_path, _ = sample
+    topup(tmp_path, 'T1')
+    # the merge of T2 replaced the detail, then the step died before recording it
+    update = count.update_fragment
+    monkeypatch.setattr(count, 'update_fragment', lambda *a: (_ for _ in ()).throw(RuntimeError('crash')))
+    with pytest.raises(RuntimeError):
+        topup(tmp_path, 'T2')
+    monkeypatch.setattr(count, 'update_fragment', update)
+    topup(tmp_path, 'T2')
+    assert umi_reads(tmp_path)[('CCC', 'g2', 'TTTT')] == 5
+    assert umi_reads(tmp_path)[('AAA', 'g1', 'ACGT')] == 5
+    topups = load_fragment(str(tmp_path / 'S1'), 'count')['topups']
+    assert sorted(t['n'] for t in topups.values()) == [1, 2]
+    assert counted[-1] == 300
+
+
+def test_topup_counts_merged_detail(sample):
+    tmp_path, raw = sample
+    count_dir = tmp_path / 'S1' / '05.count'
+    umis = ['%s%s' % (a, b) for a in 'ACGT' for b in 'ACGT']
+    # 3 cells of 16 UMIs over 4 genes, and 4 barcodes of background
+    base = ''.join('CELL%s\tg%s\t%s\t1\n' % (c, i % 4, u) for c in range(3) for i, u in enumerate(umis))
+    base += ''.join('BG%s\tg0\tAA\t1\n' % (b) for b in range(4))
+    (count_dir / 'S1_count_detail.txt').write_text(HEADER + base)
+    # more reads of known UMIs, a new UMI of CELL1 and a new gene of CELL2
+    raw['T1'] = 'CELL0\tg0\tAA\t2\nCELL1\tg1\tTT\t1\nCELL2\tg4\tGG\t1\n'
+
+    topup(tmp_path, 'T1')
+    matrix = mmread(str(count_dir / 'S1.mtx')).toarray()
+    genes = pd.read_table(str(count_dir / 'S1_genes.tsv')).iloc[:, 0].tolist()
+    cells = pd.read_table(str(count_dir / 'S1_cellbarcode.tsv')).iloc[:, 0].tolist()
+    assert genes == ['g0', 'g1', 'g2', 'g3', 'g4']
+    assert cells == ['CELL0', 'CELL1', 'CELL2']
+    assert matrix.tolist() == [[4, 4, 4], [4, 5, 4], [4, 4, 4], [4, 4, 4], [0, 0, 1]]
+
+    marked = pd.read_table(str(count_dir / 'S1_counts.txt'), index_col=0)
+    assert marked.loc[['CELL0', 'CELL1', 'CELL2'], 'mark'].tolist() == ['CB'] * 3
+    assert (marked.loc[['BG%s' % (b) for b in range(4)], 'mark'] == 'UB').all()
+    assert marked.loc['CELL0', 'readcount'] == 18
+    assert marked.loc['CELL1', 'UMI'] == 17
+
+    # valid reads of the first run and the top-up, over 3 cells
+    stat = pd.read_table(str(count_dir / 'stat.txt'), sep=':', header=None, index_col=0)[1]
+    assert stat['Mean Reads per Cell'] == '66'
+    assert stat['Estimated Number of Cells'] == '3'
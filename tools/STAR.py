@@ -3,21 +3,18 @@
 
 import os, re, sys, json, logging
 import subprocess 
+from collections import OrderedDict
+from multiprocessing import Pool
+import pysam
 from utils import format_number
+from annotation import load_regions
+from opts import get_opts3
+from profiler import phase
+from decompress import read_files_command, DEFAULT_THREADS
 
 FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 logging.basicConfig(level = logging.INFO, format = FORMAT)
 
-def get_opts3(parser,sub_program):
-    if sub_program:
-        parser.add_argument('--fq', required=True)
-        parser.add_argument('--readFilesCommand', default='zcat')
-        parser.add_argument('--outdir', help='output dir',required=True)
-        parser.add_argument('--sample', help='sample name', required=True)
-    parser.add_argument('--thread', default=2)
-    parser.add_argument('--refFlat', help='refFlat, for stat mapping region', required=True)
-    parser.add_argument('--genomeDir')
-
 def format_stat(map_log, region_log, samplename):
     fh1 = open(map_log, 'r')
     p1 = re.compile(r'Uniquely mapped reads number\s+(\d+)')
@@ -61,6 +58,77 @@ def format_stat(map_log, region_log, samplename):
     return {'region_labels': ['Exonic Regions','Intronic Regions','Intergenic Regions'], 
             'region_values': [Exonic_Regions, Intronic_Regions, Intergenic_Regions]}
 
+REGION_METRICS = ['PF_BASES', 'PF_ALIGNED_BASES', 'CODING_BASES', 'UTR_BASES', 'INTRONIC_BASES', 'INTERGENIC_BASES']
+
+def region_counts(bam, regions, contig, start, end):
+    """
+    count aligned bases in coding, UTR, intronic and intergenic regions of reads
+    starting in contig:[start, end)
+    """
+    metrics = dict.fromkeys(REGION_METRICS, 0)
+    samfile = pysam.AlignmentFile(bam, 'rb')
+    for seg in samfile.fetch(contig, start, end):
+        if seg.is_secondary or seg.is_supplementary or seg.is_qcfail or seg.is_unmapped:
+            continue
+        # reads overlapping the window start belong to the previous window
+        if seg.reference_start < start:
+            continue
+        metrics['PF_BASES'] += seg.query_length
+        for block_start, block_end in seg.get_blocks():
+            exon = regions.overlap('exon', contig, block_start, block_end)
+            coding = regions.overlap('coding', contig, block_start, block_end)
+            gene = max(regions.overlap('gene', contig, block_start, block_end), exon)
+            metrics['PF_ALIGNED_BASES'] += block_end - block_start
+            metrics['CODING_BASES'] += coding
+            metrics['UTR_BASES'] += exon - coding
+            metrics['INTRONIC_BASES'] += gene - exon
+            metrics['INTERGENIC_BASES'] += block_end - block_start - gene
+    samfile.close()
+    return metrics
+
+_regions = None
+
+def _init_region_worker(refFlat):
+    # each worker loads the region index once
+    global _regions
+    _regions = load_regions(refFlat)
+
+def _region_counts(params):
+    return region_counts(params[0], _regions, *params[1:])
+
+def region_stat(bam, refFlat, region_txt, thread=2, window=10000000):
+    """
+    region counts of each contig window in a process pool, merged and written as
+    CollectRnaSeqMetrics so that format_stat reads either engine.
+    unplaced unmapped reads are not counted in PF_BASES.
+    """
+    if not os.path.exists(bam + '.bai'):
+        pysam.index(bam)
+    # compile once before the workers load it
+    load_regions(refFlat)
+    samfile = pysam.AlignmentFile(bam, 'rb')
+    tasks = []
+    for stat in samfile.get_index_statistics():
+        if stat.mapped == 0:
+            continue
+        length = samfile.get_reference_length(stat.contig)
+        for start in range(0, length, window):
+            tasks.append((bam, stat.contig, start, min(start + window, length)))
+    samfile.close()
+
+    metrics = OrderedDict((k, 0) for k in REGION_METRICS)
+    pool = Pool(max(1, int(thread)), initializer=_init_region_worker, initargs=(refFlat,))
+    for res in pool.imap_unordered(_region_counts, tasks):
+        for k in REGION_METRICS:
+            metrics[k] += res[k]
+    pool.close()
+    pool.join()
+
+    with open(region_txt, 'w') as fh:
+        fh.write('## METRICS CLASS\tpicard.analysis.RnaSeqMetrics\n')
+        fh.write('\t'.join(metrics.keys()) + '\n')
+        fh.write('\t'.join([str(v) for v in metrics.values()]) + '\n')
+
 def STAR(args):
     logging.info('STAR ...!')
     # check dir
@@ -71,18 +139,30 @@ def STAR(args):
     outPrefix = args.outdir + '/' + args.sample + '_'
     outBam =  args.outdir + '/' + args.sample + '_'
     # cmd = ['STAR', '--runThreadN', str(args.thread), '--genomeDir', args.genomeDir, '--readFilesIn', args.fq, '--readFilesCommand', 'zcat', '--outFilterMultimapNmax', '1', '--outReadsUnmapped', 'Fastx', '--outFileNamePrefix', outPrefix, '--outSAMtype', 'BAM', 'SortedByCoordinate']    
-    cmd = ['STAR', '--runThreadN', str(args.thread), '--genomeDir', args.genomeDir, '--readFilesIn', args.fq, '--readFilesCommand', 'zcat', '--outFilterMultimapNmax', '1', '--outFileNamePrefix', outPrefix, '--outSAMtype', 'BAM', 'SortedByCoordinate']    
+    # lanes stay separate files, STAR reads a comma separated list as one sample
+    cmd = ['STAR', '--runThreadN', str(args.thread), '--genomeDir', args.genomeDir, '--readFilesIn', args.fq, '--outFilterMultimapNmax', '1', '--outFileNamePrefix', outPrefix, '--outSAMtype', 'BAM', 'SortedByCoordinate']    
+    if getattr(args, 'readFilesCommand', None):
+        cmd += ['--readFilesCommand'] + args.readFilesCommand.split()
+    else:
+        command = read_files_command(args.fq, getattr(args, 'decompressThreads', DEFAULT_THREADS))
+        if command:
+            cmd += ['--readFilesCommand'] + command
     logging.info('%s'%(' '.join(cmd)))
-    subprocess.check_call(cmd )
+    with phase('STAR'):
+        subprocess.check_call(cmd )
     logging.info('STAR done!')
 
     logging.info('stat mapping region ...!')
     outBam = outPrefix + 'Aligned.sortedByCoord.out.bam'
     region_txt = args.outdir + '/' + args.sample + '_region.log'
-    cmd = ['picard', '-Xmx4G', '-XX:ParallelGCThreads=4', 'CollectRnaSeqMetrics', 'I=%s'%(outBam), 'O=%s'%(region_txt), 'REF_FLAT=%s'%(args.refFlat), 'STRAND=NONE', 'VALIDATION_STRINGENCY=SILENT']
-    logging.info('%s'%(' '.join(cmd)))
-    res = subprocess.run(cmd,stderr=subprocess.STDOUT,stdout=subprocess.PIPE)
-    logging.info(res.stdout)
+    with phase('region_stat'):
+        if args.regionEngine == 'native':
+            region_stat(outBam, args.refFlat, region_txt, args.thread)
+        else:
+            cmd = ['picard', '-Xmx4G', '-XX:ParallelGCThreads=4', 'CollectRnaSeqMetrics', 'I=%s'%(outBam), 'O=%s'%(region_txt), 'REF_FLAT=%s'%(args.refFlat), 'STRAND=NONE', 'VALIDATION_STRINGENCY=SILENT']
+            logging.info('%s'%(' '.join(cmd)))
+            res = subprocess.run(cmd,stderr=subprocess.STDOUT,stdout=subprocess.PIPE)
+            logging.info(res.stdout)
     logging.info('stat mapping region done!')
 
     logging.info('generate report ...!')
@@ -0,0 +1,168 @@
+#!/bin/env python
+#coding=utf8
+
+"""
+one genes x cells matrix of several samples from the {sample}.mtx,
+{sample}_genes.tsv and {sample}_cellbarcode.tsv that count writes.
+
+barcodes are prefixed with the sample, {sample}_{barcode}, genes are the
+union of the genes of all samples. samples are read one at a time and their
+entries streamed to the output, so memory follows the nonzeros of the
+largest sample.
+
+with --normalize mapped, the reads of every sample are downsampled to the
+mean reads per cell of the shallowest sample before the UMIs are counted
+again from {sample}_count_detail.txt.
+
+    python3 scope.py aggregate --samples S1,S2 --workdir ./ --normalize mapped
+"""
+
+import os
+import logging
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from sparse_analysis import read_list
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(level = logging.INFO, format = FORMAT)
+
+
+def count_prefix(workdir, sample):
+    return os.path.join(workdir, sample, '05.count', sample)
+
+
+def union_genes(prefixes):
+    """
+    union of the gene ids of the samples, in order of first appearance
+    """
+    genes = {}
+    for prefix in prefixes:
+        for gene in read_list(prefix + '_genes.tsv', 'geneID'):
+            genes.setdefault(gene, len(genes))
+    return genes
+
+
+def mapped_depth(prefix):
+    """
+    number of cells and mean transcriptome reads per cell of {prefix}_counts.txt
+    """
+    df = pd.read_table(prefix + '_counts.txt', index_col=0)
+    cells = df.loc[df['mark'] == 'CB', 'readcount']
+    return len(cells), cells.sum() / float(max(len(cells), 1))
+
+
+def sample_entries(prefix, gene_index):
+    """
+    genes x cells coo of {prefix}.mtx, rows in gene_index, and the barcodes
+    """
+    from scipy.io import mmread
+    matrix = sparse.coo_matrix(mmread(prefix + '.mtx'))
+    genes = read_list(prefix + '_genes.tsv', 'geneID')
+    barcodes = read_list(prefix + '_cellbarcode.tsv', 'Barcode')
+    rows = np.array([gene_index[g] for g in genes], dtype=np.int64)[matrix.row]
+    return sparse.coo_matrix((matrix.data, (rows, matrix.col)),
+        shape=(len(gene_index), len(barcodes))), barcodes
+
+
+def downsampled_entries(prefix, gene_index, fraction, random_state, chunksize=1000000):
+    """
+    genes x cells coo of UMI counts after keeping each read of the cells with
+    probability fraction: a UMI stays when at least one of its reads does.
+    {prefix}_count_detail.txt is read in chunks
+    """
+    barcodes = read_list(prefix + '_cellbarcode.tsv', 'Barcode')
+    cells = pd.Index(barcodes)
+    genes = pd.Index(list(gene_index))
+    rows, cols, data = [], [], []
+    for chunk in pd.read_table(prefix + '_count_detail.txt', chunksize=chunksize):
+        chunk = chunk.loc[chunk['Barcode'].isin(cells), :]
+        kept = random_state.binomial(chunk['count'].values, fraction) > 0
+        chunk = chunk.loc[kept, :]
+        umi = chunk.groupby(['geneID', 'Barcode']).size()
+        rows.append(genes.get_indexer(umi.index.get_level_values(0)))
+        cols.append(cells.get_indexer(umi.index.get_level_values(1)))
+        data.append(umi.values)
+    if not data:
+        rows, cols, data = [np.array([], dtype=int)] * 3
+    matrix = sparse.coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(gene_index), len(barcodes)))
+    # a gene and cell split over two chunks
+    matrix.sum_duplicates()
+    return matrix, barcodes
+
+
+def aggregate_samples(samples, workdir, out_prefix, normalize='none', seed=0, h5=False):
+    """
+    {out_prefix}.mtx, _genes.tsv, _cellbarcode.tsv and _samples.tsv of the
+    samples. returns the genes x cells shape and the number of nonzeros
+    """
+    prefixes = [count_prefix(workdir, s) for s in samples]
+    gene_index = union_genes(prefixes)
+    logging.info('%s genes in %s samples' % (len(gene_index), len(samples)))
+
+    depths = [mapped_depth(p) for p in prefixes]
+    target = min(d for _, d in depths)
+    random_state = np.random.RandomState(seed)
+
+    body = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(out_prefix)),
+        suffix='.mtx.tmp', delete=False)
+    n_cells, nnz = 0, 0
+    rows = []
+    with body, open(out_prefix + '_cellbarcode.tsv', 'w') as bc_fh:
+        bc_fh.write('Barcode\n')
+        for sample, prefix, (cells, depth) in zip(samples, prefixes, depths):
+            logging.info('aggregate %s ...!' % (sample))
+            fraction = 1.0
+            if normalize == 'mapped':
+                fraction = target / depth if depth > 0 else 1.0
+                matrix, barcodes = downsampled_entries(prefix, gene_index, fraction, random_state)
+            else:
+                matrix, barcodes = sample_entries(prefix, gene_index)
+            matrix.eliminate_zeros()
+            np.savetxt(body, np.column_stack([matrix.row + 1, matrix.col + 1 + n_cells, matrix.data]),
+                fmt='%d')
+            for barcode in barcodes:
+                bc_fh.write('%s_%s\n' % (sample, barcode))
+            rows.append([sample, cells, int(depth), round(fraction, 4), matrix.nnz])
+            n_cells += len(barcodes)
+            nnz += matrix.nnz
+
+    with open(out_prefix + '.mtx', 'w') as fh:
+        fh.write('%%MatrixMarket matrix coordinate integer general\n%\n')
+        fh.write('%s %s %s\n' % (len(gene_index), n_cells, nnz))
+        with open(body.name) as body_fh:
+            shutil.copyfileobj(body_fh, fh)
+    os.remove(body.name)
+
+    with open(out_prefix + '_genes.tsv', 'w') as fh:
+        fh.write('geneID\n')
+        for gene in gene_index:
+            fh.write(gene + '\n')
+    pd.DataFrame(rows, columns=['Sample', 'cells', 'mean_reads_per_cell', 'read_fraction', 'nonzeros']).to_csv(
+        out_prefix + '_samples.tsv', sep='\t', index=False)
+
+    if h5:
+        from scipy.io import mmread
+        from h5matrix import write_h5
+        write_h5(out_prefix + '_matrix.h5', mmread(out_prefix + '.mtx'),
+            read_list(out_prefix + '_cellbarcode.tsv', 'Barcode'), list(gene_index))
+    logging.info('aggregate done!')
+    return (len(gene_index), n_cells), nnz
+
+
+def aggregate(args):
+    samples = [s for s in args.samples.split(',') if s]
+    out_prefix = args.outPrefix or os.path.join(args.workdir, 'aggr')
+    return aggregate_samples(samples, args.workdir, out_prefix, args.normalize, args.seed, args.h5)
+
+
+if __name__ == '__main__':
+    import argparse
+    from opts import get_opts_aggregate
+    parser = argparse.ArgumentParser('aggregate samples')
+    get_opts_aggregate(parser, True)
+    aggregate(parser.parse_args())
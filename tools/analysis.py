@@ -15,26 +15,22 @@ import pandas as pd
 from scipy.io import mmwrite
 from scipy.sparse import csr_matrix
 import pysam
+from annotation import load_annotation
+from report import update_fragment
+from opts import get_opts6
+from profiler import phase
 
 FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 logging.basicConfig(level = logging.INFO, format = FORMAT)
 toolsdir = os.path.realpath(sys.path[0] + '/../tools/')
 
 def report_prepare(outdir,tsne_df,marker_df):
-    json_file = outdir + '/../.data.json'
-    if not os.path.exists(json_file):
-        data = {}
-    else:
-        fh = open(json_file)
-        data = json.load(fh)
-        fh.close()
-
+    data = {}
     data["cluster_tsne"] = cluster_tsne_list(tsne_df)
     data["gene_tsne"] = gene_tsne_list(tsne_df)
     data["marker_gene_table"] = marker_table(marker_df)
 
-    with open(json_file, 'w') as fh:
-        json.dump(data, fh)
+    update_fragment(outdir + '/..', 'analysis', data)
 
 def cluster_tsne_list(tsne_df):
     """
@@ -46,8 +42,8 @@ def cluster_tsne_list(tsne_df):
     for cluster in sorted(tsne_df.cluster.unique()):
         sub_df = tsne_df[tsne_df.cluster==cluster]
         name = "cluster" + str(cluster)
-        tSNE_1 = list(sub_df.tSNE_1)
-        tSNE_2 = list(sub_df.tSNE_2)
+        tSNE_1 = sub_df.tSNE_1.tolist()
+        tSNE_2 = sub_df.tSNE_2.tolist()
         res.append({"name":name,"tSNE_1":tSNE_1,"tSNE_2":tSNE_2})
     return res
 
@@ -55,9 +51,9 @@ def gene_tsne_list(tsne_df):
     """
     return data dic
     """
-    tSNE_1 = list(tsne_df.tSNE_1)
-    tSNE_2 = list(tsne_df.tSNE_2)
-    Gene_Counts = list(tsne_df.Gene_Counts)
+    tSNE_1 = tsne_df.tSNE_1.tolist()
+    tSNE_2 = tsne_df.tSNE_2.tolist()
+    Gene_Counts = tsne_df.Gene_Counts.tolist()
     res = {"tSNE_1":tSNE_1,"tSNE_2":tSNE_2,"Gene_Counts":Gene_Counts}
     return res
 
@@ -70,34 +66,34 @@ def marker_table(marker_df):
     marker_gene_table = marker_df.to_html(escape=False,index=False,table_id="marker_gene_table",justify="center")
     return marker_gene_table
 
-def gene_convert(gtf_file,matrix_file):
-
-    gene_id_pattern = re.compile(r'gene_id "(\S+)";')
-    gene_name_pattern = re.compile(r'gene_name "(\S+)"')
-    id_name = {}
-    with open(gtf_file) as f:
-        for line in f.readlines():
-            if line.startswith('#!'):
-                continue
-            tabs = line.split('\t')
-            gtf_type, attributes = tabs[2], tabs[-1]
-            if gtf_type == 'gene':
-                gene_id = gene_id_pattern.findall(attributes)[-1]
-                gene_name = gene_name_pattern.findall(attributes)[-1]
-                id_name[gene_id] = gene_name
-
-    matrix = pd.read_csv(matrix_file,sep="\t")
-    def convert(gene_id):
-        if gene_id in id_name:
-            return id_name[gene_id]
-        else:
-            return np.nan
-    gene_name_col = matrix.geneID.apply(convert)
-    matrix.geneID = gene_name_col
-    matrix = matrix.rename({"geneID":"gene_name"}, axis='columns') 
-    matrix = matrix.drop_duplicates(subset=["gene_name"],keep="first")
-    matrix = matrix.dropna()
-    return matrix    
+def gene_convert(gtf_file, gene_ids):
+    """
+    names of gene_ids from the gene_id/gene_name arrays of the annotation
+    store, and the positions kept: ids missing from the annotation and
+    repeated names (all but the first) are dropped
+    """
+    annotation = load_annotation(gtf_file)
+    ids, names = annotation['gene_id'], annotation['gene_name']
+    gene_ids = np.asarray(gene_ids).astype(str)
+    order = np.argsort(ids)
+    pos = order[np.searchsorted(ids, gene_ids, sorter=order).clip(0, max(len(ids) - 1, 0))]
+    found = np.where(ids[pos] == gene_ids)[0] if len(ids) else np.array([], dtype=int)
+    first = np.unique(names[pos[found]], return_index=True)[1]
+    keep = found[np.sort(first)]
+    return names[pos[keep]], keep
+
+def matrix_prefix(matrix_file):
+    # {prefix}.mtx, {prefix}_genes.tsv and {prefix}_cellbarcode.tsv of count
+    return re.sub(r'_matrix\.xls$', '', matrix_file)
+
+def python_analysis(gtf_file, matrix_file, outdir, thread=1):
+    from sparse_analysis import read_matrix, run_analysis
+    X, gene_ids, barcodes = read_matrix(matrix_prefix(matrix_file))
+    names, keep = gene_convert(gtf_file, gene_ids)
+    X = X[:, keep]
+    # cells without counts of a named gene can not be normalized
+    cells = np.where(np.diff(X.indptr) > 0)[0]
+    run_analysis(X[cells], names, barcodes[cells], outdir, thread=thread)
 
 def analysis(args):
     logging.info('analysis ...!')
@@ -109,19 +105,31 @@ def analysis(args):
     if not os.path.exists(outdir):
         os.system('mkdir -p %s'%(outdir))
     
-    # run
-    logging.info("convert expression matrix.")
-    new_matrix = gene_convert(gtf_file,matrix_file)  
-    new_matrix_file = "{outdir}/{sample}_matrix.tsv".format(outdir=outdir,sample=sample)
-    new_matrix.to_csv(new_matrix_file,sep="\t",index=False)
-    logging.info("expression matrix written.")
-
-    # run_R
-    logging.info("Seurat running")
-    cmd = "Rscript {app} --sample {sample} --outdir {outdir} --matrix_file {new_matrix_file}".format(
-        app=toolsdir+"/run_analysis.R",sample = sample, outdir=outdir,new_matrix_file=new_matrix_file)
-    os.system(cmd)
-    logging.info("Seurat done.")
+    if args.backend == 'python':
+        logging.info("sparse analysis running")
+        with phase('sparse_analysis'):
+            python_analysis(gtf_file, matrix_file, outdir, thread=args.thread)
+        logging.info("sparse analysis done.")
+    else:
+        # rows of the count mtx kept and their names, the matrix itself is left as is
+        logging.info("convert gene names.")
+        from sparse_analysis import read_list
+        prefix = matrix_prefix(matrix_file)
+        with phase('gene_convert'):
+            names, keep = gene_convert(gtf_file, read_list(prefix + '_genes.tsv', 'geneID'))
+            genes_file = "{outdir}/{sample}_genes.tsv".format(outdir=outdir,sample=sample)
+            pd.DataFrame({'row': keep + 1, 'gene_name': names}, columns=['row', 'gene_name']).to_csv(
+                genes_file, sep="\t", index=False)
+        logging.info("gene names written.")
+
+        # run_R
+        logging.info("Seurat running")
+        cmd = ("Rscript {app} --sample {sample} --outdir {outdir} --mtx {prefix}.mtx --genes {genes_file} "
+            "--barcodes {prefix}_cellbarcode.tsv").format(
+            app=toolsdir+"/run_analysis.R",sample = sample, outdir=outdir,prefix=prefix,genes_file=genes_file)
+        with phase('Seurat'):
+            os.system(cmd)
+        logging.info("Seurat done.")
 
     # report
     tsne_df_file = "{outdir}/tsne_coord.tsv".format(outdir=outdir)
@@ -132,20 +140,12 @@ def analysis(args):
 
     logging.info('generate report ...!')
     from report import reporter
-    t = reporter(name='analysis', outdir=args.outdir + '/..')
+    t = reporter(name='analysis', outdir=args.outdir + '/..', render=True)
     t.get_report()
     logging.info('generate report done!')
     
 
 
-def get_opts6(parser, sub_program):
-    if sub_program:
-        parser.add_argument('--outdir', help='output dir', required=True)
-        parser.add_argument('--sample', help='sample name', required=True)
-        parser.add_argument('--matrix_file', help='matrix file',required=True)
-        parser.add_argument('--annot', help='gtf',required=True)
-
-
 if __name__ == "__main__":
     tsne_df = pd.read_csv("/SGRNJ01/RD_dir/pipeline_test/zhouyiqi/scope_tools_1.0/out/06.analysis/tsne_coord.tsv",sep="\t")
     marker_df = pd.read_csv("/SGRNJ01/RD_dir/pipeline_test/zhouyiqi/scope_tools_1.0/out/06.analysis/markers.tsv",sep="\t")
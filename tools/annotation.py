@@ -0,0 +1,380 @@
+#!/bin/env python
+#coding=utf8
+
+import os, re, json, glob, hashlib
+import logging
+import shutil
+import tempfile
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+import numpy as np
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(level = logging.INFO, format = FORMAT)
+
+STORE_VERSION = 1
+
+
+class IntervalIndex:
+    """
+    sorted-array interval index, per chromosome and per length class.
+
+    intervals are 0-based half-open [start, end). intervals of one chromosome
+    are split by length into classes of lengths within a factor of 8, each
+    with its own sorted starts. in a class whose longest interval is max_len,
+    only intervals starting in (start - max_len, end) can overlap a query, so
+    a query walks back over those alone: a long gene or readthrough
+    transcript only costs a walk in its own, small, class.
+    """
+    def __init__(self):
+        self._intervals = defaultdict(list)
+        self._classes = {}
+
+    def add(self, chrom, start, end, value):
+        self._intervals[chrom].append((start, end, value))
+
+    @staticmethod
+    def _length_classes(starts, ends, values):
+        # [(starts, ends, values, max_len)] of intervals sorted by start
+        lengths = np.maximum(ends - starts, 1)
+        length_class = np.floor(np.log2(lengths) / 3).astype(int)
+        classes = []
+        for c in np.unique(length_class):
+            keep = np.nonzero(length_class == c)[0]
+            classes.append((starts[keep].tolist(), ends[keep].tolist(), [values[k] for k in keep],
+                int(lengths[keep].max())))
+        return classes
+
+    def build(self):
+        for chrom, intervals in self._intervals.items():
+            intervals.sort(key=lambda x: (x[0], x[1]))
+            starts = np.array([x[0] for x in intervals], dtype=np.int64)
+            ends = np.array([x[1] for x in intervals], dtype=np.int64)
+            self._classes[chrom] = self._length_classes(starts, ends, [x[2] for x in intervals])
+        self._intervals = defaultdict(list)
+        return self
+
+    @classmethod
+    def from_arrays(cls, chrom, starts, ends, values):
+        # arrays of one chromosome each, already sorted by start
+        index = cls()
+        index._classes[chrom] = cls._length_classes(np.asarray(starts), np.asarray(ends), list(values))
+        return index
+
+    def update(self, other):
+        self._classes.update(other._classes)
+
+    def query(self, chrom, start, end):
+        # return values of intervals overlapping [start, end)
+        res = set()
+        for starts, ends, values, max_len in self._classes.get(chrom, []):
+            i = bisect_left(starts, end) - 1
+            first = start - max_len
+            while i >= 0 and starts[i] > first:
+                if ends[i] > start:
+                    res.add(values[i])
+                i -= 1
+        return res
+
+
+def _cache_dir(path):
+    # next to the source file, or in ~/.cache/celescope if the reference directory is read-only
+    ref_dir = os.path.dirname(os.path.abspath(path))
+    if os.access(ref_dir, os.W_OK):
+        return ref_dir
+    return os.path.expanduser('~/.cache/celescope')
+
+
+def file_hash(path, chunk=1 << 20):
+    """
+    md5 of the content of the file, read once and kept in {basename}.md5.json
+    with the size and nanosecond mtime it was read at.
+
+    the key depends on the content only, so every node and every copy of a
+    gtf finds the same store, and an edit of any byte is seen. reading a gtf
+    of a few GB takes some seconds, paid again only when its size or mtime
+    changes
+    """
+    st = os.stat(path)
+    stamp = {'path': os.path.abspath(path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    sidecar = os.path.join(_cache_dir(path), os.path.basename(path) + '.md5.json')
+    try:
+        with open(sidecar) as fh:
+            cached = json.load(fh)
+        if all(cached.get(k) == v for k, v in stamp.items()):
+            return cached['md5']
+    except (IOError, OSError, ValueError):
+        pass
+
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(chunk), b''):
+            md5.update(block)
+    stamp['md5'] = md5.hexdigest()
+    try:
+        parent = os.path.dirname(sidecar)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        tmp = tempfile.NamedTemporaryFile('w', dir=parent, prefix='.tmp.', delete=False)
+        with tmp:
+            json.dump(stamp, tmp)
+        os.rename(tmp.name, sidecar)
+    except (IOError, OSError):
+        logging.warning('can not cache the md5 of %s in %s' % (path, sidecar))
+    return stamp['md5']
+
+
+def store_dir(path):
+    """
+    compiled store of the version and content of path, in _cache_dir
+    """
+    key = hashlib.md5(('%s\t%s' % (STORE_VERSION, file_hash(path))).encode()).hexdigest()
+    return os.path.join(_cache_dir(path), '%s.%s.store' % (os.path.basename(path), key))
+
+
+def remove_stale_stores(path, store):
+    # stores of earlier versions or contents of path
+    source = os.path.abspath(path)
+    for stale in glob.glob(os.path.join(os.path.dirname(store), glob.escape(os.path.basename(path)) + '.*.store')):
+        if stale == store:
+            continue
+        try:
+            with open(os.path.join(stale, 'meta.json')) as fh:
+                if json.load(fh).get('source') != source:
+                    continue
+        except (IOError, OSError, ValueError):
+            continue
+        logging.info('remove stale annotation store %s' % (stale))
+        shutil.rmtree(stale, ignore_errors=True)
+
+
+def write_store(outdir, arrays, meta):
+    # write to a temp dir then rename, so concurrent samples never see half a store
+    parent = os.path.dirname(outdir)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    tmpdir = tempfile.mkdtemp(dir=parent, prefix='.tmp.')
+    for k, v in arrays.items():
+        np.save(os.path.join(tmpdir, k + '.npy'), v)
+    with open(os.path.join(tmpdir, 'meta.json'), 'w') as fh:
+        json.dump(meta, fh)
+    try:
+        os.rename(tmpdir, outdir)
+    except OSError:
+        # compiled by another process in the meantime
+        shutil.rmtree(tmpdir)
+
+
+def compile_gtf(gtf_file, outdir):
+    """
+    gene table, gene_id->gene_name and all feature intervals of a GTF,
+    sorted by (chrom, start) and saved as .npy arrays
+    """
+    gene_id_pattern = re.compile(r'gene_id "(\S+)";')
+    gene_name_pattern = re.compile(r'gene_name "(\S+)"')
+    gene_idx, gene_ids, gene_names = {}, [], []
+    chrom_idx, type_idx = {}, {}
+    chroms, starts, ends, genes, types = [], [], [], [], []
+    with open(gtf_file) as fh:
+        for line in fh:
+            if line.startswith('#'):
+                continue
+            tabs = line.split('\t')
+            if len(tabs) < 9:
+                continue
+            attributes = tabs[8]
+            gene_id = gene_id_pattern.findall(attributes)
+            if not gene_id:
+                continue
+            gene_id = gene_id[-1]
+            if gene_id not in gene_idx:
+                gene_idx[gene_id] = len(gene_ids)
+                gene_ids.append(gene_id)
+                gene_names.append(None)
+            g = gene_idx[gene_id]
+            if gene_names[g] is None or tabs[2] == 'gene':
+                gene_name = gene_name_pattern.findall(attributes)
+                if gene_name:
+                    gene_names[g] = gene_name[-1]
+            chroms.append(chrom_idx.setdefault(tabs[0], len(chrom_idx)))
+            types.append(type_idx.setdefault(tabs[2], len(type_idx)))
+            starts.append(int(tabs[3]) - 1)
+            ends.append(int(tabs[4]))
+            genes.append(g)
+
+    chroms = np.array(chroms, dtype=np.int32)
+    starts = np.array(starts, dtype=np.int64)
+    order = np.lexsort((starts, chroms))
+    arrays = {
+        'gene_id': np.array(gene_ids, dtype=str),
+        'gene_name': np.array([n if n is not None else i for i, n in zip(gene_ids, gene_names)], dtype=str),
+        'chrom': chroms[order],
+        'start': starts[order],
+        'end': np.array(ends, dtype=np.int64)[order],
+        'gene': np.array(genes, dtype=np.int32)[order],
+        'type': np.array(types, dtype=np.int16)[order],
+    }
+    meta = {
+        'version': STORE_VERSION,
+        'source': os.path.abspath(gtf_file),
+        'chroms': sorted(chrom_idx, key=chrom_idx.get),
+        'types': sorted(type_idx, key=type_idx.get),
+    }
+    write_store(outdir, arrays, meta)
+
+
+class Annotation:
+    """
+    lazy, memory-mapped view of a compiled GTF store
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as fh:
+            self.meta = json.load(fh)
+        self._arrays = {}
+
+    def __getitem__(self, key):
+        if key not in self._arrays:
+            self._arrays[key] = np.load(os.path.join(self.path, key + '.npy'), mmap_mode='r')
+        return self._arrays[key]
+
+    @property
+    def id_name(self):
+        return dict(zip(self['gene_id'].tolist(), self['gene_name'].tolist()))
+
+    def feature_index(self, feature_type='exon'):
+        index = IntervalIndex()
+        if feature_type not in self.meta['types']:
+            logging.warning('feature type %s not found in %s' % (feature_type, self.meta['source']))
+            return index
+        mask = np.asarray(self['type']) == self.meta['types'].index(feature_type)
+        chrom = np.asarray(self['chrom'])[mask]
+        start = np.asarray(self['start'])[mask]
+        end = np.asarray(self['end'])[mask]
+        gene = np.asarray(self['gene'])[mask]
+        gene_id = self['gene_id']
+        bounds = np.flatnonzero(np.diff(chrom)) + 1
+        for s, e in zip(np.r_[0, bounds], np.r_[bounds, len(chrom)]):
+            if s == e:
+                continue
+            values = gene_id[gene[s:e]].tolist()
+            index.update(IntervalIndex.from_arrays(
+                self.meta['chroms'][chrom[s]], start[s:e], end[s:e], values))
+        return index
+
+
+def load_store(path, compile_func):
+    store = store_dir(path)
+    if not os.path.exists(store):
+        logging.info('compile annotation %s ...!' % (path))
+        compile_func(path, store)
+        logging.info('compile annotation done!')
+        remove_stale_stores(path, store)
+    return store
+
+
+def load_annotation(gtf_file):
+    """
+    return Annotation of gtf_file, compiling it on first use
+    """
+    return Annotation(load_store(gtf_file, compile_gtf))
+
+
+def merge_intervals(intervals):
+    # sorted, disjoint union of [start, end) intervals
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+REGION_KINDS = ['exon', 'coding', 'gene']
+
+def compile_refflat(refflat_file, outdir):
+    """
+    merged exon, coding and gene-span intervals of a refFlat, per chromosome
+    """
+    regions = {kind: defaultdict(list) for kind in REGION_KINDS}
+    with open(refflat_file) as fh:
+        for line in fh:
+            tabs = line.rstrip('\n').split('\t')
+            if len(tabs) < 11:
+                continue
+            chrom = tabs[2]
+            tx_start, tx_end, cds_start, cds_end = [int(i) for i in tabs[4:8]]
+            regions['gene'][chrom].append((tx_start, tx_end))
+            exon_starts = [int(i) for i in tabs[9].strip(',').split(',')]
+            exon_ends = [int(i) for i in tabs[10].strip(',').split(',')]
+            for start, end in zip(exon_starts, exon_ends):
+                regions['exon'][chrom].append((start, end))
+                start, end = max(start, cds_start), min(end, cds_end)
+                if start < end:
+                    regions['coding'][chrom].append((start, end))
+
+    chroms = sorted(regions['gene'])
+    arrays = {}
+    for kind in REGION_KINDS:
+        chrom_arr, start_arr, end_arr = [], [], []
+        for i, chrom in enumerate(chroms):
+            for start, end in merge_intervals(regions[kind][chrom]):
+                chrom_arr.append(i)
+                start_arr.append(start)
+                end_arr.append(end)
+        arrays[kind + '_chrom'] = np.array(chrom_arr, dtype=np.int32)
+        arrays[kind + '_start'] = np.array(start_arr, dtype=np.int64)
+        arrays[kind + '_end'] = np.array(end_arr, dtype=np.int64)
+    meta = {
+        'version': STORE_VERSION,
+        'source': os.path.abspath(refflat_file),
+        'chroms': chroms,
+    }
+    write_store(outdir, arrays, meta)
+
+
+class RegionIndex:
+    """
+    per chromosome disjoint exon/coding/gene-span intervals of a compiled refFlat
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as fh:
+            meta = json.load(fh)
+        self.regions = {}
+        for kind in REGION_KINDS:
+            chrom = np.load(os.path.join(path, kind + '_chrom.npy'))
+            start = np.load(os.path.join(path, kind + '_start.npy'))
+            end = np.load(os.path.join(path, kind + '_end.npy'))
+            bounds = np.flatnonzero(np.diff(chrom)) + 1
+            self.regions[kind] = {}
+            for s, e in zip(np.r_[0, bounds], np.r_[bounds, len(chrom)]):
+                if s == e:
+                    continue
+                self.regions[kind][meta['chroms'][chrom[s]]] = (start[s:e].tolist(), end[s:e].tolist())
+
+    def overlap(self, kind, chrom, start, end):
+        # number of bases of [start, end) covered by kind
+        if chrom not in self.regions[kind]:
+            return 0
+        starts, ends = self.regions[kind][chrom]
+        n = 0
+        i = bisect_right(ends, start)
+        while i < len(starts) and starts[i] < end:
+            n += min(end, ends[i]) - max(start, starts[i])
+            i += 1
+        return n
+
+
+def load_regions(refflat_file):
+    return RegionIndex(load_store(refflat_file, compile_refflat))
+
+
+def build_feature_index(gtf_file, feature_type='exon'):
+    return load_annotation(gtf_file).feature_index(feature_type)
+
+
+def annotation(args):
+    logging.info('annotation store: %s' % (load_annotation(args.annot).path))
+
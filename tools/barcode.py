@@ -1,16 +1,23 @@
 #!/bin/env python
 # coding=utf8
-import os, re, io, gzip
+import os, re, io, gzip, sys
 import subprocess
 from collections import defaultdict, Counter
+from multiprocessing import Pool
+from argparse import Namespace
 from itertools import combinations, permutations, islice
 from utils import getlogger
 from report import reporter
 from xopen import xopen
-from utils import format_number
+from decompress import open_input, DEFAULT_THREADS
+from utils import format_number, lane_files
+from opts import get_opts1
+from chemistry import get_plan
+from profiler import phase
+from progress import get_progress
+from sketch import SpaceSaving, knee_rank
 
 logger1, logger2 = getlogger()	
-barcode_corrected_num = 0
 
 # 定义输出格式
 stat_info = '''
@@ -23,93 +30,6 @@ stat_info = '''
 def ord2chr(q, offset=33):
     return chr(int(q) + offset) 
 
-# 生成错配字典
-def generate_mis_seq(seq, n=1, bases = 'ACGTN'):
-    # 以随机bases中的碱基替换seq中的n个位置，产生的错配字典
-    # 返回字典，错配序列为key，
-    # (正确序列，错配碱基数目，错配碱基位置，原始碱基，新碱基)组成的元组
-    # 作为字典的值
-
-    length = len(seq)
-    assert length >= n, "err number should not be larger than sequence length!"
-    res = {}
-    seq_arr = list(seq)
-    pos_group = list(combinations(range(0,length), n))
-    bases_group = list(permutations(bases, n))
-
-    for g in pos_group:
-        for b in bases_group:
-            seq_tmp = seq_arr[:]
-            mis_num = n
-            raw_tmp = []
-            for i in range(n):
-                raw_base = seq_tmp[g[i]]
-                new_base = b[i]
-
-                if raw_base == new_base:
-                    mis_num -= 1
-
-                raw_tmp.append(raw_base)
-                seq_tmp[g[i]] = new_base
-
-            if mis_num!=0:
-                res[''.join(seq_tmp)] = (seq, mis_num, ','.join([str(i) for i in g]), ','.join(raw_tmp), ','.join(b))
-    return(res)
-
-def generate_seq_dict(seqlist, n=1):
-    seq_dict = {}
-    with open(seqlist, 'r') as fh:
-        for seq in fh:
-            seq = seq.strip()
-            if seq == '':
-                continue
-            seq_dict[seq] = (seq, 0, -1, 'X', 'X')
-            for k, v in generate_mis_seq(seq, n).items():
-                # duplicate key
-                if k in seq_dict:
-                    logger2.warning('barcode %s, %s\n%s, %s' % (v, k, seq_dict[k], k))
-                else:
-                    seq_dict[k] = v
-    return seq_dict
-
-def parse_bc_type(bctype):
-    # assign pattern based on bc type: scope, dropseq
-    if bctype == 'scope':
-        # place holder, may change, depending on the beads development progress
-        bc_pattern = 'C8L16C8L16C8L1U8T18'
-    elif bctype == 'dropseq':
-        bc_pattern = 'C12U8T30'
-    elif bctype == 'test':
-        bc_pattern = 'C6L15C6L15C6U6T25'
-    else:
-        bc_pattern = None
-    return bc_pattern
-
-def parse_pattern(pattern):
-    # 解析接头结构，返回接头结构字典
-    # key: 字母表示的接头, value: 碱基区间列表
-    # eg.: C8L10C8L10C8U8T30
-    # defaultdict(<type 'list'>:
-    # {'C': [[0, 8], [18, 26], [36, 44]], 'U': [[44, 52]], 'L': [[8, 18], [26, 36]], 'T': [[52, 82]]})
-    pattern_dict = defaultdict(list)
-    p = re.compile(r'([CLUNT])(\d+)')
-    tmp = p.findall(pattern)
-    if not tmp:
-        logger2.error('Can not recognise pattern! %s' % pattern)
-    start = 0
-    for item in tmp:
-        end = start + int(item[1])
-        pattern_dict[item[0]].append([start, end])
-        start = end
-    return pattern_dict
-
-
-def get_scope_bc():
-    code_path = os.path.dirname(os.path.abspath(__file__))
-    linker_f = os.path.join(os.path.dirname(code_path), 'data/1.0/linker_withC')
-    whitelist_f = os.path.join(os.path.dirname(code_path), 'data/1.0/bclist')
-    return linker_f, whitelist_f
-
 def read_fastq(f):
     """
     Return tuples: (name, sequence, qualities).
@@ -149,75 +69,103 @@ def no_polyT(seq, strictT=0, minT=10):
     else:
         return False
 
-def no_barcode(seq_arr, mis_dict, err_tolerance=1):
-    global barcode_corrected_num
-    tmp = [ mis_dict[seq][0:2] if seq in mis_dict else ('X', 100) for seq in seq_arr ]
-    err = sum([t[1] for t in tmp])
-    if err > err_tolerance:
-        return True
-    else:
-        if err >0:
-            barcode_corrected_num += 1
-        return ''.join([t[0] for t in tmp])
-
-def no_linker(seq, linker_dict):
-    return False if seq in linker_dict else True
+def count_raw_barcodes(params):
+    """
+    first pass of whitelist-free mode: sketch of raw barcode counts of reads
+    passing the polyT and low quality filters, read1 only
+    """
+    (fq1, plan, lowQual, lowNum, sketch_size, threads) = params
+    sketch = SpaceSaving(sketch_size)
+    with open_input(fq1, threads) as fh1:
+        for (header1, seq1, qual1) in read_fastq(fh1):
+            if plan.bool_T and no_polyT(plan.polyT(seq1)):
+                continue
+            if low_qual(plan.quals(qual1), lowQual, lowNum):
+                continue
+            sketch[''.join(plan.barcodes(seq1))] += 1
+    return sketch
 
 
-def barcode(args):
-    logger1.info('extract barcode ...!')
+def discover_barcodes(fq1_list, plan, args, whitelist_file):
+    """
+    barcodes up to the knee of the sketched rank curve, written to whitelist_file
+    """
+    threads = getattr(args, 'decompressThreads', DEFAULT_THREADS)
+    params = [(fq1, plan, args.lowQual, args.lowNum, args.sketchSize, threads) for fq1 in fq1_list]
+    if len(params) == 1:
+        sketch = count_raw_barcodes(params[0])
+    else:
+        pool = Pool(min(len(params), int(args.thread)))
+        sketches = pool.map(count_raw_barcodes, params)
+        pool.close()
+        pool.join()
+        sketch = sketches[0]
+        for other in sketches[1:]:
+            sketch.update(other)
+    ranked = sketch.most_common()
+    n = knee_rank([c for _, c in ranked])
+    with open(whitelist_file, 'w') as fh:
+        for cb, _ in ranked[:n]:
+            fh.write(cb + '\n')
+    logger1.info('%s barcodes above the knee of %s sketched, sketch error %s reads' % (n, len(ranked), sketch.floor))
+    return [cb for cb, _ in ranked[:n]]
+
+
+def barcode_corrections(barcodes, bases='ACGTN'):
+    """
+    {barcode: barcode} plus each unambiguous 1-mismatch neighbor mapped onto its barcode
+    """
+    corrections = dict((cb, cb) for cb in barcodes)
+    ambiguous = set()
+    for cb in barcodes:
+        for i in range(len(cb)):
+            for b in bases:
+                if b == cb[i]:
+                    continue
+                seq = cb[:i] + b + cb[i + 1:]
+                if seq in ambiguous or corrections.get(seq) == seq:
+                    continue
+                if seq in corrections:
+                    ambiguous.add(seq)
+                    del corrections[seq]
+                else:
+                    corrections[seq] = cb
+    return corrections
 
-    # check dir
-    if not os.path.exists(args.outdir):
-        os.system('mkdir -p %s' % args.outdir)
 
-    if (args.bcType):
-        bc_pattern = parse_bc_type(args.bcType)
-    else:
-        bc_pattern = args.pattern
-    # parse pattern to dict, C8L10C8L10C8U8
-    # defaultdict(<type 'list'>, {'C': [[0, 8], [18, 26], [36, 44]], 'U': [[44, 52]], 'L': [[8, 18], [26, 36]]})
-    pattern_dict = parse_pattern(bc_pattern)
-    #pattern_dict = parse_pattern(args.pattern)
-    bool_T = True if 'T' in pattern_dict else False
-    bool_L = True if 'L' in pattern_dict else False
+def extract_barcode(args, plan, out_fq2, lane='', corrections=None):
+    """
+    read fq1/fq2 pairs, filter on polyT, low quality, linker and barcode,
+    and write valid read2 with @barcode_umi_readID headers to out_fq2.
+    without linker, corrections maps raw barcodes onto the discovered ones
+    """
+    C_len = plan.C_len
 
-    C_len = sum([item[1]-item[0] for item in pattern_dict['C']])
+    threads = getattr(args, 'decompressThreads', DEFAULT_THREADS)
+    fh1 = open_input(args.fq1, threads)
+    fh2 = open_input(args.fq2, threads)
+    fh3 = xopen(out_fq2, 'w')
 
     barcode_qual_Counter = Counter()
     umi_qual_Counter = Counter()
     C_U_base_Counter = Counter()
-    args.lowQual = ord2chr(args.lowQual)
-
-    # generate list with mismatch 1, substitute one base in raw sequence with A,T,C,G
-    if (args.bcType=="scope"):
-        (linker, whitelist) = get_scope_bc()
-    elif (args.linker and args.whitelist):
-        linker = args.linker
-        whitelist = args.whitelist
-    else:
-        sys.exit("invalid bcType or [linker,whitelist]")
-
-    
-    barcode_dict = generate_seq_dict(whitelist, n=1)
-    linker_dict = generate_seq_dict(linker, n=2)
-
-
-    fh1 = xopen(args.fq1)
-    fh2 = xopen(args.fq2)
-    out_fq2 = args.outdir + '/' + args.sample + '_2.fq.gz'
-    fh3 = xopen(out_fq2, 'w')
-
     (total_num, clean_num,  no_polyT_num, lowQual_num, no_linker_num, no_barcode_num) = (0, 0, 0, 0, 0, 0)
-    Barcode_dict = defaultdict(int)
+    barcode_corrected_num = 0
+    (barcode_matcher, linker_matcher) = (plan.barcode_matcher, plan.linker_matcher)
+    # whitelist-free barcodes are unbounded, keep their counts in a sketch
+    Barcode_dict = defaultdict(int) if corrections is None else SpaceSaving(args.sketchSize)
 
     if args.nopolyT:
-        fh1_without_polyT = xopen(args.outdir + '/noPolyT_1.fq', 'w')
-        fh2_without_polyT = xopen(args.outdir + '/noPolyT_2.fq', 'w')
+        fh1_without_polyT = xopen(args.outdir + '/noPolyT%s_1.fq' % (lane), 'w')
+        fh2_without_polyT = xopen(args.outdir + '/noPolyT%s_2.fq' % (lane), 'w')
 
     if args.noLinker:
-        fh1_without_linker = xopen(args.outdir + '/noLinker_1.fq', 'w')
-        fh2_without_linker = xopen(args.outdir + '/noLinker_2.fq', 'w')
+        fh1_without_linker = xopen(args.outdir + '/noLinker%s_1.fq' % (lane), 'w')
+        fh2_without_linker = xopen(args.outdir + '/noLinker%s_2.fq' % (lane), 'w')
+
+    progress = get_progress('barcode' + lane, [args.fq1, args.fq2], args)
+    pass_counts = lambda: {'valid': clean_num, 'no_polyT': no_polyT_num, 'lowQual': lowQual_num,
+        'no_linker': no_linker_num, 'no_barcode': no_barcode_num}
 
     g1 = read_fastq(fh1)
     g2 = read_fastq(fh2)
@@ -225,17 +173,18 @@ def barcode(args):
         try:
             (header1, seq1, qual1) = next(g1)
             (header2, seq2, qual2) = next(g2)
-        except:
+        except StopIteration:
             break
         
         total_num += 1
+        if progress and total_num % 10000 == 0:
+            progress.report(total_num, pass_counts())
         #if total_num > 10000: total_num-= 1; break
 
 
         # polyT filter
-        if bool_T:
-            polyT = seq_ranges(seq1, pattern_dict['T'])
-            if no_polyT(polyT):
+        if plan.bool_T:
+            if no_polyT(plan.polyT(seq1)):
                 no_polyT_num += 1
                 if args.nopolyT:
                     fh1_without_polyT.write('%s%s+\n%s'%(header1, seq1, qual1))
@@ -243,18 +192,15 @@ def barcode(args):
                 continue
 
         # lowQual filter
-        C_U_quals_ascii = seq_ranges(qual1, pattern_dict['C'] + pattern_dict['U'])
+        C_U_quals_ascii = plan.quals(qual1)
         # C_U_quals_ord = [ord(q) - 33 for q in C_U_quals_ascii]
         if low_qual(C_U_quals_ascii, args.lowQual, args.lowNum):
             lowQual_num += 1
             continue
 
-        # linker filter
-        barcode_arr = [seq_ranges(seq1, [i]) for i in pattern_dict['C']]
-        raw_cb = ''.join(barcode_arr)
-        if bool_L:
-            linker = seq_ranges(seq1, pattern_dict['L'])
-            if (no_linker(linker, linker_dict)):
+        # linker filter, each segment against its own linker list
+        if linker_matcher:
+            if linker_matcher.match(seq1) is None:
                 no_linker_num += 1
                 
                 if args.noLinker:
@@ -262,19 +208,22 @@ def barcode(args):
                     fh2_without_linker.write('%s%s+\n%s'%(header2, seq2, qual2))
                 continue
 
-        # barcode filter
-            # barcode_arr = [seq_ranges(seq1, [i]) for i in pattern_dict['C']]
-            # raw_cb = ''.join(barcode_arr)
-            res = no_barcode(barcode_arr, barcode_dict)
-            if res is True:
+        # barcode filter, each segment against its own whitelist
+        raw_cb = ''.join(plan.barcodes(seq1))
+        if barcode_matcher:
+            res = barcode_matcher.match(seq1)
+            if res is None:
                 no_barcode_num += 1
                 continue
-            else:
-                cb = res
+            (cb, err) = res
+            if err:
+                barcode_corrected_num += 1
+        elif corrections is not None:
+            cb = corrections.get(raw_cb, raw_cb)
         else:
             cb = raw_cb
 
-        umi = seq_ranges(seq1, pattern_dict['U'])
+        umi = plan.umi(seq1)
         Barcode_dict[cb] += 1
         # new readID: @barcode_umi_old readID
         fh3.write('@{cellbarcode}_{umi}_{readID}\n{seq}\n+\n{qual}\n'.format(
@@ -287,7 +236,105 @@ def barcode(args):
         umi_qual_Counter.update(C_U_quals_ascii[C_len:])
         C_U_base_Counter.update(raw_cb + umi)
 
+    fh1.close()
+    fh2.close()
     fh3.close()
+    if progress:
+        progress.done(total_num, pass_counts())
+
+    return {
+        'total_num': total_num, 'clean_num': clean_num, 'no_polyT_num': no_polyT_num,
+        'lowQual_num': lowQual_num, 'no_linker_num': no_linker_num, 'no_barcode_num': no_barcode_num,
+        'barcode_corrected_num': barcode_corrected_num,
+        'Barcode_dict': Barcode_dict, 'barcode_qual_Counter': barcode_qual_Counter,
+        'umi_qual_Counter': umi_qual_Counter, 'C_U_base_Counter': C_U_base_Counter,
+    }
+
+
+def _extract_lane(params):
+    return extract_barcode(*params)
+
+
+def merge_lanes(lane_res):
+    """
+    sum the counts and counters of extract_barcode over lanes
+    """
+    res = {}
+    for k in lane_res[0]:
+        if isinstance(lane_res[0][k], int):
+            res[k] = sum(r[k] for r in lane_res)
+        elif isinstance(lane_res[0][k], SpaceSaving):
+            # whitelist-free lanes, the merged sketch stays bounded
+            res[k] = lane_res[0][k]
+            for r in lane_res[1:]:
+                res[k].update(r[k])
+        elif k == 'Barcode_dict':
+            res[k] = defaultdict(int)
+            for r in lane_res:
+                for cb, n in r[k].items():
+                    res[k][cb] += n
+        else:
+            res[k] = Counter()
+            for r in lane_res:
+                res[k].update(r[k])
+    return res
+
+
+def barcode(args):
+    logger1.info('extract barcode ...!')
+
+    # check dir
+    if not os.path.exists(args.outdir):
+        os.system('mkdir -p %s' % args.outdir)
+
+    # read1 layout, whitelist and linker indexes of the chemistry, built once
+    # e.g. C8L10C8L10C8U8: {'C': [[0, 8], [18, 26], [36, 44]], 'U': [[44, 52]], 'L': [[8, 18], [26, 36]]}
+    plan = get_plan(args)
+
+    args.lowQual = ord2chr(args.lowQual)
+
+    # lanes of one sample are comma separated, each lane is extracted to its own fq
+    # in parallel and the lane fqs go to STAR as a list
+    fq1_list = args.fq1.split(',')
+    fq2_list = args.fq2.split(',')
+    if len(fq1_list) != len(fq2_list):
+        sys.exit("fq1 and fq2 have different lane numbers")
+
+    corrections = None
+    if plan.bool_L and not (plan.barcode_matcher and plan.linker_matcher):
+        sys.exit("invalid bcType or [linker,whitelist]")
+    elif not plan.bool_L and not plan.barcode_matcher:
+        # whitelist-free: sketch raw barcodes, keep those up to the knee and
+        # correct their 1-mismatch neighbors in the extraction pass
+        logger1.info('discover barcodes ...!')
+        with phase('discover_barcodes'):
+            barcodes = discover_barcodes(fq1_list, plan, args,
+                args.outdir + '/' + args.sample + '_discovered_barcodes.txt')
+            corrections = barcode_corrections(barcodes)
+        logger1.info('discover barcodes done!')
+
+    out_fq2_list = lane_files(args.outdir + '/' + args.sample, '_2.fq.gz', len(fq1_list))
+    with phase('extract_barcode'):
+        if len(fq1_list) == 1:
+            res = extract_barcode(args, plan, out_fq2_list[0],
+                corrections=corrections)
+        else:
+            params = []
+            for i, (fq1, fq2, out_fq2) in enumerate(zip(fq1_list, fq2_list, out_fq2_list)):
+                # lanes log their own progress, the status file is left to single lane runs
+                lane_args = Namespace(fq1=fq1, fq2=fq2, outdir=args.outdir, lowQual=args.lowQual,
+                    lowNum=args.lowNum, nopolyT=args.nopolyT, noLinker=args.noLinker,
+                    progressInterval=args.progressInterval, statusFile=None, sketchSize=args.sketchSize,
+                    decompressThreads=getattr(args, 'decompressThreads', DEFAULT_THREADS))
+                params.append((lane_args, plan, out_fq2, '_L%s' % (i + 1),
+                    corrections))
+            pool = Pool(min(len(params), int(args.thread)))
+            lane_res = pool.map(_extract_lane, params)
+            pool.close()
+            pool.join()
+            res = merge_lanes(lane_res)
+    total_num, clean_num = res['total_num'], res['clean_num']
+    barcode_qual_Counter, umi_qual_Counter = res['barcode_qual_Counter'], res['umi_qual_Counter']
 
     # stat
     #print(barcode_qual_Counter)
@@ -310,12 +357,14 @@ def barcode(args):
             UMIsQ30)
         stat_info = re.sub(r'^\s+', r'', stat_info, flags=re.M)
         fh.write(stat_info)
+    logger1.info('%s valid reads with a corrected barcode' % (format_number(res['barcode_corrected_num'])))
     logger1.info('extract barcode done!')
     
     logger1.info('fastqc ...!')
-    cmd = ['fastqc', '-t', str(args.thread), '-o', args.outdir, out_fq2]
+    cmd = ['fastqc', '-t', str(args.thread), '-o', args.outdir] + out_fq2_list
     logger1.info('%s' % (' '.join(cmd)))
-    subprocess.check_call(cmd)
+    with phase('fastqc'):
+        subprocess.check_call(cmd)
     logger1.info('fastqc done!')
     
     logger1.info('generate report ...!')
@@ -324,20 +373,3 @@ def barcode(args):
     logger1.info('generate report done!')
 
 
-
-def get_opts1(parser,sub_program):
-    parser.add_argument('--outdir', help='output dir',required=True)
-    parser.add_argument('--sample', help='sample name', required=True)
-    parser.add_argument('--fq1', help='read1 fq file', required=True)
-    parser.add_argument('--fq2', help='read2 fq file', required=True)
-    parser.add_argument('--bcType', help='choice of barcode types. Currently support scope and Drop-seq barcode designs')
-    parser.add_argument('--pattern', help='')
-    parser.add_argument('--whitelist', help='')
-    parser.add_argument('--linker', help='')
-    parser.add_argument('--lowQual', type=int, help='max phred of base as lowQual, default=0', default=0)
-    parser.add_argument('--lowNum', type=int, help='max number with lowQual allowed, default=2', default=2)
-    parser.add_argument('--nopolyT', action='store_true', help='output nopolyT fq')
-    parser.add_argument('--noLinker', action='store_true', help='output noLinker fq')
-    parser.add_argument('--thread', default=2)
-    return parser
-
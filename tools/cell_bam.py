@@ -0,0 +1,97 @@
+#!/bin/env python
+#coding=utf8
+
+"""
+reads of single cells from the name sorted bam of featureCounts, by the
+{sample}_barcode_index.tsv that count writes: one seek per barcode instead
+of a scan of the whole bam.
+
+    python3 cell_bam.py --bam 04.featureCounts/S1_name_sorted.bam \
+        --index 05.count/S1_barcode_index.tsv --barcodes cells.txt --out cells.bam
+
+after top-ups, the reads of a cell are spread over the bam of every run;
+pass all of them with their indexes, {sample}_topup{n}_barcode_index.tsv,
+in the same order:
+
+    --bam S1/04.featureCounts/S1_name_sorted.bam,S1_topup/04.featureCounts/S1_name_sorted.bam
+    --index S1/05.count/S1_barcode_index.tsv,S1/05.count/S1_topup1_barcode_index.tsv
+"""
+
+import argparse
+
+
+def load_barcode_index(index_file):
+    """
+    {barcode: (start, end, reads)}, start and end are BGZF virtual offsets
+    """
+    index = {}
+    with open(index_file) as fh:
+        next(fh)
+        for line in fh:
+            barcode, start, end, reads = line.rstrip('\n').split('\t')
+            index[barcode] = (int(start), int(end), int(reads))
+    return index
+
+
+def fetch_cell_reads(samfile, index, barcode):
+    """
+    reads of barcode from an open pysam.AlignmentFile, nothing if the
+    barcode is not in the index
+    """
+    if barcode not in index:
+        return
+    start, end, reads = index[barcode]
+    samfile.seek(start)
+    for _ in range(reads):
+        yield next(samfile)
+
+
+def write_cell_bam(bams, index_files, barcodes, out_bam):
+    """
+    reads of barcodes, in the given order, to out_bam. bams and index_files
+    are a bam and its index, or lists of them (a run and its top-ups), whose
+    reads of a barcode are written one bam after the other.
+    returns the read number
+    """
+    import pysam
+    if isinstance(bams, str):
+        bams, index_files = [bams], [index_files]
+    if len(bams) != len(index_files):
+        raise ValueError('%s bams for %s barcode indexes' % (len(bams), len(index_files)))
+    indexes = [load_barcode_index(f) for f in index_files]
+    samfiles = [pysam.AlignmentFile(bam, 'rb') for bam in bams]
+    n = 0
+    try:
+        with pysam.AlignmentFile(out_bam, 'wb', template=samfiles[0]) as out:
+            for barcode in barcodes:
+                for samfile, index in zip(samfiles, indexes):
+                    for seg in fetch_cell_reads(samfile, index, barcode):
+                        out.write(seg)
+                        n += 1
+    finally:
+        for samfile in samfiles:
+            samfile.close()
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser(description='reads of some cells from the name sorted bam')
+    parser.add_argument('--bam', help='name sorted bam of featureCounts, or the bams of a run and its top-ups \
+        seperated by comma', required=True)
+    parser.add_argument('--index', help='{sample}_barcode_index.tsv of count, or one index per bam seperated by comma',
+        required=True)
+    parser.add_argument('--barcodes', help='file of barcodes, one per line, or barcodes seperated by comma',
+        required=True)
+    parser.add_argument('--out', help='output bam', required=True)
+    args = parser.parse_args()
+
+    try:
+        with open(args.barcodes) as fh:
+            barcodes = [line.strip() for line in fh if line.strip()]
+    except IOError:
+        barcodes = args.barcodes.split(',')
+    write_cell_bam(args.bam.split(','), args.index.split(','), barcodes, args.out)
+
+
+if __name__ == '__main__':
+    main()
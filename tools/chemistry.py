@@ -0,0 +1,302 @@
+#!/bin/env python
+#coding=utf8
+
+import os, re, sys, json
+import logging
+from collections import defaultdict
+from itertools import combinations, permutations, product
+from operator import itemgetter
+
+datadir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+# 生成错配字典
+def generate_mis_seq(seq, n=1, bases = 'ACGTN'):
+    # 以随机bases中的碱基替换seq中的n个位置，产生的错配字典
+    # 返回字典，错配序列为key，
+    # (正确序列，错配碱基数目，错配碱基位置，原始碱基，新碱基)组成的元组
+    # 作为字典的值
+
+    length = len(seq)
+    assert length >= n, "err number should not be larger than sequence length!"
+    res = {}
+    seq_arr = list(seq)
+    pos_group = list(combinations(range(0,length), n))
+    bases_group = list(permutations(bases, n))
+
+    for g in pos_group:
+        for b in bases_group:
+            seq_tmp = seq_arr[:]
+            mis_num = n
+            raw_tmp = []
+            for i in range(n):
+                raw_base = seq_tmp[g[i]]
+                new_base = b[i]
+
+                if raw_base == new_base:
+                    mis_num -= 1
+
+                raw_tmp.append(raw_base)
+                seq_tmp[g[i]] = new_base
+
+            if mis_num!=0:
+                res[''.join(seq_tmp)] = (seq, mis_num, ','.join([str(i) for i in g]), ','.join(raw_tmp), ','.join(b))
+    return(res)
+
+def read_seqs(seqlist):
+    with open(seqlist, 'r') as fh:
+        return [seq.strip() for seq in fh if seq.strip()]
+
+def seq_dict(seqs, n=1):
+    res = {}
+    for seq in seqs:
+        res[seq] = (seq, 0, -1, 'X', 'X')
+        for k, v in generate_mis_seq(seq, n).items():
+            # duplicate key
+            if k in res:
+                logging.warning('barcode %s, %s\n%s, %s' % (v, k, res[k], k))
+            else:
+                res[k] = v
+    return res
+
+def generate_seq_dict(seqlist, n=1):
+    return seq_dict(read_seqs(seqlist), n)
+
+def parse_pattern(pattern):
+    # 解析接头结构，返回接头结构字典
+    # key: 字母表示的接头, value: 碱基区间列表
+    # eg.: C8L10C8L10C8U8T30
+    # defaultdict(<type 'list'>:
+    # {'C': [[0, 8], [18, 26], [36, 44]], 'U': [[44, 52]], 'L': [[8, 18], [26, 36]], 'T': [[52, 82]]})
+    pattern_dict = defaultdict(list)
+    p = re.compile(r'([CLUNT])(\d+)')
+    tmp = p.findall(pattern)
+    if not tmp:
+        logging.error('Can not recognise pattern! %s' % pattern)
+    start = 0
+    for item in tmp:
+        end = start + int(item[1])
+        pattern_dict[item[0]].append([start, end])
+        start = end
+    return pattern_dict
+
+
+def load_registry(chemistry_file=None):
+    """
+    built-in chemistries of data/chemistry.json, updated with chemistry_file.
+    whitelist/linker paths are relative to the json they come from
+    """
+    registry = {}
+    for json_file in [datadir + '/chemistry.json', chemistry_file]:
+        if not json_file:
+            continue
+        base = os.path.dirname(os.path.abspath(json_file))
+        with open(json_file) as fh:
+            for name, chemistry in json.load(fh).items():
+                for key in ['whitelist', 'linker']:
+                    if chemistry.get(key):
+                        chemistry[key] = [os.path.join(base, f) for f in chemistry[key]]
+                registry[name] = chemistry
+    return registry
+
+
+def get_chemistry(bcType, chemistry_file=None):
+    registry = load_registry(chemistry_file)
+    if bcType not in registry:
+        sys.exit('unknown bcType %s, choose from %s' % (bcType, ','.join(sorted(registry))))
+    return registry[bcType]
+
+
+def _strings(ranges):
+    # subsequence at ranges, joined when the ranges are not contiguous
+    if len(ranges) == 1:
+        return itemgetter(slice(*ranges[0]))
+    getter = itemgetter(*[slice(s, e) for s, e in ranges])
+    return lambda seq: ''.join(getter(seq))
+
+
+def _tuples(ranges):
+    # tuple of the subsequences at ranges
+    if len(ranges) == 1:
+        s = slice(*ranges[0])
+        return lambda seq: (seq[s],)
+    return itemgetter(*[slice(s, e) for s, e in ranges])
+
+
+class SegmentMatcher:
+    """
+    segments of one kind (barcodes or linkers) each matched against its own
+    mismatch index, at most max_mismatch mismatches over all of them.
+
+    a read is rejected at the first segment that misses its index. segments
+    are tried in the order of their rejections so far, re-sorted every
+    reorder rejections, so most rejected reads cost a single lookup.
+    when there are few exact combinations (linkers), exact reads are
+    accepted with one set lookup
+    """
+    MAX_EXACT = 4096
+
+    def __init__(self, ranges, indexes, max_mismatch, reorder=10000):
+        self.ranges = ranges
+        self.slices = [slice(s, e) for s, e in ranges]
+        self.indexes = indexes
+        self.max_mismatch = max_mismatch
+        self.reorder = reorder
+        self.order = list(range(len(ranges)))
+        self.rejects = [0] * len(ranges)
+        self.n_rejects = 0
+
+        exact = [[k for k, v in index.items() if v[1] == 0] for index in indexes]
+        n_exact = 1
+        for e in exact:
+            n_exact *= len(e)
+        self.exact = set(''.join(p) for p in product(*exact)) if n_exact <= self.MAX_EXACT else None
+        self._compile()
+
+    def _compile(self):
+        self.joined = _strings(self.ranges)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('joined')
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile()
+
+    def _reject(self, i):
+        self.rejects[i] += 1
+        self.n_rejects += 1
+        if self.n_rejects % self.reorder == 0:
+            self.order.sort(key=lambda j: -self.rejects[j])
+
+    def match(self, seq):
+        """
+        (corrected sequence, mismatches), None if rejected
+        """
+        if self.exact is not None:
+            seq_joined = self.joined(seq)
+            if seq_joined in self.exact:
+                return seq_joined, 0
+        res = [None] * len(self.slices)
+        err = 0
+        for i in self.order:
+            hit = self.indexes[i].get(seq[self.slices[i]])
+            if hit is None:
+                self._reject(i)
+                return None
+            err += hit[1]
+            if err > self.max_mismatch:
+                self._reject(i)
+                return None
+            res[i] = hit[0]
+        return ''.join(res), err
+
+
+def _budgets(budget, n):
+    # per segment mismatches from an int or a list of the chemistry
+    if budget is None:
+        budget = 1
+    if isinstance(budget, int):
+        return [budget] * n
+    if len(budget) != n:
+        sys.exit('%s mismatch budgets for %s segments' % (len(budget), n))
+    return budget
+
+
+def _segment_indexes(files, ranges, budgets, kind):
+    """
+    one mismatch index per segment, segments sharing a file and budget share
+    the index. a single file for several segments holds either per-segment
+    sequences (all of one segment length) or whole sequences of all segments,
+    which are split at the segment lengths
+    """
+    lengths = [e - s for s, e in ranges]
+    if len(files) == 1 and len(ranges) > 1:
+        seqs = read_seqs(files[0])
+        if seqs and len(seqs[0]) == sum(lengths):
+            columns, start = [], 0
+            for n in lengths:
+                columns.append(sorted(set(seq[start:start + n] for seq in seqs)))
+                start += n
+            return [seq_dict(c, b) for c, b in zip(columns, budgets)]
+        files = files * len(ranges)
+    if len(files) != len(ranges):
+        sys.exit('%s %s files for %s segments' % (len(files), kind, len(ranges)))
+    cache = {}
+    indexes = []
+    for f, b in zip(files, budgets):
+        if (f, b) not in cache:
+            cache[(f, b)] = seq_dict(read_seqs(f), b)
+        indexes.append(cache[(f, b)])
+    return indexes
+
+
+class ExtractionPlan:
+    """
+    read1 layout compiled once per run: slice getters of every segment type
+    and the per-segment mismatch indexes of barcodes and linkers, so the
+    barcode loop does no pattern parsing or range list building per read.
+
+    whitelist: one file per C segment, or a single file for all of them
+    linker: one file per L segment, or a single file of whole linkers
+    barcode_mismatch/linker_mismatch: mismatches allowed per segment, an int
+    or a list; the totals stay within BARCODE_MAX_MISMATCH/LINKER_MAX_MISMATCH
+    """
+    BARCODE_MAX_MISMATCH = 1
+    LINKER_MAX_MISMATCH = 2
+
+    def __init__(self, pattern, whitelist=None, linker=None, barcode_mismatch=None, linker_mismatch=None):
+        self.pattern = pattern
+        self.pattern_dict = parse_pattern(pattern)
+        self.bool_T = 'T' in self.pattern_dict
+        self.bool_L = 'L' in self.pattern_dict
+        self.C_len = sum([e - s for s, e in self.pattern_dict['C']])
+
+        self.barcode_matcher = None
+        if whitelist:
+            ranges = self.pattern_dict['C']
+            indexes = _segment_indexes(whitelist, ranges, _budgets(barcode_mismatch, len(ranges)), 'whitelist')
+            self.barcode_matcher = SegmentMatcher(ranges, indexes, self.BARCODE_MAX_MISMATCH)
+
+        self.linker_matcher = None
+        if linker and self.bool_L:
+            ranges = self.pattern_dict['L']
+            indexes = _segment_indexes(linker, ranges, _budgets(linker_mismatch, len(ranges)), 'linker')
+            self.linker_matcher = SegmentMatcher(ranges, indexes, self.LINKER_MAX_MISMATCH)
+        self._compile()
+
+    def _compile(self):
+        p = self.pattern_dict
+        self.barcodes = _tuples(p['C'])
+        self.quals = _strings(p['C'] + p['U'])
+        self.umi = _strings(p['U']) if p['U'] else lambda seq: ''
+        self.polyT = _strings(p['T']) if self.bool_T else None
+
+    # getters are closures, rebuilt after pickling to pool workers
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ['barcodes', 'quals', 'umi', 'polyT']:
+            state.pop(k)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile()
+
+
+def get_plan(args):
+    """
+    ExtractionPlan of --bcType, or of --pattern/--whitelist/--linker.
+    --whitelist/--linker override the files of the chemistry
+    """
+    if args.bcType:
+        chemistry = get_chemistry(args.bcType, getattr(args, 'chemistryFile', None))
+    else:
+        chemistry = {'pattern': args.pattern}
+    if args.whitelist:
+        chemistry['whitelist'] = args.whitelist.split(',')
+    if args.linker:
+        chemistry['linker'] = args.linker.split(',')
+    return ExtractionPlan(chemistry['pattern'], chemistry.get('whitelist'), chemistry.get('linker'),
+        chemistry.get('barcode_mismatch'), chemistry.get('linker_mismatch'))
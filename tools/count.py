@@ -3,8 +3,11 @@
 
 import os
 import sys
+import glob
+import shutil
 import json
 import functools
+import importlib.util
 import logging
 from collections import defaultdict
 from itertools import groupby
@@ -15,29 +18,18 @@ from scipy.io import mmwrite
 from scipy.sparse import csr_matrix
 import pysam
 from utils import format_number
+from report import load_fragment, update_fragment
+from profiler import phase
+from progress import get_progress
+from figures import binned_rank_curve, defer_figure
+from opts import get_opts5
 
 FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 logging.basicConfig(level = logging.INFO, format = FORMAT)
 
-def get_opts5(parser, sub_program):
-    if sub_program:
-        parser.add_argument('--outdir', help='output dir', required=True)
-        parser.add_argument('--sample', help='sample name', required=True)
-        parser.add_argument('--bam', required=True)
-    parser.add_argument('--thread', default=2)
-    parser.add_argument('--cells', type=int, default=3000)
-
-
 def report_prepare(count_file, downsample_file, outdir):
 
-    json_file = outdir + '/.data.json'
-    if not os.path.exists(json_file):
-        data = {}
-    else:
-        fh = open(json_file)
-        data = json.load(fh)
-        fh.close()
-
+    data = {}
     df0 = pd.read_table(downsample_file, header=0)
     data['percentile'] = df0['percent'].tolist()
     data['MedianGeneNum'] = df0['median_geneNum'].tolist()
@@ -48,15 +40,19 @@ def report_prepare(count_file, downsample_file, outdir):
     df = pd.read_table(count_file, header=0)
     df = df.sort_values('UMI', ascending=False)
     data['CB_num'] = df[df['mark'] == 'CB'].shape[0]
-    data['Cells'] = list(df.loc[df['mark'] == 'CB', 'UMI'])
-
     data['UB_num'] = df[df['mark'] == 'UB'].shape[0]
-    data['Background'] = list(df.loc[df['mark'] == 'UB', 'UMI'])
+
+    # barcode rank plot only needs log-spaced points, cells come first in UMI order
+    ranks, umi = binned_rank_curve(df['UMI'].values, breaks=[data['CB_num']])
+    n = np.searchsorted(ranks, data['CB_num'], side='right')
+    data['Cells_rank'] = ranks[:n]
+    data['Cells'] = umi[:n]
+    data['Background_rank'] = ranks[n:]
+    data['Background'] = umi[n:]
 
     data['umi_summary'] = True
 
-    with open(json_file, 'w') as fh:
-        json.dump(data, fh)
+    update_fragment(outdir, 'count', data)
 
 def barcode_filter_with_magnitude(df, plot='magnitude.pdf', col='UMI', percent=0.1, expected_cell_num=3000):
     # col can be readcount or UMI
@@ -67,20 +63,16 @@ def barcode_filter_with_magnitude(df, plot='magnitude.pdf', col='UMI', percent=0
     idx = max(0, idx)
 
     # calculate read counts threshold
-    threshold = int(df.iloc[idx, df.columns==col] * 0.1)
+    threshold = int(df[col].iloc[idx] * 0.1)
     threshold = max(1, threshold)
     validated_barcodes = df[df[col]>threshold].index
 
-    import matplotlib
-    matplotlib.use('Agg')
-    import matplotlib.pyplot as plt
-    fig = plt.figure()
-    plt.plot(df[col])
-    plt.hlines(threshold, 0, len(validated_barcodes), linestyle='dashed')
-    plt.vlines(len(validated_barcodes), 0 , threshold, linestyle='dashed')
-    plt.title('expected cell num: %s\n%s threshold: %s\ncell num: %s'%(expected_cell_num, col, threshold, len(validated_barcodes)))
-    plt.loglog()
-    plt.savefig(plot)
+    # drawn with the report, from about 500 points of the rank curve
+    if plot:
+        ranks, values = binned_rank_curve(df[col].values, breaks=[len(validated_barcodes)])
+        defer_figure(os.path.dirname(os.path.abspath(plot)) + '/..', 'barcode_filter_magnitude', plot, {
+            'ranks': ranks, 'values': values, 'threshold': threshold, 'cell_num': len(validated_barcodes),
+            'expected_cell_num': expected_cell_num, 'col': col})
 
     return (validated_barcodes, threshold, len(validated_barcodes))
 
@@ -112,33 +104,108 @@ def correct_umi(fh1, barcode, gene_umi_dict, percent=0.1):
     return res_dict
 
 
-def bam2table(bam, detail_file):
+def with_offsets(samfile):
+    # (BGZF virtual offset, segment) of each record
+    tell = samfile.tell
+    while True:
+        offset = tell()
+        try:
+            seg = next(samfile)
+        except StopIteration:
+            return
+        yield offset, seg
+
+
+def bam2table(bam, detail_file, args=None, index_file=None, correct=True):
     # 提取bam中相同barcode的reads，统计比对到基因的reads信息
-    #
+    # index_file: Barcode, virtual offsets of the first read and past the
+    # last read of the barcode, and its read number, see cell_bam.py
+    # correct=False keeps the raw UMI counts, for merge_detail
     samfile = pysam.AlignmentFile(bam, "rb")
+    # compressed offset is the upper 48 bits of the virtual offset
+    progress = get_progress('bam2table', [bam], args, position=lambda: samfile.tell() >> 16)
+    (n_reads, n_assigned, n_barcodes) = (0, 0, 0)
     with open(detail_file, 'w') as fh1:
         fh1.write('\t'.join(['Barcode', 'geneID', 'UMI', 'count']) + '\n')
 
         # pysam.libcalignedsegment.AlignedSegment
         # AAACAGGCCAGCGTTAACACGACC_CCTAACGT_A00129:340:HHH72DSXX:2:1353:23276:30843
         # 获取read的barcode
-        keyfunc = lambda x: x.query_name.split('_', 1)[0]
-
-        for _, g in groupby(samfile, keyfunc):
+        keyfunc = lambda x: x[1].query_name.split('_', 1)[0]
+        fh_index = open(index_file, 'w') if index_file else None
+        if fh_index:
+            fh_index.write('Barcode\tstart\tend\treads\n')
+            records = with_offsets(samfile)
+        else:
+            records = ((None, seg) for seg in samfile)
+        last = None
+
+        for _, g in groupby(records, keyfunc):
             gene_umi_dict = defaultdict(lambda: defaultdict(int))
-            for seg in g:
+            start_reads = n_reads
+            for i, (offset, seg) in enumerate(g):
+                if i == 0 and fh_index:
+                    # a barcode ends where the next one starts
+                    if last:
+                        fh_index.write('%s\t%s\t%s\t%s\n' % (last[0], last[1], offset, last[2]))
+                    start = offset
+                n_reads += 1
                 (barcode, umi) = seg.query_name.split('_')[:2]
                 if not seg.has_tag('XT'):
                     continue
+                n_assigned += 1
                 geneID = seg.get_tag('XT')
                 gene_umi_dict[geneID][umi] += 1
-            res_dict = correct_umi(fh1, barcode, gene_umi_dict)
+            n_barcodes += 1
+            if fh_index:
+                last = (barcode, start, n_reads - start_reads)
+            if progress and n_barcodes % 1000 == 0:
+                progress.report(n_reads, {'assigned': n_assigned})
+            res_dict = correct_umi(fh1, barcode, gene_umi_dict) if correct else gene_umi_dict
 
             # output
             for geneID in res_dict:
                 for umi in res_dict[geneID]:
                     fh1.write('%s\t%s\t%s\t%s\n' % (barcode, geneID, umi,
                                                 res_dict[geneID][umi]))
+        if fh_index:
+            if last:
+                fh_index.write('%s\t%s\t%s\t%s\n' % (last[0], last[1], samfile.tell(), last[2]))
+            fh_index.close()
+    if progress:
+        progress.done(n_reads, {'assigned': n_assigned})
+
+
+def merge_detail(detail_file, topup_files, out_file):
+    """
+    merge the raw UMI counts of top-up runs into a count detail table.
+    (Barcode, geneID) groups without new reads are kept as they are, UMI
+    correction is run again on the old plus new counts of the others
+    """
+    old = pd.read_table(detail_file, header=0)
+    new = pd.concat([pd.read_table(f, header=0) for f in topup_files])
+    affected = new[['Barcode', 'geneID']].drop_duplicates()
+    old = old.merge(affected, on=['Barcode', 'geneID'], how='left', indicator=True)
+    kept = old.loc[old['_merge'] == 'left_only', ['Barcode', 'geneID', 'UMI', 'count']]
+    touched = pd.concat([old.loc[old['_merge'] == 'both', ['Barcode', 'geneID', 'UMI', 'count']], new])
+    touched = touched.groupby(['Barcode', 'geneID', 'UMI'], sort=True)['count'].sum().reset_index()
+
+    tmp_file = out_file + '.tmp'
+    with open(tmp_file, 'w') as fh:
+        fh.write('\t'.join(['Barcode', 'geneID', 'UMI', 'count']) + '\n')
+        kept.to_csv(fh, sep='\t', header=False, index=False)
+        rows = zip(touched['Barcode'].values, touched['geneID'].values, touched['UMI'].values,
+            touched['count'].values)
+        for barcode, g in groupby(rows, lambda x: x[0]):
+            gene_umi_dict = defaultdict(dict)
+            for _, geneID, umi, n in g:
+                gene_umi_dict[geneID][umi] = int(n)
+            res_dict = correct_umi(fh, barcode, gene_umi_dict)
+            for geneID in res_dict:
+                for umi in res_dict[geneID]:
+                    fh.write('%s\t%s\t%s\t%s\n' % (barcode, geneID, umi, res_dict[geneID][umi]))
+    os.rename(tmp_file, out_file)
+    return len(kept), len(affected)
 
 
 def call_cells(df, expected_num, pdf, marked_counts_file):
@@ -164,7 +231,7 @@ def call_cells(df, expected_num, pdf, marked_counts_file):
     return validated_barcodes, threshold, cell_num, CB_describe
 
 
-def expression_matrix(df, validated_barcodes, matrix_file):
+def expression_matrix(df, validated_barcodes, matrix_file, h5_file=None, marked_counts_file=None, annot=None):
     df.loc[:, 'mark'] = 'UB'
     df.loc[df['Barcode'].isin(validated_barcodes), 'mark'] = 'CB'
 
@@ -184,25 +251,49 @@ def expression_matrix(df, validated_barcodes, matrix_file):
     table.index.to_series().to_csv(
         matrix_file + '_genes.tsv', index=False, sep='\t')
     mmwrite(matrix_file, csr_matrix(table.fillna(0)))
+    if h5_file:
+        write_matrix_h5(h5_file, table, marked_counts_file, annot)
     return(CB_total_Genes, CB_reads_count, reads_mapped_to_transcriptome) 
 
+def write_matrix_h5(h5_file, table, marked_counts_file=None, annot=None):
+    """
+    genes x cells table as {sample}_matrix.h5, with gene names when annot is
+    given and the per cell columns of marked_counts_file
+    """
+    from h5matrix import write_h5
+    gene_ids = table.index.values.astype(str)
+    gene_names = None
+    if annot:
+        from annotation import load_annotation
+        id_name = load_annotation(annot).id_name
+        gene_names = [id_name.get(gene_id, gene_id) for gene_id in gene_ids]
+    cell_qc = None
+    if marked_counts_file:
+        cell_qc = pd.read_table(marked_counts_file, index_col=0).drop('mark', axis=1)
+    write_h5(h5_file, csr_matrix(table.values), table.columns.values.astype(str), gene_ids,
+        gene_names, cell_qc)
+
+
+def valid_reads(outdir):
+    # Valid Reads of the barcode step of a sample dir
+    data = load_fragment(outdir, 'barcode')
+    #total_read_number = int(data['barcode_summary'][0][1])
+    str_number = data['barcode_summary'][1][1].split("(")[0]
+    return int(str_number.replace(",",""))
+
 def get_summary(df, sample, Saturation, CB_describe, CB_total_Genes,
-         CB_reads_count, reads_mapped_to_transcriptome,stat_file, outdir):
+         CB_reads_count, reads_mapped_to_transcriptome,stat_file, outdir, valid_read_number=None):
 
     #total read
-    json_file = outdir + '.data.json'
-    fh = open(json_file)
-    data = json.load(fh)
-    #total_read_number = int(data['barcode_summary'][0][1])
-    str_number = data['barcode_summary'][1][1].split("(")[0]
-    valid_read_number = int(str_number.replace(",",""))
+    if valid_read_number is None:
+        valid_read_number = valid_reads(outdir)
 
     summary = pd.Series([0, 0, 0, 0, 0, 0, 0],
                         index=[
                             'Estimated Number of Cells','Fraction Reads in Cells',
                             'Mean Reads per Cell', 'Median UMI per Cell', 'Total Genes',
                             'Median Genes per Cell','Saturation'
-                        ])
+                        ], dtype=object)
 
     # 细胞数
     summary['Estimated Number of Cells'] = int(CB_describe.loc['count', 'readcount'])
@@ -248,8 +339,43 @@ def downsample(detail_file, validated_barcodes, downsample_file):
             saturation = s
     return saturation
 
+def saturation_model(df, validated_barcodes, downsample_file, model_file, reads_per_cell,
+        target_saturation=80, target_genes=None):
+    """
+    saturation and median genes per cell predicted at folds of the reads, from
+    the reads per molecule of the cells and the downsampled points.
+    writes model_file and returns the report data
+    """
+    from saturation import extrapolate, fold_for_saturation, fold_for_genes
+    reads_per_umi = df.loc[df['Barcode'].isin(validated_barcodes), 'count'].values
+    df0 = pd.read_table(downsample_file, header=0)
+    table, model, params = extrapolate(reads_per_umi, df0['percent'], df0['median_geneNum'])
+    table['mean_reads_per_cell'] = (table['fold'] * reads_per_cell).round().astype(int)
+    table.to_csv(model_file, sep='\t', index=False, float_format='%.2f')
+
+    targets = []
+    if model:
+        targets.append(['%s%% Saturation' % (target_saturation), fold_for_saturation(model, target_saturation)])
+    if params and target_genes:
+        targets.append(['%s Median Genes per Cell' % (target_genes), fold_for_genes(params, target_genes)])
+    data = {
+        'Predicted_fold': table['fold'].tolist(),
+        'Predicted_saturation': table['saturation'].round(2).tolist() if model else [],
+        'Predicted_MedianGeneNum': table['median_geneNum'].round(2).tolist() if params else [],
+        'saturation_targets': [[item, 'not reached within 1000x' if fold is None else
+            '%.2fx reads, %s mean reads per cell' % (fold, format_number(int(fold * reads_per_cell)))]
+            for item, fold in targets],
+    }
+    return data
+
+def check_h5(args):
+    if args.h5 and importlib.util.find_spec('h5py') is None:
+        sys.exit('--h5 needs h5py installed')
+
 def count(args):
 
+    check_h5(args)
+
     # 检查和创建输出目录
     if not os.path.exists(args.outdir):
         os.system('mkdir -p %s' % (args.outdir))
@@ -257,32 +383,64 @@ def count(args):
     # umi纠错，输出Barcode geneID  UMI     count为表头的表格
     count_detail_file = args.outdir + '/' + args.sample + '_count_detail.txt'
     logging.info('UMI count ...!')
-    bam2table(args.bam, count_detail_file)
+    barcode_index_file = args.outdir + '/' + args.sample + '_barcode_index.tsv'
+    with phase('bam2table'):
+        bam2table(args.bam, count_detail_file, args, index_file=barcode_index_file)
     logging.info('bam to table done ...!')
 
-    df = pd.read_table(count_detail_file, header=0)
+    # a fresh count drops the reads of earlier top-ups
+    if load_fragment(args.outdir + '/..', 'count').get('topups'):
+        update_fragment(args.outdir + '/..', 'count', {'topups': {}})
+    prefix = args.outdir + '/' + args.sample
+    for f in glob.glob(prefix + '_topup*') + glob.glob(prefix + '_count_detail_base.txt'):
+        os.remove(f)
+    count_from_detail(args, count_detail_file)
+
+
+def count_from_detail(args, count_detail_file, valid_read_number=None):
+    """
+    cells, matrix, saturation, summary and report of a count detail table
+    """
+    with phase('read_table'):
+        df = pd.read_table(count_detail_file, header=0)
 
     # call cells
     pdf = args.outdir + '/barcode_filter_magnitude.pdf'
     marked_counts_file = args.outdir + '/' + args.sample + '_counts.txt'
-    (validated_barcodes, threshold, cell_num, CB_describe) = call_cells(df, args.cells, pdf, marked_counts_file)
+    with phase('call_cells'):
+        (validated_barcodes, threshold, cell_num, CB_describe) = call_cells(df, args.cells, pdf, marked_counts_file)
 
     # 输出matrix
     matrix_file = args.outdir + '/' + args.sample 
-    (CB_total_Genes, CB_reads_count, 
-        reads_mapped_to_transcriptome)=expression_matrix(df, validated_barcodes, matrix_file)
+    with phase('expression_matrix'):
+        (CB_total_Genes, CB_reads_count, 
+            reads_mapped_to_transcriptome)=expression_matrix(df, validated_barcodes, matrix_file,
+            h5_file=matrix_file + '_matrix.h5' if args.h5 else None, marked_counts_file=marked_counts_file,
+            annot=getattr(args, 'annot', None))
 
     # downsampling
     validated_barcodes = set(validated_barcodes)
     downsample_file = args.outdir + '/' + args.sample + '_downsample.txt'
-    Saturation = downsample(count_detail_file, validated_barcodes, downsample_file)
+    with phase('downsample'):
+        Saturation = downsample(count_detail_file, validated_barcodes, downsample_file)
+
+    # extrapolation beyond the sequenced reads
+    if valid_read_number is None:
+        valid_read_number = valid_reads(args.outdir + '/../')
+    model_file = args.outdir + '/' + args.sample + '_saturation_model.txt'
+    with phase('saturation_model'):
+        model_data = saturation_model(df, validated_barcodes, downsample_file, model_file,
+            valid_read_number / float(max(cell_num, 1)), getattr(args, 'targetSaturation', 80),
+            getattr(args, 'targetGenes', None))
 
     # summary
     stat_file = args.outdir + '/stat.txt'
     get_summary(df, args.sample, Saturation, CB_describe, CB_total_Genes,
-                    CB_reads_count, reads_mapped_to_transcriptome,stat_file,args.outdir + '/../')
+                    CB_reads_count, reads_mapped_to_transcriptome,stat_file,args.outdir + '/../',
+                    valid_read_number=valid_read_number)
 
     report_prepare(marked_counts_file, downsample_file, args.outdir + '/..')
+    update_fragment(args.outdir + '/..', 'count', model_data)
 
     logging.info('count done!')
     from report import reporter
@@ -291,3 +449,64 @@ def count(args):
         stat_file=args.outdir + '/stat.txt',
         outdir=args.outdir + '/..')
     t.get_report()
+
+
+def topup_files(prefix, n):
+    # raw detail table and barcode index of the n-th top-up of a sample
+    return '%s_topup%s_detail.txt' % (prefix, n), '%s_topup%s_barcode_index.tsv' % (prefix, n)
+
+
+def topup(args):
+    """
+    merge a top-up run of the same library, taken through featureCounts in
+    its own dir (--topupDir), into the count step of the sample at --outdir,
+    then call cells and rebuild the matrix without realigning old reads.
+
+    the count detail of the first run is kept as {sample}_count_detail_base.txt
+    and the raw table of every top-up as {sample}_topup{n}_detail.txt; the
+    count detail is always rebuilt from them, and the top-ups merged are
+    recorded in the count fragment, so a repeated or interrupted top-up
+    does not count reads twice
+    """
+    check_h5(args)
+    prefix = args.outdir + '/' + args.sample
+    count_detail_file = prefix + '_count_detail.txt'
+    base_detail_file = prefix + '_count_detail_base.txt'
+    if not os.path.exists(count_detail_file):
+        sys.exit('no count detail table to top up: %s' % (count_detail_file))
+    sample_dir = args.outdir + '/..'
+    topups = load_fragment(sample_dir, 'count').get('topups', {})
+    topup_dir = os.path.realpath(args.topupDir)
+
+    if topup_dir in topups:
+        logging.info('%s already merged, count again only' % (args.topupDir))
+    else:
+        n = len(topups) + 1
+        topup_detail_file, topup_index_file = topup_files(prefix, n)
+        topup_bam = args.topupDir + '/04.featureCounts/' + args.sample + '_name_sorted.bam'
+        logging.info('top-up UMI count ...!')
+        with phase('bam2table'):
+            bam2table(topup_bam, topup_detail_file + '.tmp', args, index_file=topup_index_file, correct=False)
+        os.rename(topup_detail_file + '.tmp', topup_detail_file)
+        logging.info('top-up UMI count done!')
+
+        # the count detail is only replaced by merges of the base, which
+        # is the untouched detail of the first run
+        if not os.path.exists(base_detail_file):
+            shutil.copyfile(count_detail_file, base_detail_file + '.tmp')
+            os.rename(base_detail_file + '.tmp', base_detail_file)
+
+        logging.info('merge top-up ...!')
+        with phase('merge_detail'):
+            (n_kept, n_affected) = merge_detail(base_detail_file,
+                [topup_files(prefix, i + 1)[0] for i in range(n)], count_detail_file)
+        logging.info('%s barcode/gene groups corrected again, %s UMIs kept as they were' % (
+            format_number(n_affected), format_number(n_kept)))
+        logging.info('merge top-up done!')
+        topups[topup_dir] = {'n': n, 'valid_reads': valid_reads(args.topupDir), 'bam': os.path.realpath(topup_bam),
+            'barcode_index': os.path.realpath(topup_index_file)}
+        update_fragment(sample_dir, 'count', {'topups': topups})
+
+    # valid reads of the first run and of every top-up, for the reads per cell of the summary
+    topup_valid_reads = sum(t['valid_reads'] for t in topups.values())
+    count_from_detail(args, count_detail_file, valid_reads(sample_dir) + topup_valid_reads)
@@ -6,21 +6,12 @@ import subprocess
 import logging
 from itertools import islice
 import pandas as pd
+from opts import get_opts2
+from utils import format_number, lane_files
 
 FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 logging.basicConfig(level = logging.INFO, format = FORMAT)
 
-def get_opts2(parser,sub_program):
-    if sub_program:
-        parser.add_argument('--fq', help='fq file', required=True)
-        parser.add_argument('--outdir', help='output dir',required=True)
-        parser.add_argument('--sample', help='sample name', required=True)
-    parser.add_argument('--adapt', action='append', default=['polyT=A{18}', 'p5=AGATCGGAAGAGCACACGTCTGAACTCCAGTCAC',])
-    parser.add_argument('--minimum-length', dest='minimum_length', help='minimum_length, default=20', default=20)
-    parser.add_argument('--nextseq-trim', dest='nextseq_trim', help='nextseq_trim, default=20', default=20)
-    parser.add_argument('--overlap', help='minimum overlap length, default=5', default=5)
-    parser.add_argument('--thread', default=2)
-
 def format_stat(cutadapt_log, samplename):
     fh = open(cutadapt_log, 'r') 
     stat_file = os.path.dirname(cutadapt_log) + '/stat.txt'
@@ -46,6 +37,42 @@ def format_stat(cutadapt_log, samplename):
             
     fh.close()
 
+# summary lines of a cutadapt log, and their names in stat.txt.
+# percents are of total reads or of total base pairs, as cutadapt reports them
+LOG_ITEMS = [
+    ('Reads with Adapters', r'Reads with adapters:\s+([\d,]+)', 'reads'),
+    ('Reads too Short', r'Reads that were too short:\s+([\d,]+)', 'reads'),
+    ('Reads Written', r'Reads written \(passing filters\):\s+([\d,]+)', 'reads'),
+    ('Base Pairs Processed', r'Total basepairs processed:\s+([\d,]+)', None),
+    ('Base Pairs Quality-Trimmed', r'Quality-trimmed:\s+([\d,]+)', 'bp'),
+    ('Base Pairs Written', r'Total written \(filtered\):\s+([\d,]+)', 'bp'),
+]
+
+def format_stat_lanes(cutadapt_logs, stat_file):
+    """
+    stat.txt of several lanes, counts summed over the lane logs
+    """
+    def log_number(content, pattern):
+        m = re.search(pattern, content)
+        return int(m.group(1).replace(',', '')) if m else 0
+
+    total = {'reads': 0, 'bp': 0}
+    values = [0] * len(LOG_ITEMS)
+    for log in cutadapt_logs:
+        with open(log) as fh:
+            content = fh.read()
+        total['reads'] += log_number(content, r'Total reads processed:\s+([\d,]+)')
+        total['bp'] += log_number(content, r'Total basepairs processed:\s+([\d,]+)')
+        for i, (_, pattern, _) in enumerate(LOG_ITEMS):
+            values[i] += log_number(content, pattern)
+
+    with open(stat_file, 'w') as fh:
+        for (item, _, of), value in zip(LOG_ITEMS, values):
+            if of:
+                fh.write('%s:%s(%.1f%%)\n' % (item, format_number(value), value * 100.0 / max(total[of], 1)))
+            else:
+                fh.write('%s:%s\n' % (item, format_number(value)))
+
 def cutadapt(args):
     logging.info('cutadapt ...!')
     # check dir
@@ -58,16 +85,23 @@ def cutadapt(args):
         adapt.append('-a')
         adapt.append(a)
     
-    out_fq2 = args.outdir + '/' + args.sample + '_clean_2.fq.gz'
-    cmd = ['cutadapt'] + adapt + ['-n', str(len(args.adapt)), '-j', str(args.thread), '-m', str(args.minimum_length), '--nextseq-trim=' + str(args.nextseq_trim), '--overlap', str(args.overlap), '-o', out_fq2, args.fq ]
-    logging.info('%s'%(' '.join(cmd)))
-    res = subprocess.run(cmd,stderr=subprocess.STDOUT,stdout=subprocess.PIPE)
-    with open(args.outdir + '/cutadapt.log', 'wb') as fh:
-        fh.write(res.stdout)
+    # one cutadapt run per lane, lanes are comma separated
+    fq_list = args.fq.split(',')
+    out_fq2_list = lane_files(args.outdir + '/' + args.sample, '_clean_2.fq.gz', len(fq_list))
+    log_list = lane_files(args.outdir + '/cutadapt', '.log', len(fq_list))
+    for fq, out_fq2, log in zip(fq_list, out_fq2_list, log_list):
+        cmd = ['cutadapt'] + adapt + ['-n', str(len(args.adapt)), '-j', str(args.thread), '-m', str(args.minimum_length), '--nextseq-trim=' + str(args.nextseq_trim), '--overlap', str(args.overlap), '-o', out_fq2, fq ]
+        logging.info('%s'%(' '.join(cmd)))
+        res = subprocess.run(cmd,stderr=subprocess.STDOUT,stdout=subprocess.PIPE)
+        with open(log, 'wb') as fh:
+            fh.write(res.stdout)
     logging.info('cutadapt done!')
 
     logging.info('generate report ...!')
-    format_stat(args.outdir + '/cutadapt.log', args.sample)
+    if len(log_list) == 1:
+        format_stat(log_list[0], args.sample)
+    else:
+        format_stat_lanes(log_list, args.outdir + '/stat.txt')
     from report import reporter
     t = reporter(name='cutadapt', stat_file=args.outdir + '/stat.txt', outdir=args.outdir + '/..')
     t.get_report()
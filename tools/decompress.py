@@ -0,0 +1,102 @@
+#!/bin/env python
+#coding=utf8
+
+"""
+gzip input of the steps, inflated by a separate process that reads ahead
+into a 1MB pipe, so decompression does not run in the thread that parses
+the reads. pigz is used when installed, with --decompressThreads threads
+for reading, writing and checking; gzip otherwise.
+
+    open_input(path, threads)          handle of a fastq, gzip or not (barcode)
+    read_files_command(fq, threads)    the same decompressor for STAR --readFilesCommand
+
+cutadapt is given the gzip file itself, xopen already inflates it with pigz
+in its own process.
+"""
+
+import io
+import os
+import shutil
+import subprocess
+
+BUFFER_SIZE = 1 << 20
+# fcntl.F_SETPIPE_SZ of linux, not in the fcntl module before python 3.10
+F_SETPIPE_SZ = 1031
+DEFAULT_THREADS = 4
+
+
+def is_gzip(path):
+    return path.endswith('.gz')
+
+
+def decompress_command(threads=DEFAULT_THREADS):
+    """
+    command writing the content of a gzip file to stdout
+    """
+    if shutil.which('pigz'):
+        return ['pigz', '-dc', '-p', str(threads)]
+    return ['gzip', '-dc']
+
+
+def read_files_command(fq, threads=DEFAULT_THREADS):
+    """
+    --readFilesCommand of STAR for the comma separated fq, None for plain files
+    """
+    if any(is_gzip(f) for f in fq.split(',')):
+        return decompress_command(threads)
+    return None
+
+
+def _read_ahead(fd, size=BUFFER_SIZE):
+    # a larger pipe lets the decompressor run further ahead, best effort
+    try:
+        import fcntl
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except (ImportError, IOError, OSError):
+        pass
+
+
+def _check(process, path):
+    if process.wait() != 0:
+        raise IOError('decompressing %s failed, exit status %s' % (path, process.returncode))
+
+
+class PipedInput:
+    """
+    text (or bytes, mode 'rb') lines of the stdout of a decompressor.
+    a decompressor failing midway, e.g. on a truncated file, raises at the
+    end of the iteration instead of looking like the end of the file
+    """
+    def __init__(self, path, threads=DEFAULT_THREADS, mode='r'):
+        self.path = path
+        self.process = subprocess.Popen(decompress_command(threads) + [path],
+            stdout=subprocess.PIPE, bufsize=BUFFER_SIZE)
+        _read_ahead(self.process.stdout.fileno())
+        self.fh = self.process.stdout if 'b' in mode else io.TextIOWrapper(self.process.stdout)
+
+    def __iter__(self):
+        for line in self.fh:
+            yield line
+        _check(self.process, self.path)
+
+    def close(self):
+        self.fh.close()
+        if self.process.poll() is None:
+            # closed before the end
+            self.process.kill()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_input(path, threads=DEFAULT_THREADS, mode='r'):
+    """
+    handle of path, through a decompressor when it is gzip
+    """
+    if is_gzip(path):
+        return PipedInput(path, threads, mode)
+    return open(path, mode, buffering=BUFFER_SIZE)
@@ -4,23 +4,16 @@
 import os, re
 import logging
 import subprocess
+from collections import OrderedDict
+import pysam
 from utils import format_number
+from annotation import build_feature_index
+from opts import get_opts4
+from profiler import phase
 
 FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 logging.basicConfig(level = logging.INFO, format = FORMAT)
 
-def get_opts4(parser,sub_program): 
-
-    parser.add_argument('--thread', default=2)
-    parser.add_argument('--annot', required=True)
-    parser.add_argument('--type', help='Specify feature type in GTF annotation', default='exon')
-    if sub_program:
-        parser.add_argument('--input', required=True)
-        #parser.add_argument('--format', default='BAM')
-        parser.add_argument('--outdir', help='output dir',required=True)
-        parser.add_argument('--sample', help='sample name', required=True)
-
-
 def format_stat(log, samplename):
     #Assigned, Unassigned_NoFeatures, Unassigned_Ambiguity=(0, 0, 0)
     tmp_arr = []
@@ -47,6 +40,54 @@ def format_stat(log, samplename):
             stat_fh.write('%s: %s\n'%(t, s))
     fh.close()
 
+def assign_genes(bam, gtf_file, feature_type, out_bam, summary_file):
+    """
+    assign reads to genes in-process and pipe them into samtools sort -n
+
+    Tags follow featureCounts -R BAM: XS status, XN number of overlapped genes,
+    XT assigned geneID. Stat is written in featureCounts .summary format.
+    """
+    index = build_feature_index(gtf_file, feature_type)
+    logging.info('feature index built!')
+
+    stat = OrderedDict([('Assigned', 0), ('Unassigned_Unmapped', 0), ('Unassigned_MultiMapping', 0),
+        ('Unassigned_NoFeatures', 0), ('Unassigned_Ambiguity', 0)])
+    samfile = pysam.AlignmentFile(bam, 'rb')
+    cmd = ['samtools', 'sort', '-n', '-@', '3', '-o', out_bam, '-']
+    logging.info('%s'%(' '.join(cmd)))
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    outfile = pysam.AlignmentFile(p.stdin, 'wbu', template=samfile)
+    for seg in samfile.fetch(until_eof=True):
+        if seg.is_unmapped:
+            status = 'Unassigned_Unmapped'
+        elif seg.is_secondary or (seg.has_tag('NH') and seg.get_tag('NH') > 1):
+            status = 'Unassigned_MultiMapping'
+        else:
+            chrom = seg.reference_name
+            genes = set()
+            for start, end in seg.get_blocks():
+                genes |= index.query(chrom, start, end)
+            if len(genes) == 1:
+                status = 'Assigned'
+                seg.set_tag('XT', genes.pop(), value_type='Z')
+            elif genes:
+                status = 'Unassigned_Ambiguity'
+            else:
+                status = 'Unassigned_NoFeatures'
+            seg.set_tag('XN', len(genes), value_type='i')
+        seg.set_tag('XS', status, value_type='Z')
+        stat[status] += 1
+        outfile.write(seg)
+    outfile.close()
+    p.stdin.close()
+    if p.wait() != 0:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+
+    with open(summary_file, 'w') as fh:
+        fh.write('Status\t%s\n' % (bam))
+        for k, v in stat.items():
+            fh.write('%s\t%s\n' % (k, v))
+
 def featureCounts(args):
     """
     """
@@ -55,11 +96,21 @@ def featureCounts(args):
     if not os.path.exists(args.outdir):
         os.mkdir(args.outdir)
 
-    # run featureCounts
     outPrefix = args.outdir + '/' + args.sample
+    if args.assignEngine == 'native':
+        # assign and sort by name:BC and umi, without the intermediate featureCounts bam
+        logging.info('assign genes ...!')
+        with phase('assign_genes'):
+            assign_genes(args.input, args.annot, args.type, outPrefix+'_name_sorted.bam', outPrefix+'.summary')
+        logging.info('assign genes done!')
+        featureCounts_report(args)
+        return
+
+    # run featureCounts
     cmd = ['featureCounts', '-a', args.annot, '-o', outPrefix, '-R', 'BAM', '-T', str(args.thread),'-t',args.type , args.input]
     logging.info('%s'%(' '.join(cmd)))
-    subprocess.check_call(cmd)
+    with phase('featureCounts'):
+        subprocess.check_call(cmd)
     logging.info('featureCounts done!')
 
     subprocess.check_call(['which', 'samtools'])
@@ -69,9 +120,13 @@ def featureCounts(args):
     bam_basename = os.path.basename(args.input)
     cmd = ['samtools', 'sort', '-n', '-@','3', '-o', outPrefix+'_name_sorted.bam', args.outdir + '/' + bam_basename + '.featureCounts.bam']
     logging.info('%s'%(' '.join(cmd)))
-    subprocess.check_call(cmd)
+    with phase('samtools_sort'):
+        subprocess.check_call(cmd)
     logging.info('samtools sort done!')
 
+    featureCounts_report(args)
+
+def featureCounts_report(args):
     logging.info('generate report ...!')
     format_stat(args.outdir+'/'+args.sample+'.summary', args.sample)
     from report import reporter
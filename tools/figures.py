@@ -0,0 +1,115 @@
+#!/bin/env python
+#coding=utf8
+
+"""
+figures drawn after the steps, when the html report is assembled.
+
+a step only records what to draw with defer_figure: a small spec, e.g. a
+log-binned rank curve instead of every barcode, kept in the report fragment
+'figures'. render_figures draws the specs with matplotlib, closes each
+figure and caches it in .report/figures under the hash of its spec, so a
+report rebuilt from unchanged data draws nothing.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+
+import numpy as np
+from report import fragment_dir, load_fragment, load_arrays, resolve_arrays, update_fragment
+
+# bump when the look of a figure changes, so cached ones are drawn again
+FIGURE_VERSION = 1
+
+
+def rank_curve(n, n_points=500):
+    """
+    log-spaced 1-based ranks out of n
+    """
+    if n == 0:
+        return np.array([], dtype=int)
+    return np.unique(np.geomspace(1, n, num=min(n, n_points)).round().astype(int))
+
+
+def binned_rank_curve(values, breaks=(), n_points=500):
+    """
+    ranks and values of a descending curve at log-spaced ranks, plus the
+    ranks at and after each break
+    """
+    ranks = np.union1d(rank_curve(len(values), n_points), [r + d for r in breaks for d in (0, 1)])
+    ranks = ranks[(ranks >= 1) & (ranks <= len(values))]
+    return ranks.tolist(), np.asarray(values)[ranks - 1].tolist()
+
+
+def defer_figure(outdir, name, path, spec):
+    """
+    record figure name, to be drawn to path from spec by render_figures.
+    outdir is the sample dir of the report
+    """
+    update_fragment(outdir, 'figures', {'figure_' + name: {'name': name, 'path': os.path.abspath(path),
+        'spec': spec}})
+
+
+def plot_magnitude(spec, ax):
+    # cell calling of count.barcode_filter_with_magnitude
+    ax.plot(spec['ranks'], spec['values'])
+    ax.hlines(spec['threshold'], 1, max(spec['cell_num'], 1), linestyle='dashed')
+    ax.vlines(max(spec['cell_num'], 1), 1, spec['threshold'], linestyle='dashed')
+    ax.set_title('expected cell num: %s\n%s threshold: %s\ncell num: %s' % (
+        spec['expected_cell_num'], spec['col'], spec['threshold'], spec['cell_num']))
+    ax.loglog()
+
+
+PLOTS = {
+    'barcode_filter_magnitude': plot_magnitude,
+}
+
+
+def spec_hash(name, spec):
+    text = json.dumps([FIGURE_VERSION, name, spec], sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def render_figures(outdir):
+    """
+    draw the deferred figures of outdir that are not cached yet and copy
+    them to their paths. returns the names of the figures drawn
+    """
+    figures = load_fragment(outdir, 'figures')
+    if not figures:
+        return []
+    figures = resolve_arrays(figures, load_arrays(outdir, 'figures'))
+    cache_dir = fragment_dir(outdir) + '/figures'
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    drawn = []
+    plt = None
+    for figure in figures.values():
+        name, path = figure['name'], figure['path']
+        if name not in PLOTS:
+            logging.warning('unknown figure %s' % (name))
+            continue
+        ext = os.path.splitext(path)[1] or '.pdf'
+        cached = '%s/%s.%s%s' % (cache_dir, name, spec_hash(name, figure['spec']), ext)
+        if not os.path.exists(cached):
+            # figures of earlier specs
+            for f in os.listdir(cache_dir):
+                if f.startswith(name + '.'):
+                    os.remove(cache_dir + '/' + f)
+            if plt is None:
+                import matplotlib
+                matplotlib.use('Agg')
+                import matplotlib.pyplot as plt
+            fig, ax = plt.subplots()
+            try:
+                PLOTS[name](figure['spec'], ax)
+                fig.savefig(cached)
+            finally:
+                plt.close(fig)
+            drawn.append(name)
+        if os.path.isdir(os.path.dirname(path)):
+            shutil.copyfile(cached, path)
+    return drawn
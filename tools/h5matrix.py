@@ -0,0 +1,132 @@
+#!/bin/env python
+#coding=utf8
+
+"""
+count matrix as chunked, compressed HDF5 (needs h5py).
+
+the layout follows the 10x Genomics feature-barcode matrix, so tools that
+read those files read this one too:
+
+    /matrix/data, indices, indptr, shape   genes x cells CSC, one column per cell
+    /matrix/barcodes
+    /matrix/features/id, name, feature_type, genome
+    /matrix_by_gene/data, indices, indptr  the same counts CSR, one row per gene
+    /cell_qc/{column}                      per cell columns of {sample}_counts.txt
+
+read_cells/read_genes only read the indptr and the ranges of the cells or
+genes asked for.
+"""
+
+import numpy as np
+from scipy import sparse
+
+CHUNK = 1 << 16
+
+
+def _dataset(group, name, values):
+    values = np.asarray(values)
+    if values.dtype.kind == 'U':
+        values = values.astype('S')
+    if values.ndim == 1 and len(values) > 0:
+        group.create_dataset(name, data=values, chunks=(min(len(values), CHUNK),),
+            compression='gzip', compression_opts=4, shuffle=True)
+    else:
+        group.create_dataset(name, data=values)
+
+
+def _write_compressed(group, matrix):
+    _dataset(group, 'data', matrix.data.astype(np.int32))
+    _dataset(group, 'indices', matrix.indices.astype(np.int32))
+    _dataset(group, 'indptr', matrix.indptr.astype(np.int64))
+
+
+def write_h5(h5_file, matrix, barcodes, gene_ids, gene_names=None, cell_qc=None):
+    """
+    matrix: genes x cells sparse counts. cell_qc: DataFrame indexed by barcode
+    """
+    import h5py
+    matrix = sparse.csc_matrix(matrix)
+    with h5py.File(h5_file, 'w') as fh:
+        group = fh.create_group('matrix')
+        _write_compressed(group, matrix)
+        group.create_dataset('shape', data=np.array(matrix.shape, dtype=np.int32))
+        _dataset(group, 'barcodes', barcodes)
+        features = group.create_group('features')
+        _dataset(features, 'id', gene_ids)
+        _dataset(features, 'name', gene_names if gene_names is not None else gene_ids)
+        _dataset(features, 'feature_type', ['Gene Expression'] * len(gene_ids))
+        _dataset(features, 'genome', [''] * len(gene_ids))
+        _write_compressed(fh.create_group('matrix_by_gene'), matrix.tocsr())
+        if cell_qc is not None:
+            qc = fh.create_group('cell_qc')
+            cell_qc = cell_qc.reindex(barcodes)
+            for column in cell_qc.columns:
+                _dataset(qc, column, cell_qc[column].values)
+
+
+def _decode(values):
+    return np.array([v.decode() if isinstance(v, bytes) else v for v in values])
+
+
+def _positions(selection, names, n):
+    # positions of a slice, of indices or of names
+    if isinstance(selection, slice):
+        return np.arange(n)[selection]
+    selection = np.asarray(selection)
+    if selection.dtype.kind in 'iu':
+        return selection
+    index = dict((name, i) for i, name in enumerate(names))
+    return np.array([index[s] for s in selection], dtype=int)
+
+
+def _read_ranges(group, positions):
+    """
+    data and indices of the compressed rows/columns at positions, reading
+    runs of consecutive positions in one go
+    """
+    indptr = group['indptr'][:]
+    starts, ends = indptr[positions], indptr[positions + 1]
+    data, indices = [], []
+    i = 0
+    while i < len(positions):
+        j = i
+        while j + 1 < len(positions) and positions[j + 1] == positions[j] + 1:
+            j += 1
+        data.append(group['data'][starts[i]:ends[j]])
+        indices.append(group['indices'][starts[i]:ends[j]])
+        i = j + 1
+    new_indptr = np.concatenate([[0], np.cumsum(ends - starts)])
+    if not data:
+        return np.array([], dtype=np.int32), np.array([], dtype=np.int32), new_indptr
+    return np.concatenate(data), np.concatenate(indices), new_indptr
+
+
+def read_cells(h5_file, cells=slice(None)):
+    """
+    genes x cells csc counts of some cells: a slice, positions or barcodes.
+    returns the matrix and the barcodes
+    """
+    import h5py
+    with h5py.File(h5_file, 'r') as fh:
+        group = fh['matrix']
+        n_genes, n_cells = group['shape'][:]
+        barcodes = _decode(group['barcodes'][:])
+        positions = _positions(cells, barcodes, n_cells)
+        data, indices, indptr = _read_ranges(group, positions)
+    matrix = sparse.csc_matrix((data, indices, indptr), shape=(n_genes, len(positions)))
+    return matrix, barcodes[positions]
+
+
+def read_genes(h5_file, genes=slice(None)):
+    """
+    genes x cells csr counts of some genes: a slice, positions or gene ids.
+    returns the matrix and the gene ids
+    """
+    import h5py
+    with h5py.File(h5_file, 'r') as fh:
+        n_genes, n_cells = fh['matrix/shape'][:]
+        gene_ids = _decode(fh['matrix/features/id'][:])
+        positions = _positions(genes, gene_ids, n_genes)
+        data, indices, indptr = _read_ranges(fh['matrix_by_gene'], positions)
+    matrix = sparse.csr_matrix((data, indices, indptr), shape=(len(positions), n_cells))
+    return matrix, gene_ids[positions]
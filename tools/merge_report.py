@@ -9,37 +9,52 @@ import matplotlib
 matplotlib.use('Agg')
 from matplotlib import pyplot as plt
 from collections import defaultdict
-
-parser = argparse.ArgumentParser('merge report')
-parser.add_argument('--samples', help='samples, seperated by comma', required=True)
-parser.add_argument('--workdir', help='working dir', required=True)
-args = vars(parser.parse_args())
-
-samples = args['samples'].split(',')
-data_json = [args['workdir'] + '/' + s + '/' + '.data.json' for s in samples]
-result_dict = defaultdict(list)
+from multiprocessing import Pool
+from report import load_fragment, load_data
 
 def pie_label(values, keys):
     total = float(sum(values))
     return ['%s:%.2f%%'%(k.replace(' Regions',''), v/total*100) for k, v in zip(keys, values)]
 
-for n, i in zip(samples, data_json):
-    tmp = json.load(open(i))
-    
+def plot_pie(params):
+    n, sample_dir = params
+    # STAR_plot is small, the rest of the sample report is not loaded
+    tmp = load_fragment(sample_dir, 'STAR') or load_data(sample_dir)
+
     # pie
-    patches, texts = plt.pie(tmp['STAR_plot']['region_values'])
-    plt.legend(patches, pie_label(tmp['STAR_plot']['region_values'], tmp['STAR_plot']['region_labels']),bbox_to_anchor=(1,0.5), loc="center right")
-    plt.savefig(n+'_pie.png', bbox_inches="tight", dpi=300)
-    plt.clf()
+    fig, ax = plt.subplots()
+    patches, texts = ax.pie(tmp['STAR_plot']['region_values'])
+    ax.legend(patches, pie_label(tmp['STAR_plot']['region_values'], tmp['STAR_plot']['region_labels']),bbox_to_anchor=(1,0.5), loc="center right")
+    fig.savefig(n+'_pie.png', bbox_inches="tight", dpi=300)
+    plt.close(fig)
 
     #ax.pie(tmp['STAR_plot']['region_values'], labels=tmp['STAR_plot']['region_labels'])
 
-with open(args['workdir']+'/merge.xls', 'w') as fh:
-    for j in ['barcode_summary', 'cutadapt_summary', 'STAR_summary', 'featureCounts_summary', 'count_summary']:
-        fh.write('##' + j + '\n')
-        for k in result_dict[j]:
-            fh.write(k + '\n')
-        fh.write('\n')
+def main():
+    parser = argparse.ArgumentParser('merge report')
+    parser.add_argument('--samples', help='samples, seperated by comma', required=True)
+    parser.add_argument('--workdir', help='working dir', required=True)
+    parser.add_argument('--thread', type=int, help='parallel plotting workers, default=4', default=4)
+    args = vars(parser.parse_args())
+
+    samples = args['samples'].split(',')
+    sample_dirs = [args['workdir'] + '/' + s for s in samples]
+    result_dict = defaultdict(list)
+
+    pool = Pool(args['thread'])
+    pool.map(plot_pie, zip(samples, sample_dirs))
+    pool.close()
+    pool.join()
+
+    with open(args['workdir']+'/merge.xls', 'w') as fh:
+        for j in ['barcode_summary', 'cutadapt_summary', 'STAR_summary', 'featureCounts_summary', 'count_summary']:
+            fh.write('##' + j + '\n')
+            for k in result_dict[j]:
+                fh.write(k + '\n')
+            fh.write('\n')
+
+if __name__ == '__main__':
+    main()
 
 '''
 plt.pie(x['STAR_plot']['region_values'], labels=x['STAR_plot']['region_labels'])
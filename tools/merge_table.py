@@ -3,37 +3,106 @@
 
 import os
 import sys
+import re
 import json
 import argparse
-import matplotlib
-matplotlib.use('Agg')
-from matplotlib import pyplot as plt
-from collections import defaultdict
-
-parser = argparse.ArgumentParser('merge report')
-parser.add_argument('--samples', help='samples, seperated by comma', required=True)
-parser.add_argument('--workdir', help='working dir', required=True)
-args = vars(parser.parse_args())
-
-samples = args['samples'].split(',')
-data_json = [args['workdir'] + '/' + s + '/' + '.data.json' for s in samples]
-result_dict = defaultdict(list)
-
-def pie_label(values, keys):
-    total = float(sum(values))
-    return ['%s:%.2f%%'%(k.replace(' Regions',''), v/total*100) for k, v in zip(keys, values)]
-
-for n, i in zip(samples, data_json):
-    tmp = json.load(open(i))
-    for j in ['sample_summary','barcode_summary', 'cutadapt_summary', 'STAR_summary', 'featureCounts_summary', 'count_summary']:
-        if n==samples[0]: 
-            result_dict[j].append('\t'.join([x[0].replace(' ','') for x in tmp[j]]))
-        result_dict[j].append('\t'.join([x[1].replace(' ','') for x in tmp[j]]))
-    
-with open(args['workdir']+'/merge.xls', 'w') as fh:
-    for j in ['sample_summary','barcode_summary', 'cutadapt_summary', 'STAR_summary', 'featureCounts_summary', 'count_summary']:
-        fh.write('##' + j + '\n')
-        for k in result_dict[j]:
-            fh.write(k + '\n')
-        fh.write('\n')
+import logging
+from multiprocessing import Pool
+from collections import defaultdict, OrderedDict
 
+import pandas as pd
+from report import load_fragment, load_data, fragment_dir
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(level = logging.INFO, format = FORMAT)
+
+STEPS = ['sample', 'barcode', 'cutadapt', 'STAR', 'featureCounts', 'count']
+
+def read_summary(sample_dir):
+    """
+    read only the *_summary sections of one sample
+    """
+    summary = {}
+    if os.path.exists(fragment_dir(sample_dir)):
+        for step in STEPS:
+            key = step + '_summary'
+            summary[key] = load_fragment(sample_dir, step).get(key, [])
+    else:
+        data = load_data(sample_dir)
+        for step in STEPS:
+            key = step + '_summary'
+            summary[key] = data.get(key, [])
+    return summary
+
+def parse_value(value):
+    """
+    '1,234(56.78%)' -> (1234, 56.78), '56.78%' -> (None, 56.78), '1,234' -> (1234, None)
+    anything else is kept as a string
+    """
+    value = value.strip()
+    m = re.match(r'^([\d,]+(?:\.\d+)?)(?:\(([\d\.]+)%\))?$', value)
+    if m:
+        number = m.group(1).replace(',', '')
+        number = float(number) if '.' in number else int(number)
+        percent = float(m.group(2)) if m.group(2) else None
+        return number, percent
+    m = re.match(r'^([\d\.]+)%$', value)
+    if m:
+        return None, float(m.group(1))
+    return value, None
+
+def metrics_row(params):
+    sample, sample_dir = params
+    summary = read_summary(sample_dir)
+    row = OrderedDict([('Sample', sample)])
+    for step in STEPS:
+        for item, value in summary[step + '_summary']:
+            item = item.strip()
+            number, percent = parse_value(str(value))
+            if number is not None:
+                row[item] = number
+            if percent is not None:
+                row[item + '(%)'] = percent
+    return summary, row
+
+def main():
+    parser = argparse.ArgumentParser('merge report')
+    parser.add_argument('--samples', help='samples, seperated by comma', required=True)
+    parser.add_argument('--workdir', help='working dir', required=True)
+    parser.add_argument('--thread', type=int, help='parallel readers, default=4', default=4)
+    args = vars(parser.parse_args())
+
+    samples = args['samples'].split(',')
+    sample_dirs = [args['workdir'] + '/' + s for s in samples]
+
+    pool = Pool(args['thread'])
+    results = pool.map(metrics_row, zip(samples, sample_dirs))
+    pool.close()
+    pool.join()
+
+    # per section table, same layout as before
+    result_dict = defaultdict(list)
+    for n, (summary, _) in zip(samples, results):
+        for j in ['sample_summary','barcode_summary', 'cutadapt_summary', 'STAR_summary', 'featureCounts_summary', 'count_summary']:
+            if n==samples[0]:
+                result_dict[j].append('\t'.join([x[0].replace(' ','') for x in summary[j]]))
+            result_dict[j].append('\t'.join([x[1].replace(' ','') for x in summary[j]]))
+
+    with open(args['workdir']+'/merge.xls', 'w') as fh:
+        for j in ['sample_summary','barcode_summary', 'cutadapt_summary', 'STAR_summary', 'featureCounts_summary', 'count_summary']:
+            fh.write('##' + j + '\n')
+            for k in result_dict[j]:
+                fh.write(k + '\n')
+            fh.write('\n')
+
+    # typed metrics table, one row per sample
+    df = pd.DataFrame([row for _, row in results])
+    df = df.set_index('Sample')
+    df.to_csv(args['workdir'] + '/merge_metrics.tsv', sep='\t')
+    try:
+        df.to_parquet(args['workdir'] + '/merge_metrics.parquet')
+    except ImportError:
+        logging.info('pyarrow not installed, skip parquet output')
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,8 @@ import re
 from collections import defaultdict
 
 toolsdir = os.path.realpath(sys.path[0] + '/../tools')
+sys.path.insert(0, toolsdir)
+from utils import lane_files
 
 '''
 def parse_map(mapfile):
@@ -34,25 +36,27 @@ def parse_map(mapfile, cells=3000):
             if not line: continue
             if line.startswith('#'): continue
             tmp = line.split()
-            try:
-                pattern1_1 = tmp[1] + '/' + tmp[0] + '*' + '_1.fq.gz'
-                pattern1_2 = tmp[1] + '/' + tmp[0] + '*' + 'R1_*.fastq.gz'
-                pattern2_1 = tmp[1] + '/' + tmp[0] + '*' + '_2.fq.gz'
-                pattern2_2 = tmp[1] + '/' + tmp[0] + '*' + 'R2_*.fastq.gz'
-                fq1 = (glob.glob(pattern1_1) + glob.glob(pattern1_2))[0]
-                fq2 = (glob.glob(pattern2_1) + glob.glob(pattern2_2))[0]
-            except IndexError as e:
-                sys.exit("Error:"+str(e))
-                
-            assert os.path.exists(fq1), '%s not exists!'%(fq1)
-            assert os.path.exists(fq2), '%s not exists!'%(fq2)
-            fq_dict[tmp[2]] = [fq1, fq2]
+            # every lane of the library, a sample may also span several lines
+            pattern1_1 = tmp[1] + '/' + tmp[0] + '*' + '_1.fq.gz'
+            pattern1_2 = tmp[1] + '/' + tmp[0] + '*' + 'R1_*.fastq.gz'
+            pattern2_1 = tmp[1] + '/' + tmp[0] + '*' + '_2.fq.gz'
+            pattern2_2 = tmp[1] + '/' + tmp[0] + '*' + 'R2_*.fastq.gz'
+            fq1_list = sorted(glob.glob(pattern1_1) + glob.glob(pattern1_2))
+            fq2_list = sorted(glob.glob(pattern2_1) + glob.glob(pattern2_2))
+            if not fq1_list or len(fq1_list) != len(fq2_list):
+                sys.exit("Error: %s has %s R1 and %s R2 fastq in %s" % (tmp[0], len(fq1_list), len(fq2_list), tmp[1]))
+
+            for fq1, fq2 in zip(fq1_list, fq2_list):
+                assert os.path.exists(fq1), '%s not exists!'%(fq1)
+                assert os.path.exists(fq2), '%s not exists!'%(fq2)
+                fq_dict[tmp[2]].append([fq1, fq2])
 
             if re.match(r'\d+$', tmp[-1]):
                 cells_dict[tmp[2]] = tmp[-1]
             else:
                 cells_dict[tmp[2]] = cells
-            sample_arr.append(tmp[2])
+            if tmp[2] not in sample_arr:
+                sample_arr.append(tmp[2])
 
     return fq_dict, sample_arr, cells_dict
 
@@ -100,9 +104,10 @@ def main():
     os.system('mkdir -p %s'%(raw_dir))
     with open(raw_dir + '/ln.sh', 'w') as fh:
         fh.write('cd %s\n'%(raw_dir))
-        for s, arr in fq_dict.items():
-            fh.write('ln -sf %s %s\n'%(arr[0], s + '_1.fq.gz'))
-            fh.write('ln -sf %s %s\n'%(arr[1], s + '_2.fq.gz'))
+        for s, lanes in fq_dict.items():
+            for arr, fq1, fq2 in zip(lanes, lane_files(s, '_1.fq.gz', len(lanes)), lane_files(s, '_2.fq.gz', len(lanes))):
+                fh.write('ln -sf %s %s\n'%(arr[0], fq1))
+                fh.write('ln -sf %s %s\n'%(arr[1], fq2))
     #os.system('sh %s'%(raw_dir+'/ln.sh'))
 
     logdir = args['outdir']+'/log'
@@ -110,6 +115,11 @@ def main():
     sjm_cmd = 'log_dir %s\n'%(logdir)
     sjm_order = ''
 
+    # annotation store, compiled once and shared by all samples
+    cmd = '''conda activate scope1.0; python {app} annotation --annot {annot};'''.format(
+        app = toolsdir + '/scope.py', annot=args['annot'])
+    sjm_cmd += generate_sjm(cmd, 'annotation', m=4)
+
     for n in sample_arr:
         # sample
         outdir = '{basedir}/{sampledir}/{step}'.format(basedir = args['outdir'], sampledir = n, step='00.sample')
@@ -119,12 +129,12 @@ def main():
         sjm_cmd += generate_sjm(cmd, 'sample_'+n)
 
         # barcode
-        arr = fq_dict[n]
+        lanes = fq_dict[n]
         outdir = '{basedir}/{sampledir}/{step}'.format(basedir = args['outdir'], sampledir = n, step='01.barcode')
         cmd = '''conda activate scope1.0; python {app} barcode --fq1 {fq1} --fq2 {fq2} --pattern {pattern} 
                 --whitelist {whitelist} --linker {linker} --sample {samplename} --lowQual {lowQual} 
                 --lowNum {lowNum} --outdir {outdir};'''.format(
-            app = toolsdir + '/scope.py', fq1 = arr[0], fq2 =arr[1], pattern=args['pattern'], 
+            app = toolsdir + '/scope.py', fq1 = ','.join([arr[0] for arr in lanes]), fq2 = ','.join([arr[1] for arr in lanes]), pattern=args['pattern'], 
             whitelist=args['whitelist'], linker=args['linker'], samplename=n, 
             lowQual=args['lowQual'], lowNum=args['lowNum'], outdir=outdir
         )
@@ -132,7 +142,7 @@ def main():
         sjm_order += 'order barcode_%s after sample_%s\n'%(n, n)
 
         # adapt
-        fq = outdir + '/' + n + '_2.fq.gz'
+        fq = ','.join(lane_files(outdir + '/' + n, '_2.fq.gz', len(lanes)))
         outdir = '{basedir}/{sampledir}/{step}'.format(basedir = args['outdir'], sampledir = n, step='02.cutadapt')
         cmd = '''conda activate scope1.0; python {app} cutadapt --fq {fq} --sample {samplename} --outdir 
             {outdir}'''.format( app = toolsdir + '/scope.py', fq=fq, samplename = n, outdir = outdir)
@@ -140,7 +150,7 @@ def main():
         sjm_order += 'order adapt_%s after barcode_%s\n'%(n, n)
 
         # STAR
-        fq = outdir + '/' + n + '_clean_2.fq.gz'
+        fq = ','.join(lane_files(outdir + '/' + n, '_clean_2.fq.gz', len(lanes)))
         outdir = '{basedir}/{sampledir}/{step}'.format(basedir = args['outdir'], sampledir = n, step='03.STAR')
         cmd = '''conda activate scope1.0; python {app} STAR --fq {fq} --sample {samplename} --refFlat {refFlat} 
         --genomeDir {genomeDir} --thread 8 --outdir {outdir}'''.format(
@@ -158,6 +168,7 @@ def main():
                 app = toolsdir + '/scope.py', bam=bam, annot=args['annot'], samplename=n, type=args['type'], outdir = outdir)
         sjm_cmd += generate_sjm(cmd, 'featureCounts_' + n, m=8, x=8)
         sjm_order += 'order featureCounts_%s after STAR_%s\n'%(n, n)
+        sjm_order += 'order featureCounts_%s after annotation\n'%(n)
 
         # count
         bam = outdir + '/' + n + '_name_sorted.bam'
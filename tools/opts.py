@@ -0,0 +1,151 @@
+#!/bin/env python
+#coding=utf8
+
+# argument registration of every step, kept free of heavy imports so that
+# scope.py can build all subparsers without loading the step modules
+
+__VERSION__ = "CeleScope V1.0.0"
+
+
+def get_opts_progress(parser):
+    parser.add_argument('--progressInterval', type=int,
+        help='seconds between progress logs of long loops, 0 to disable, default=60', default=60)
+    parser.add_argument('--statusFile', help='json file rewritten with the progress, for schedulers to poll')
+
+
+def get_opts_input(parser):
+    parser.add_argument('--decompressThreads', type=int,
+        help='threads of pigz for each gzip input of barcode and STAR, default=4', default=4)
+
+
+def get_opts0(parser,sub_program):
+    if sub_program:
+        parser.add_argument('--outdir', help='output dir',required=True)
+        parser.add_argument('--sample', help='sample name', required=True)
+        parser.add_argument('--genomeDir', help='genomeDir', required=True)
+    parser.add_argument('--description', help='sample description',default="scRNA-Seq")
+    parser.add_argument('--version', help='software version',default=__VERSION__)
+
+
+def get_opts1(parser,sub_program):
+    parser.add_argument('--outdir', help='output dir',required=True)
+    parser.add_argument('--sample', help='sample name', required=True)
+    parser.add_argument('--fq1', help='read1 fq file, lanes seperated by comma', required=True)
+    parser.add_argument('--fq2', help='read2 fq file, lanes seperated by comma, same order as fq1', required=True)
+    parser.add_argument('--bcType', help='chemistry name in data/chemistry.json or --chemistryFile, e.g. scope, dropseq, test')
+    parser.add_argument('--chemistryFile', help='json of extra chemistries, same format as data/chemistry.json')
+    parser.add_argument('--pattern', help='read1 pattern, e.g. C8L16C8L16C8L1U8T18, used without --bcType')
+    parser.add_argument('--whitelist', help='barcode whitelist, or one whitelist per C segment seperated by comma')
+    parser.add_argument('--linker', help='linker list, or one list per L segment seperated by comma')
+    parser.add_argument('--lowQual', type=int, help='max phred of base as lowQual, default=0', default=0)
+    parser.add_argument('--lowNum', type=int, help='max number with lowQual allowed, default=2', default=2)
+    parser.add_argument('--nopolyT', action='store_true', help='output nopolyT fq')
+    parser.add_argument('--noLinker', action='store_true', help='output noLinker fq')
+    parser.add_argument('--thread', default=2)
+    parser.add_argument('--sketchSize', type=int,
+        help='barcodes tracked in whitelist-free mode, memory is bounded by twice this, default=100000',
+        default=100000)
+    get_opts_progress(parser)
+    get_opts_input(parser)
+    return parser
+
+
+def get_opts2(parser,sub_program):
+    if sub_program:
+        parser.add_argument('--fq', help='fq file, lanes seperated by comma', required=True)
+        parser.add_argument('--outdir', help='output dir',required=True)
+        parser.add_argument('--sample', help='sample name', required=True)
+    parser.add_argument('--adapt', action='append', default=['polyT=A{18}', 'p5=AGATCGGAAGAGCACACGTCTGAACTCCAGTCAC',])
+    parser.add_argument('--minimum-length', dest='minimum_length', help='minimum_length, default=20', default=20)
+    parser.add_argument('--nextseq-trim', dest='nextseq_trim', help='nextseq_trim, default=20', default=20)
+    parser.add_argument('--overlap', help='minimum overlap length, default=5', default=5)
+    parser.add_argument('--thread', default=2)
+
+
+def get_opts3(parser,sub_program):
+    if sub_program:
+        parser.add_argument('--fq', help='fq file, lanes seperated by comma', required=True)
+        parser.add_argument('--readFilesCommand',
+            help='STAR --readFilesCommand, default the decompressor of --decompressThreads for gzip fq')
+        parser.add_argument('--outdir', help='output dir',required=True)
+        parser.add_argument('--sample', help='sample name', required=True)
+    parser.add_argument('--thread', default=2)
+    parser.add_argument('--refFlat', help='refFlat, for stat mapping region', required=True)
+    parser.add_argument('--genomeDir')
+    parser.add_argument('--regionEngine', help='mapping region stat engine, default=native',
+        choices=['native', 'picard'], default='native')
+    get_opts_input(parser)
+
+
+def get_opts4(parser,sub_program):
+
+    parser.add_argument('--thread', default=2)
+    parser.add_argument('--annot', required=True)
+    parser.add_argument('--type', help='Specify feature type in GTF annotation', default='exon')
+    parser.add_argument('--assignEngine', help='gene assignment engine, default=native',
+        choices=['native', 'featureCounts'], default='native')
+    if sub_program:
+        parser.add_argument('--input', required=True)
+        #parser.add_argument('--format', default='BAM')
+        parser.add_argument('--outdir', help='output dir',required=True)
+        parser.add_argument('--sample', help='sample name', required=True)
+
+
+def get_opts5(parser, sub_program):
+    if sub_program:
+        parser.add_argument('--outdir', help='output dir', required=True)
+        parser.add_argument('--sample', help='sample name', required=True)
+        parser.add_argument('--bam', required=True)
+        parser.add_argument('--annot', help='gtf, gene names of the h5 matrix')
+    parser.add_argument('--thread', default=2)
+    parser.add_argument('--cells', type=int, default=3000)
+    parser.add_argument('--h5', action='store_true',
+        help='also write the matrix as compressed HDF5 {sample}_matrix.h5, needs h5py')
+    parser.add_argument('--targetSaturation', type=float,
+        help='saturation percent to predict the reads needed for, default=80', default=80)
+    parser.add_argument('--targetGenes', type=int,
+        help='median genes per cell to predict the reads needed for')
+    get_opts_progress(parser)
+
+
+def get_opts_topup(parser, sub_program):
+    if sub_program:
+        parser.add_argument('--outdir', help='count dir of the sample to top up', required=True)
+        parser.add_argument('--sample', help='sample name', required=True)
+        parser.add_argument('--topupDir', help='outdir of the top-up run, run through featureCounts',
+            required=True)
+    else:
+        parser.add_argument('--topupOf', help='outdir of an earlier run of the sample: run this one through '
+            'featureCounts, merge its counts into it and redo count and analysis there')
+
+
+def get_opts6(parser, sub_program):
+    if sub_program:
+        parser.add_argument('--outdir', help='output dir', required=True)
+        parser.add_argument('--sample', help='sample name', required=True)
+        parser.add_argument('--matrix_file', help='matrix file',required=True)
+        parser.add_argument('--annot', help='gtf',required=True)
+    parser.add_argument('--backend', help='analysis backend, python works on the sparse matrix in process, '
+        'R runs Seurat in run_analysis.R, default=python', choices=['python', 'R'], default='python')
+    parser.add_argument('--thread', default=2)
+
+
+def get_opts_annotation(parser, sub_program):
+    if sub_program:
+        parser.add_argument('--annot', help='gtf', required=True)
+
+
+def get_opts_aggregate(parser, sub_program):
+    if sub_program:
+        parser.add_argument('--samples', help='samples, seperated by comma', required=True)
+        parser.add_argument('--workdir', help='working dir, parent of the sample dirs', required=True)
+    parser.add_argument('--outPrefix', help='output prefix, default={workdir}/aggr')
+    parser.add_argument('--normalize', help='none, or mapped to downsample the reads of every sample to the '
+        'mean reads per cell of the shallowest one, default=none', choices=['none', 'mapped'], default='none')
+    parser.add_argument('--seed', type=int, help='random seed of the downsampling, default=0', default=0)
+    parser.add_argument('--h5', action='store_true', help='also write {outPrefix}_matrix.h5, needs h5py')
+
+
+def get_opts_report(parser, sub_program):
+    if sub_program:
+        parser.add_argument('--outdir', help='sample output dir, parent of the step dirs', required=True)
@@ -0,0 +1,92 @@
+#!/bin/env python
+#coding=utf8
+
+import os
+import json
+import time
+import logging
+import resource
+from contextlib import contextmanager
+
+# phases of the running step, None when profiling is off so that phase()
+# costs nothing in normal runs
+_phases = None
+_depth = 0
+
+
+def _usage():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'wall': time.time(),
+        'cpu': self_usage.ru_utime + self_usage.ru_stime,
+        'max_rss': self_usage.ru_maxrss,
+        'children_cpu': children_usage.ru_utime + children_usage.ru_stime,
+        'children_max_rss': children_usage.ru_maxrss,
+    }
+
+
+@contextmanager
+def phase(name):
+    """
+    record wall time, cpu time and peak rss of a block.
+
+    child cpu time covers every subprocess (STAR, samtools, Rscript, pool workers)
+    waited for during the block. ru_maxrss can not be reset, so the peak rss is
+    the peak of the process, or of its largest child, up to the end of the block
+    """
+    global _depth
+    if _phases is None:
+        yield
+        return
+    record = {'name': name, 'depth': _depth}
+    _phases.append(record)
+    start = _usage()
+    _depth += 1
+    try:
+        yield
+    finally:
+        _depth -= 1
+        end = _usage()
+        record['wall_time'] = round(end['wall'] - start['wall'], 3)
+        record['cpu_time'] = round(end['cpu'] - start['cpu'], 3)
+        record['children_cpu_time'] = round(end['children_cpu'] - start['children_cpu'], 3)
+        # kilobytes on linux
+        record['max_rss_mb'] = round(end['max_rss'] / 1024.0, 1)
+        record['children_max_rss_mb'] = round(end['children_max_rss'] / 1024.0, 1)
+
+
+def run_step(name, func, args):
+    """
+    run one step, profiled with --profile. phases go to {outdir}/{name}_profile.json
+    and to the report fragment profile_{name}
+    """
+    global _phases
+    if not getattr(args, 'profile', False):
+        return func(args)
+
+    _phases = []
+    start = time.time()
+    try:
+        with phase(name):
+            res = func(args)
+    finally:
+        phases, _phases = _phases, None
+
+    outdir = args.outdir
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    profile = {'step': name, 'start': start, 'phases': phases}
+    with open(outdir + '/' + name + '_profile.json', 'w') as fh:
+        json.dump(profile, fh, indent=2)
+    for p in phases:
+        logging.info('profile %s%s: wall %.1fs, cpu %.1fs, children cpu %.1fs, peak rss %.1fMB' % (
+            '  ' * p['depth'], p['name'], p['wall_time'], p['cpu_time'], p['children_cpu_time'], p['max_rss_mb']))
+
+    from report import update_fragment, render_report
+    report_dir = outdir + '/..'
+    update_fragment(report_dir, 'profile_' + name, {'profile_' + name: profile})
+    # analysis renders the html before its own profile is known
+    if os.path.exists(report_dir + '/report.html'):
+        render_report(report_dir)
+    return res
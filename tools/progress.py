@@ -0,0 +1,118 @@
+#!/bin/env python
+#coding=utf8
+
+import os
+import json
+import time
+import logging
+
+
+def fd_position(path):
+    """
+    bytes of path consumed so far, read from /proc fdinfo of this process or of
+    its children (pigz), so it works whatever decompressor xopen picked.
+    None if the file is not open or /proc is not available
+    """
+    path = os.path.realpath(path)
+    pids = ['self']
+    try:
+        for task in os.listdir('/proc/self/task'):
+            with open('/proc/self/task/%s/children' % (task)) as fh:
+                pids.extend(fh.read().split())
+    except (IOError, OSError):
+        pass
+    for pid in pids:
+        fd_dir = '/proc/%s/fd' % (pid)
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                if os.readlink(fd_dir + '/' + fd) != path:
+                    continue
+                with open('/proc/%s/fdinfo/%s' % (pid, fd)) as fh:
+                    for line in fh:
+                        if line.startswith('pos:'):
+                            return int(line.split()[1])
+            except (IOError, OSError, ValueError):
+                continue
+    return None
+
+
+class Progress:
+    """
+    periodic progress of a long read loop.
+
+    the loop calls report() every few thousand reads; it only logs, and writes
+    the status file, once interval seconds have passed. ETA comes from the
+    bytes of the input files consumed, by default looked up in /proc.
+    """
+    def __init__(self, name, inputs, interval=60, status_file=None, position=None):
+        self.name = name
+        self.inputs = inputs
+        self.interval = interval
+        self.status_file = status_file
+        self.position = position or (lambda: self._fd_position())
+        self.size = sum(os.path.getsize(f) for f in inputs)
+        self.start = self.last = time.time()
+
+    def _fd_position(self):
+        positions = [fd_position(f) for f in self.inputs]
+        if None in positions:
+            return None
+        return sum(positions)
+
+    def report(self, reads, counts=None, force=False):
+        """
+        counts: {name: reads}, shown as percent of reads
+        """
+        now = time.time()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = now - self.start
+        status = {
+            'step': self.name,
+            'state': 'done' if force else 'running',
+            'reads': reads,
+            'reads_per_sec': round(reads / elapsed, 1) if elapsed > 0 else None,
+            'elapsed': round(elapsed, 1),
+            'updated': now,
+        }
+        if counts:
+            status['rates'] = dict((k, round(float(v) / reads * 100, 2) if reads else 0) for k, v in counts.items())
+        position = self.position() if not force else self.size
+        if position and self.size:
+            fraction = min(1.0, float(position) / self.size)
+            status['fraction'] = round(fraction, 4)
+            status['eta'] = round(elapsed * (1 - fraction) / fraction, 1)
+
+        msg = '%s: %s reads, %s reads/sec' % (self.name, reads, status['reads_per_sec'])
+        if 'rates' in status:
+            msg += ', ' + ', '.join('%s %.2f%%' % (k, v) for k, v in status['rates'].items())
+        if 'eta' in status and not force:
+            msg += ', %.1f%% of input, ETA %ds' % (status['fraction'] * 100, status['eta'])
+        logging.info(msg)
+
+        if self.status_file:
+            # rename, so a poller never reads half a file
+            tmp = self.status_file + '.tmp'
+            with open(tmp, 'w') as fh:
+                json.dump(status, fh)
+            os.rename(tmp, self.status_file)
+
+    def done(self, reads, counts=None):
+        self.report(reads, counts, force=True)
+
+
+def get_progress(name, inputs, args, position=None):
+    """
+    Progress from the --progressInterval and --statusFile options of a step,
+    None when progress reporting is off
+    """
+    interval = getattr(args, 'progressInterval', 0)
+    if not interval:
+        return None
+    return Progress(name, inputs, interval=interval, status_file=getattr(args, 'statusFile', None),
+        position=position)
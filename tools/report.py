@@ -3,49 +3,150 @@
 
 import os, sys, json
 import argparse
-import pandas as pd
 import io
-from jinja2 import Environment, PackageLoader, select_autoescape, FileSystemLoader
-env = Environment(
-    loader=FileSystemLoader(os.path.dirname(__file__) + '/../templates'),
-    autoescape=select_autoescape(['html', 'xml'])
-)
+import numbers
+from opts import get_opts_report
+
+# numpy and jinja2 are only imported when arrays are written or html is rendered,
+# steps that just write their summary stay cheap to start
+def get_env():
+    from jinja2 import Environment, PackageLoader, select_autoescape, FileSystemLoader
+    return Environment(
+        loader=FileSystemLoader(os.path.dirname(__file__) + '/../templates'),
+        autoescape=select_autoescape(['html', 'xml'])
+    )
+
+# numeric lists at least this long are kept in the .npz sidecar of a fragment
+ARRAY_MIN_LEN = 256
+
+def fragment_dir(outdir):
+    return outdir + '/.report'
+
+def load_fragment(outdir, name):
+    fragment_file = fragment_dir(outdir) + '/' + name + '.json'
+    if not os.path.exists(fragment_file):
+        return {}
+    with open(fragment_file) as fh:
+        return json.load(fh)
+
+def load_arrays(outdir, name):
+    import numpy as np
+    array_file = fragment_dir(outdir) + '/' + name + '.npz'
+    if not os.path.exists(array_file):
+        return {}
+    with np.load(array_file) as npz:
+        return dict(npz.items())
+
+def split_arrays(data, arrays, prefix=''):
+    """
+    move long numeric lists of data into arrays, leaving {"$array": key} references
+    """
+    if isinstance(data, dict):
+        return dict((k, split_arrays(v, arrays, prefix + str(k) + '.')) for k, v in data.items())
+    if isinstance(data, list):
+        if len(data) >= ARRAY_MIN_LEN and all(
+                isinstance(i, numbers.Number) and not isinstance(i, bool) for i in data):
+            import numpy as np
+            key = prefix.rstrip('.')
+            arrays[key] = np.array(data)
+            return {'$array': key}
+        return [split_arrays(v, arrays, prefix + str(i) + '.') for i, v in enumerate(data)]
+    return data
+
+def resolve_arrays(data, arrays):
+    if isinstance(data, dict):
+        if list(data.keys()) == ['$array']:
+            return arrays[data['$array']].tolist()
+        return dict((k, resolve_arrays(v, arrays)) for k, v in data.items())
+    if isinstance(data, list):
+        return [resolve_arrays(v, arrays) for v in data]
+    return data
+
+def update_fragment(outdir, name, data):
+    """
+    merge data into the report fragment of one step, other steps are not touched.
+    the json keeps scalars and references, large arrays go to a compressed .npz
+    """
+    if not os.path.exists(fragment_dir(outdir)):
+        os.makedirs(fragment_dir(outdir))
+    arrays = {}
+    data = split_arrays(data, arrays)
+    if arrays:
+        import numpy as np
+        old_arrays = load_arrays(outdir, name)
+        old_arrays.update(arrays)
+        np.savez_compressed(fragment_dir(outdir) + '/' + name + '.npz', **old_arrays)
+    fragment = load_fragment(outdir, name)
+    fragment.update(data)
+    with open(fragment_dir(outdir) + '/' + name + '.json', 'w') as fh:
+        json.dump(fragment, fh)
+
+def load_data(outdir, arrays=False):
+    """
+    assemble all step fragments, or the .data.json of runs before the
+    fragments. array references are only resolved with arrays=True, the
+    .data.json has its arrays inline
+    """
+    data = {}
+    if os.path.exists(fragment_dir(outdir)):
+        for fragment_file in sorted(os.listdir(fragment_dir(outdir))):
+            if fragment_file.endswith('.json'):
+                name = fragment_file[:-len('.json')]
+                fragment = load_fragment(outdir, name)
+                if arrays:
+                    fragment = resolve_arrays(fragment, load_arrays(outdir, name))
+                data.update(fragment)
+    elif os.path.exists(outdir + '/.data.json'):
+        with open(outdir + '/.data.json') as fh:
+            data = json.load(fh)
+    return data
+
+def render_report(outdir):
+    # figures the steps deferred, drawn once per change of their data
+    from figures import render_figures
+    render_figures(outdir)
+    template = get_env().get_template('base.html')
+    data = load_data(outdir, arrays=True)
+    # all data in one json with the arrays inline, as runs before the
+    # fragments wrote it, for the tools that read it
+    with open(outdir + '/.data.json', 'w') as fh:
+        json.dump(data, fh)
+    # per step profiles of --profile runs, in the order the steps ran
+    profiles = sorted([v for k, v in data.items() if k.startswith('profile_')], key=lambda x: x['start'])
+    if profiles:
+        data['profile_summary'] = profiles
+    with io.open(outdir + '/report.html', 'w',encoding='utf8') as fh:
+        html = template.render(data)
+        fh.write(html)
 
 class reporter:
-    def __init__(self, name, outdir, stat_file=None, plot=None):
+    def __init__(self, name, outdir, stat_file=None, plot=None, render=False):
         self.name = name
         self.stat_file = stat_file
         self.outdir = outdir
         self.plot = plot
+        self.render = render
   
     def get_report(self):
-        template = env.get_template('base.html')
-        json_file = self.outdir + '/.data.json'
-        if not os.path.exists(json_file):
-            data = {}
-        else:
-            fh = open(json_file)
-            data = json.load(fh)
-            #if 'STAR_plot' in data:
-                #data['STAR_plot']['region_labels'] = json.dumps(data['STAR_plot']['region_labels'])
-            fh.close()
-
+        """
+        write this step's report fragment; the html is only assembled by the 
+        last step or by the report command
+        """
+        data = {}
         if self.stat_file:
-            df = pd.read_table(self.stat_file, header=None, sep=':', dtype=str)
-            #data[self.name + '_summary'] = df.T.values.tolist()
-            data[self.name + '_summary'] = df.values.tolist()
+            with open(self.stat_file) as fh:
+                data[self.name + '_summary'] = [line.rstrip('\n').split(':') for line in fh if line.strip()]
   
         if self.plot:
             data[self.name + '_plot'] = self.plot
 
-        with io.open(self.outdir + '/report.html', 'w',encoding='utf8') as fh:
-            html = template.render(data)
-            #fh.write(html.encode('utf-8'))
-            fh.write(html)
+        update_fragment(self.outdir, self.name, data)
+        if self.render:
+            render_report(self.outdir)
+
+def report(args):
+    render_report(args.outdir)
 
-        with open(json_file, 'w') as fh:
-            json.dump(data, fh)
-        
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='report')
     parser.add_argument('--basedir', help='output base dir',required=True)
@@ -83,6 +184,7 @@ if __name__ == "__main__":
             report_prepare(marked_counts_file, downsample_file, outdir + '/..')
 
         if step == "analysis":
+            import pandas as pd
             from analysis import  report_prepare
             tsne_df_file = "{outdir}/tsne_coord.tsv".format(outdir=outdir)
             marker_df_file = "{outdir}/markers.tsv".format(outdir=outdir)
@@ -95,6 +197,7 @@ if __name__ == "__main__":
 
         t = reporter(name=step, stat_file=stat_file, outdir=outdir + '/..')
         t.get_report()
+    render_report(basedir)
 
 
 
@@ -15,40 +15,53 @@ def run(args):
     sample = args.sample
     baseDir = args.outdir    
 
+    # each step is profiled into its own dir with --profile
+    from profiler import run_step
+
     args.outdir = baseDir + '/00.sample'
     from sampleInfo import sampleInfo
-    sampleInfo(args)
+    run_step('sampleInfo', sampleInfo, args)
  
     args.outdir = baseDir + '/01.barcode'    
     from barcode import barcode
-    barcode(args)
+    run_step('barcode', barcode, args)
 
-    args.fq = baseDir + '/01.barcode/' + sample + '_2.fq.gz'
+    from utils import lane_files
+    n_lanes = len(args.fq1.split(','))
+    args.fq = ','.join(lane_files(baseDir + '/01.barcode/' + sample, '_2.fq.gz', n_lanes))
     args.outdir = baseDir + '/02.cutadapt'
     from cutadapt import cutadapt
-    cutadapt(args)
+    run_step('cutadapt', cutadapt, args)
 
-    args.fq = baseDir + '/02.cutadapt/' + sample + '_clean_2.fq.gz'
+    args.fq = ','.join(lane_files(baseDir + '/02.cutadapt/' + sample, '_clean_2.fq.gz', n_lanes))
     args.outdir = baseDir + '/03.STAR'
     args.runThreadN = 6
     from STAR import STAR
-    STAR(args)
+    run_step('STAR', STAR, args)
 
     args.input = baseDir + '/03.STAR/' + sample + '_Aligned.sortedByCoord.out.bam'
     args.outdir = baseDir + '/04.featureCounts'
     args.runThreadN = 6
     from featureCounts import featureCounts
-    featureCounts(args)
+    run_step('featureCounts', featureCounts, args)
 
-    args.bam = baseDir + '/04.featureCounts/' + sample + '_name_sorted.bam'
-    args.outdir = baseDir + '/05.count'
-    from count import count
-    count(args)
+    if getattr(args, 'topupOf', None):
+        # counts and analysis go to the earlier run, this dir keeps the top-up reads only
+        args.topupDir = baseDir
+        baseDir = args.topupOf
+        args.outdir = baseDir + '/05.count'
+        from count import topup
+        run_step('topup', topup, args)
+    else:
+        args.bam = baseDir + '/04.featureCounts/' + sample + '_name_sorted.bam'
+        args.outdir = baseDir + '/05.count'
+        from count import count
+        run_step('count', count, args)
 
     args.matrix_file = baseDir + '/05.count/' + sample + '_matrix.xls'
     args.outdir = baseDir + '/06.analysis'
     from analysis import analysis
-    analysis(args)
+    run_step('analysis', analysis, args)
 
 def main():
     import argparse
@@ -3,10 +3,9 @@
 
 from report import reporter
 import os
-import pandas as pd
 from utils import getlogger
+from opts import get_opts0, __VERSION__
 
-__VERSION__ = "CeleScope V1.0.0"
 logger1, logger2 = getlogger()
 def sampleInfo(args):
     if not os.path.exists(args.outdir):
@@ -21,19 +20,11 @@ def sampleInfo(args):
         os.system('mkdir -p %s' % outdir)
 
 
-    stat = pd.DataFrame({"item":["Sample ID","Description","Transcriptome","Software Version"],"count":[sample,description,transcriptome,version]},
-    columns=["item","count"])
     stat_file = outdir + "/stat.txt"
-    stat.to_csv(stat_file,sep=":",header=None,index=False)
+    with open(stat_file, 'w') as fh:
+        for item, count in zip(["Sample ID","Description","Transcriptome","Software Version"],[sample,description,transcriptome,version]):
+            fh.write('%s:%s\n' % (item, count))
 
     t = reporter(name='sample', stat_file=stat_file, outdir=outdir + '/..')
     t.get_report()
     logger1.info("Generating sample info done.")
-
-def get_opts0(parser,sub_program):
-    if sub_program:
-        parser.add_argument('--outdir', help='output dir',required=True)
-        parser.add_argument('--sample', help='sample name', required=True)
-        parser.add_argument('--genomeDir', help='genomeDir', required=True)
-    parser.add_argument('--description', help='sample description',default="scRNA-Seq")
-    parser.add_argument('--version', help='software version',default=__VERSION__)
\ No newline at end of file
@@ -0,0 +1,137 @@
+#!/bin/env python
+#coding=utf8
+
+"""
+saturation and genes per cell beyond the sequenced depth.
+
+saturation: reads per molecule are gamma-Poisson (negative binomial) with
+mean m and shape a, the molecules differing in how well they are captured
+and amplified; a large a is plain Poisson occupancy. with fold times the
+reads the mean is fold * m, and the molecules seen have zero-truncated
+reads, so
+
+    saturation(fold) = 1 - P(1) / (1 - P(0))
+
+m and a are the maximum likelihood fit of the zero-truncated histogram of
+reads per molecule, starting from the Poisson rate of n1 / U.
+
+median genes per cell: Michaelis-Menten G(fold) = Gmax * fold / (K + fold)
+fitted to the downsampled points.
+"""
+
+import numpy as np
+
+FOLDS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1, 1.5, 2, 3, 4, 5, 6, 8, 10]
+
+
+def poisson_rate(n1, umi):
+    """
+    reads per molecule lam with n1 / U = lam / (exp(lam) - 1), inf when no
+    molecule is seen once, 0 when all are
+    """
+    from scipy.optimize import brentq
+    if umi == 0 or n1 >= umi:
+        return 0.0
+    if n1 == 0:
+        return np.inf
+    ratio = float(n1) / umi
+    return brentq(lambda lam: lam / np.expm1(lam) - ratio, 1e-9, 700)
+
+
+def fit_reads_per_molecule(reads_per_umi):
+    """
+    (mean, shape) of the gamma-Poisson reads per molecule, None when the
+    histogram can not tell them: no molecule seen more than once, or none once
+    """
+    from scipy.optimize import minimize
+    from scipy.special import gammaln
+    hist = np.bincount(np.asarray(reads_per_umi, dtype=int))
+    k = np.nonzero(hist)[0]
+    k = k[k > 0]
+    n = hist[k]
+    lam = poisson_rate(hist[1] if len(hist) > 1 else 0, n.sum())
+    if not 0 < lam < np.inf:
+        return None
+
+    def nll(log_params):
+        m, a = np.exp(log_params)
+        log_p0 = -a * np.log1p(m / a)
+        ll = gammaln(k + a) - gammaln(a) - gammaln(k + 1) + a * np.log(a / (a + m)) + k * np.log(m / (a + m))
+        return -(n * (ll - np.log(-np.expm1(log_p0)))).sum()
+
+    res = minimize(nll, [np.log(lam), np.log(10.0)], method='Nelder-Mead')
+    return tuple(np.exp(res.x))
+
+
+def saturation_at(model, folds):
+    """
+    percent saturation at folds of the current reads
+    """
+    m, a = model
+    mf = m * np.asarray(folds, dtype=float)
+    p0 = np.power(1 + mf / a, -a)
+    p1 = mf * np.power(1 + mf / a, -a - 1)
+    return (1 - p1 / (1 - p0)) * 100
+
+
+def fold_for_saturation(model, target):
+    """
+    fold of the current reads with target percent saturation, None beyond
+    1000 folds
+    """
+    from scipy.optimize import brentq
+    f = lambda fold: saturation_at(model, fold) - target
+    if f(1e3) < 0:
+        return None
+    return brentq(f, 1e-6, 1e3)
+
+
+def fit_genes(fractions, medians):
+    """
+    (Gmax, K) of the median genes of the downsampled fractions, None when
+    there are too few points
+    """
+    from scipy.optimize import curve_fit
+    fractions = np.asarray(fractions, dtype=float)
+    medians = np.asarray(medians, dtype=float)
+    keep = fractions > 0
+    fractions, medians = fractions[keep], medians[keep]
+    if len(fractions) < 3 or medians.max() <= 0:
+        return None
+    try:
+        params, _ = curve_fit(lambda f, gmax, k: gmax * f / (k + f), fractions, medians,
+            p0=[medians.max() * 1.5, 0.5], bounds=([0, 0], [np.inf, np.inf]))
+    except RuntimeError:
+        return None
+    return tuple(params)
+
+
+def genes_at(params, folds):
+    gmax, k = params
+    folds = np.asarray(folds, dtype=float)
+    return gmax * folds / (k + folds)
+
+
+def fold_for_genes(params, target):
+    """
+    fold of the current reads with target median genes, None if the fitted
+    curve stays below it
+    """
+    gmax, k = params
+    if target >= gmax:
+        return None
+    return k * target / (gmax - target)
+
+
+def extrapolate(reads_per_umi, fractions, medians, folds=FOLDS):
+    """
+    table of predicted saturation and median genes per cell at folds of the
+    current reads, with the reads per molecule model and the genes fit
+    """
+    import pandas as pd
+    model = fit_reads_per_molecule(reads_per_umi)
+    params = fit_genes(fractions, medians)
+    table = pd.DataFrame({'fold': folds})
+    table['saturation'] = saturation_at(model, folds) if model else np.nan
+    table['median_geneNum'] = genes_at(params, folds) if params else np.nan
+    return table, model, params
@@ -2,48 +2,71 @@
 #coding=utf8
 
 import argparse
+import importlib
+from opts import get_opts0, get_opts1, get_opts2, get_opts3, get_opts4, get_opts5, get_opts6, \
+    get_opts_annotation, get_opts_report, get_opts_topup, get_opts_aggregate
 
-if __name__ == '__main__':
+def lazy(module, func, profiled=True):
+    # import the step module only when its subcommand runs. profiled steps
+    # take --profile and write their profile to --outdir
+    def run(args):
+        step = getattr(importlib.import_module(module), func)
+        if not profiled:
+            return step(args)
+        from profiler import run_step
+        return run_step(func, step, args)
+    run.profiled = profiled
+    return run
 
+def get_parser():
     parser = argparse.ArgumentParser(description='fastq to matrix')
     subparsers = parser.add_subparsers()
 
-    from sampleInfo import sampleInfo,get_opts0
     parser0 = subparsers.add_parser('sample', description='sample infomation')
     get_opts0(parser0,True)
-    parser0.set_defaults(func=sampleInfo)
+    parser0.set_defaults(func=lazy('sampleInfo', 'sampleInfo'))
 
-    from barcode import barcode, get_opts1
     parser1 = subparsers.add_parser('barcode', description='extract barcode and umi')
     get_opts1(parser1,True)
-    parser1.set_defaults(func=barcode)
+    parser1.set_defaults(func=lazy('barcode', 'barcode'))
 
-    from cutadapt import cutadapt, get_opts2
     parser2 = subparsers.add_parser('cutadapt', description='cutadapt')
     get_opts2(parser2,True)
-    parser2.set_defaults(func=cutadapt)
+    parser2.set_defaults(func=lazy('cutadapt', 'cutadapt'))
 
-    from STAR import STAR, get_opts3
     parser3 = subparsers.add_parser('STAR')
     get_opts3(parser3,True)
-    parser3.set_defaults(func=STAR)
+    parser3.set_defaults(func=lazy('STAR', 'STAR'))
 
-    from featureCounts import featureCounts, get_opts4
     parser4 = subparsers.add_parser('featureCounts')
     get_opts4(parser4,True)
-    parser4.set_defaults(func=featureCounts)
+    parser4.set_defaults(func=lazy('featureCounts', 'featureCounts'))
 
-    from count import count, get_opts5
     parser5 = subparsers.add_parser('count')
     get_opts5(parser5,True)
-    parser5.set_defaults(func=count)
+    parser5.set_defaults(func=lazy('count', 'count'))
+
+    parser_topup = subparsers.add_parser('topup', description='merge a top-up run into the counts of a sample')
+    get_opts_topup(parser_topup,True)
+    get_opts5(parser_topup,False)
+    parser_topup.set_defaults(func=lazy('count', 'topup'))
 
-    from analysis import analysis, get_opts6
     parser6 = subparsers.add_parser('analysis')
     get_opts6(parser6,True)
-    parser6.set_defaults(func=analysis)
+    parser6.set_defaults(func=lazy('analysis', 'analysis'))
+
+    parser_annotation = subparsers.add_parser('annotation', description='compile gtf into annotation store')
+    get_opts_annotation(parser_annotation,True)
+    parser_annotation.set_defaults(func=lazy('annotation', 'annotation', profiled=False))
+
+    parser_report = subparsers.add_parser('report', description='assemble html report from step fragments')
+    get_opts_report(parser_report,True)
+    parser_report.set_defaults(func=lazy('report', 'report', profiled=False))
+
+    parser_aggregate = subparsers.add_parser('aggregate', description='one matrix of the counts of several samples')
+    get_opts_aggregate(parser_aggregate,True)
+    parser_aggregate.set_defaults(func=lazy('aggregate', 'aggregate', profiled=False))
 
-    from run import run
     parser_run = subparsers.add_parser('run',conflict_handler='resolve')
     get_opts0(parser_run,False)
     get_opts1(parser_run,False)
@@ -52,7 +75,25 @@ if __name__ == '__main__':
     get_opts4(parser_run,False)
     get_opts5(parser_run,False)
     get_opts6(parser_run,False)
-    parser_run.set_defaults(func=run)
+    get_opts_topup(parser_run,False)
+    parser_run.set_defaults(func=lazy('run', 'run', profiled=False))
+
+    for sub_parser in [parser0, parser1, parser2, parser3, parser4, parser5, parser_topup, parser6, parser_run]:
+        sub_parser.add_argument('--profile', action='store_true',
+            help='record wall time, cpu time and peak memory of each step and its phases')
 
-    args = parser.parse_args()
+    return parser
+
+
+def subcommands(parser=None):
+    # names of the registered subcommands, in order
+    parser = parser or get_parser()
+    for action in parser._actions:
+        if isinstance(action, argparse._SubParsersAction):
+            return list(action.choices)
+    return []
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
     args.func(args)
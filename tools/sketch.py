@@ -0,0 +1,80 @@
+#!/bin/env python
+#coding=utf8
+
+
+class SpaceSaving:
+    """
+    bounded-memory heavy-hitter counts, a batched Space-Saving sketch.
+
+    keeps at most 2*k keys; when full it keeps the k largest and every new key
+    starts from the largest count dropped so far (floor), so counts are over-
+    estimated by at most floor. any key seen more than n/k times is kept.
+    supports d[key] += 1 like the defaultdict(int) it replaces
+    """
+    def __init__(self, k=100000):
+        self.k = k
+        self.floor = 0
+        self.counts = {}
+
+    def __getitem__(self, key):
+        return self.counts.get(key, self.floor)
+
+    def __setitem__(self, key, value):
+        self.counts[key] = value
+        if len(self.counts) >= 2 * self.k:
+            self.prune()
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key, n=1):
+        self[key] = self[key] + n
+
+    def prune(self):
+        # exactly k keys are kept, ties at the cut are broken by key, so tied
+        # singletons do not empty the sketch
+        items = sorted(self.counts.items(), key=lambda x: (-x[1], x[0]))
+        if len(items) > self.k:
+            self.floor = max(self.floor, items[self.k][1])
+        self.counts = dict(items[:self.k])
+
+    def items(self):
+        return self.counts.items()
+
+    def most_common(self):
+        return sorted(self.counts.items(), key=lambda x: (-x[1], x[0]))
+
+    def update(self, other):
+        """
+        merge the sketch of other reads (another lane). a key missing from
+        one side counts that side's floor, so counts stay overestimates, by
+        at most the sum of the floors
+        """
+        keys = set(self.counts) | set(other.counts)
+        self.counts = dict((key, self[key] + other[key]) for key in keys)
+        self.floor = self.floor + other.floor
+        if len(self.counts) >= 2 * self.k:
+            self.prune()
+
+
+def knee_rank(counts):
+    """
+    number of barcodes up to the knee of a descending count curve: the point
+    of the log-log rank curve farthest above the line from first to last point
+    """
+    import math
+    counts = [c for c in counts if c > 0]
+    if len(counts) < 3:
+        return len(counts)
+    x = [math.log10(i + 1) for i in range(len(counts))]
+    y = [math.log10(c) for c in counts]
+    slope = (y[-1] - y[0]) / (x[-1] - x[0])
+    best, best_i = 0, len(counts)
+    for i in range(len(counts)):
+        d = y[i] - (y[0] + slope * (x[i] - x[0]))
+        if d > best:
+            best, best_i = d, i + 1
+    return best_i
@@ -0,0 +1,368 @@
+#!/bin/env python
+#coding=utf8
+
+"""
+in-process analysis of the sparse count matrix, the python backend of the
+analysis step. follows run_analysis.R: LogNormalize, variable genes by
+binned dispersion, PCA on the scaled variable genes, shared nearest
+neighbor graph, modularity clustering, 2D embedding and markers per cluster.
+no dense cells x genes copy is made.
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.io import mmread
+
+
+def read_list(list_file, header):
+    # one column list of count.expression_matrix, with or without header line
+    with open(list_file) as fh:
+        items = [line.strip() for line in fh if line.strip()]
+    if items and items[0] == header:
+        items = items[1:]
+    return np.array(items)
+
+
+def read_matrix(prefix):
+    """
+    cells x genes csr count matrix of {prefix}.mtx, gene ids and barcodes
+    """
+    matrix = sparse.csr_matrix(mmread(prefix + '.mtx').T)
+    genes = read_list(prefix + '_genes.tsv', 'geneID')
+    barcodes = read_list(prefix + '_cellbarcode.tsv', 'Barcode')
+    return matrix, genes, barcodes
+
+
+def normalize(X, scale_factor=10000):
+    """
+    log1p of counts per scale_factor of each cell, Seurat LogNormalize
+    """
+    total = np.asarray(X.sum(axis=1)).ravel().astype(float)
+    total[total == 0] = 1
+    X = sparse.diags(scale_factor / total).dot(X).tocsr()
+    X.data = np.log1p(X.data)
+    return X
+
+
+def _mean_var(X):
+    # per gene mean and variance of a sparse cells x genes matrix
+    n = X.shape[0]
+    mean = np.asarray(X.mean(axis=0)).ravel()
+    sq = X.copy()
+    sq.data **= 2
+    var = np.asarray(sq.mean(axis=0)).ravel() - mean ** 2
+    return mean, var * n / max(n - 1, 1)
+
+
+def variable_genes(X, x_low=0.1, x_high=8, y_cutoff=1, n_bins=20, min_genes=100):
+    """
+    Seurat FindVariableGenes with ExpMean and LogVMR: log mean and log
+    variance/mean of the non-log normalized data, dispersion z-scored within
+    20 bins of mean. falls back to the min_genes most dispersed genes
+    """
+    E = X.copy()
+    E.data = np.expm1(E.data)
+    mean, var = _mean_var(E)
+    exp_mean = np.log1p(mean)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dispersion = np.log(var / mean)
+    dispersion[~np.isfinite(dispersion)] = 0
+
+    bins = np.floor((exp_mean - exp_mean.min()) / max(np.ptp(exp_mean), 1e-12) * n_bins).clip(0, n_bins - 1)
+    z = np.zeros(len(dispersion))
+    for b in np.unique(bins):
+        in_bin = bins == b
+        sd = dispersion[in_bin].std(ddof=1) if in_bin.sum() > 1 else 0
+        if sd > 0:
+            z[in_bin] = (dispersion[in_bin] - dispersion[in_bin].mean()) / sd
+    genes = np.where((exp_mean > x_low) & (exp_mean < x_high) & (z > y_cutoff))[0]
+    if len(genes) < min_genes:
+        genes = np.argsort(-z)[:min(min_genes, len(z))]
+    return np.sort(genes)
+
+
+def truncated_pca(X, n_components=20, n_oversamples=10, n_iter=4, seed=0):
+    """
+    cell embeddings of the top n_components principal components of the gene
+    scaled X by randomized SVD. centering is applied inside the products, so
+    the sparse matrix is never densified
+    """
+    n, m = X.shape
+    mean, var = _mean_var(X)
+    sd = np.sqrt(var)
+    sd[sd == 0] = 1
+    Xs = X.dot(sparse.diags(1 / sd)).tocsr()
+    mu = mean / sd
+
+    def matmat(B):
+        return Xs.dot(B) - mu.dot(B)[None, :]
+
+    def rmatmat(B):
+        return Xs.T.dot(B) - np.outer(mu, B.sum(axis=0))
+
+    k = min(n_components, n - 1, m)
+    rng = np.random.RandomState(seed)
+    Q = np.linalg.qr(matmat(rng.normal(size=(m, min(k + n_oversamples, m)))))[0]
+    for _ in range(n_iter):
+        Q = np.linalg.qr(rmatmat(Q))[0]
+        Q = np.linalg.qr(matmat(Q))[0]
+    U, s, _ = np.linalg.svd(rmatmat(Q).T, full_matrices=False)
+    return Q.dot(U[:, :k]) * s[:k]
+
+
+def knn(pcs, k=20):
+    """
+    indices of the k nearest cells of each cell, itself included, by
+    euclidean distance in PC space
+    """
+    from scipy.spatial import cKDTree
+    k = min(k, pcs.shape[0])
+    neighbors = cKDTree(pcs).query(pcs, k=k)[1]
+    return neighbors.reshape(pcs.shape[0], k)
+
+
+def snn_graph(neighbors, prune=1 / 15.0):
+    """
+    Jaccard overlap of the neighbor sets of connected cells, edges under
+    prune dropped, like the SNN graph of Seurat FindClusters
+    """
+    n, k = neighbors.shape
+    A = sparse.csr_matrix((np.ones(n * k), (np.repeat(np.arange(n), k), neighbors.ravel())), shape=(n, n))
+    S = A.dot(A.T).tocsr()
+    S.data = S.data / (2 * k - S.data)
+    S.data[S.data < prune] = 0
+    S.eliminate_zeros()
+    return S
+
+
+def _local_moving(graph, resolution, rng, max_passes=20):
+    # one level of Louvain: move nodes to the neighbor community of best modularity gain
+    n = graph.shape[0]
+    indptr, indices, data = graph.indptr.tolist(), graph.indices.tolist(), graph.data.tolist()
+    degree = np.asarray(graph.sum(axis=1)).ravel().tolist()
+    m2 = float(sum(degree))
+    comm = list(range(n))
+    tot = list(degree)
+    moved_any = False
+    order = rng.permutation(n).tolist()
+    for _ in range(max_passes):
+        moved = 0
+        for i in order:
+            ci, ki = comm[i], degree[i]
+            weights = {}
+            for p in range(indptr[i], indptr[i + 1]):
+                j = indices[p]
+                if j != i:
+                    weights[comm[j]] = weights.get(comm[j], 0) + data[p]
+            tot[ci] -= ki
+            best, best_gain = ci, weights.get(ci, 0) - resolution * tot[ci] * ki / m2
+            for c, w in weights.items():
+                gain = w - resolution * tot[c] * ki / m2
+                if gain > best_gain:
+                    best, best_gain = c, gain
+            tot[best] += ki
+            if best != ci:
+                comm[i] = best
+                moved += 1
+        if not moved:
+            break
+        moved_any = True
+    return np.unique(comm, return_inverse=True)[1], moved_any
+
+
+def louvain(graph, resolution=0.6, seed=0, max_levels=10):
+    """
+    Louvain modularity clusters of a symmetric weighted graph, numbered from
+    0 by decreasing size as Seurat does
+    """
+    rng = np.random.RandomState(seed)
+    membership = np.arange(graph.shape[0])
+    for _ in range(max_levels):
+        comm, moved = _local_moving(graph, resolution, rng)
+        if not moved:
+            break
+        membership = comm[membership]
+        P = sparse.csr_matrix((np.ones(len(comm)), (np.arange(len(comm)), comm)))
+        graph = P.T.dot(graph).dot(P).tocsr()
+    sizes = np.bincount(membership)
+    rank = np.empty(len(sizes), dtype=int)
+    rank[np.argsort(-sizes, kind='mergesort')] = np.arange(len(sizes))
+    return rank[membership]
+
+
+def spectral_embedding(graph, seed=0):
+    """
+    2D laplacian eigenmap of graph, used when scikit-learn is not installed
+    """
+    from scipy.sparse.linalg import eigsh
+    n = graph.shape[0]
+    W = graph + graph.T
+    degree = np.asarray(W.sum(axis=1)).ravel()
+    degree[degree == 0] = 1
+    d = sparse.diags(1 / np.sqrt(degree))
+    M = d.dot(W).dot(d)
+    if n <= 10:
+        values, vectors = np.linalg.eigh(M.toarray())
+    else:
+        v0 = np.random.RandomState(seed).uniform(size=n)
+        values, vectors = eigsh(M, k=3, which='LA', v0=v0)
+    vectors = vectors[:, np.argsort(-values)]
+    return vectors[:, 1:3] / np.sqrt(degree)[:, None]
+
+
+def embedding(pcs, graph, seed=0):
+    """
+    tSNE of the PCs with scikit-learn, a spectral embedding of the graph
+    without it
+    """
+    try:
+        from sklearn.manifold import TSNE
+    except ImportError:
+        logging.warning('scikit-learn not installed, tSNE_1 and tSNE_2 of tsne_coord.tsv '
+            'hold a spectral embedding of the SNN graph instead of tSNE')
+        return spectral_embedding(graph, seed)
+    perplexity = min(30, max(1, (pcs.shape[0] - 1) // 3))
+    return TSNE(n_components=2, perplexity=perplexity, random_state=seed).fit_transform(pcs)
+
+
+def column_ranks(X):
+    """
+    X: csc matrix without negative values. returns the csc matrix of the
+    ranks of the nonzero entries within their column, the rank shared by the
+    zeros of each column and the tie term sum(t^3 - t) of each column.
+    ties get their average rank, and the zeros rank below everything
+    """
+    n, m = X.shape
+    nnz = np.diff(X.indptr)
+    n_zero = n - nnz
+    cols = np.repeat(np.arange(m), nnz)
+    order = np.lexsort((X.data, cols))
+    values, sorted_cols = X.data[order], cols[order]
+    # 0-based position of each sorted entry among the nonzeros of its column
+    pos = np.arange(len(order)) - X.indptr[sorted_cols]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (values[1:] != values[:-1]) | (sorted_cols[1:] != sorted_cols[:-1])
+    group = np.cumsum(first) - 1
+    group_size = np.bincount(group).astype(float)
+    ranks = np.empty(len(order))
+    ranks[order] = n_zero[sorted_cols] + pos[first][group] + (group_size[group] + 1) / 2.0
+    R = sparse.csc_matrix((ranks, X.indices, X.indptr), shape=X.shape)
+    tie = np.bincount(sorted_cols[first], weights=group_size ** 3 - group_size, minlength=m) \
+        + n_zero.astype(float) ** 3 - n_zero
+    return R, (n_zero + 1) / 2.0, tie
+
+
+def _marker_stats(params):
+    """
+    per cluster x gene statistics of a block of genes: mean expm1 and
+    detection fraction in and out of the cluster, and the wilcoxon z score
+    of the cluster against the rest, all clusters at once
+    """
+    from scipy.stats import norm
+    X, membership, n1 = params
+    n = X.shape[0]
+    n2 = n - n1
+    E = X.copy()
+    E.data = np.expm1(E.data)
+    detected = X.copy()
+    detected.data = (detected.data > 0).astype(float)
+    R, zero_rank, tie = column_ranks(X)
+
+    sum_in = membership.dot(E).toarray()
+    detected_in = membership.dot(detected).toarray()
+    mean_in = sum_in / n1[:, None]
+    mean_out = (np.asarray(E.sum(axis=0)) - sum_in) / np.maximum(n2, 1)[:, None]
+    pct_in = detected_in / n1[:, None]
+    pct_out = (np.asarray(detected.sum(axis=0)) - detected_in) / np.maximum(n2, 1)[:, None]
+
+    # rank sum of each cluster: nonzero ranks plus the zero rank of its zeros
+    rank_sum = membership.dot(R).toarray() + (n1[:, None] - detected_in) * zero_rank[None, :]
+    U = rank_sum - n1[:, None] * (n1[:, None] + 1) / 2.0
+    mu = n1[:, None] * n2[:, None] / 2.0
+    var = n1[:, None] * n2[:, None] / 12.0 * ((n + 1) - tie[None, :] / float(n * (n - 1)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # continuity correction as R wilcox.test
+        z = (U - mu - 0.5 * np.sign(U - mu)) / np.sqrt(var)
+    p_val = 2 * norm.sf(np.abs(z))
+    p_val[~np.isfinite(z)] = 1
+    return mean_in, mean_out, pct_in, pct_out, p_val
+
+
+def find_markers(X, clusters, genes, n_tests=None, min_pct=0.1, logfc_threshold=0.25, return_thresh=0.01,
+        thread=1, block=2000):
+    """
+    markers of each cluster against the other cells in the columns of
+    Seurat FindAllMarkers: wilcoxon rank sum p value, natural log fold
+    change of the mean normalized expression, detection fractions and
+    p value adjusted by bonferroni over n_tests genes, all genes by default.
+
+    all clusters are tested at once from one ranking of each gene; blocks
+    of genes are spread over thread processes
+    """
+    X = sparse.csc_matrix(X)
+    cluster_ids, idx = np.unique(clusters, return_inverse=True)
+    membership = sparse.csr_matrix((np.ones(len(idx)), (idx, np.arange(len(idx)))),
+        shape=(len(cluster_ids), len(idx)))
+    n1 = np.bincount(idx).astype(float)
+    params = [(X[:, start:start + block], membership, n1) for start in range(0, X.shape[1], block)]
+    if int(thread) > 1 and len(params) > 1:
+        from multiprocessing import Pool
+        pool = Pool(min(len(params), int(thread)))
+        blocks = pool.map(_marker_stats, params)
+        pool.close()
+        pool.join()
+    else:
+        blocks = [_marker_stats(p) for p in params]
+    columns = ['p_val', 'avg_logFC', 'pct.1', 'pct.2', 'p_val_adj', 'cluster', 'gene']
+    if not blocks:
+        return pd.DataFrame(columns=columns)
+    mean_in, mean_out, pct_in, pct_out, p_val = [np.hstack(arrays) for arrays in zip(*blocks)]
+
+    logfc = np.log1p(mean_in) - np.log1p(mean_out)
+    keep = (np.maximum(pct_in, pct_out) >= min_pct) & (np.abs(logfc) >= logfc_threshold) & (p_val < return_thresh)
+    # a single cluster has nothing to be compared with
+    keep[n1 == len(idx)] = False
+    c, g = np.where(keep)
+    markers = pd.DataFrame({
+        'p_val': p_val[c, g],
+        'avg_logFC': logfc[c, g],
+        'pct.1': pct_in[c, g].round(3),
+        'pct.2': pct_out[c, g].round(3),
+        'p_val_adj': np.minimum(p_val[c, g] * (n_tests or X.shape[1]), 1),
+        'cluster': cluster_ids[c],
+        'gene': np.asarray(genes)[g],
+    }, columns=columns)
+    return markers.sort_values(['cluster', 'avg_logFC'], ascending=[True, False])
+
+
+def run_analysis(X, genes, barcodes, outdir, n_pcs=20, k=20, resolution=0.6, seed=0, thread=1):
+    """
+    X: cells x genes csr counts. writes tsne_coord.tsv and markers.tsv
+    in the format of run_analysis.R
+    """
+    n_cells = X.shape[0]
+    gene_counts = np.diff(X.indptr)
+    X = normalize(X)
+    var_genes = variable_genes(X)
+    logging.info('%s variable genes' % (len(var_genes)))
+
+    if n_cells < 3:
+        # too few cells to cluster
+        clusters = np.zeros(n_cells, dtype=int)
+        coord = np.zeros((n_cells, 2))
+    else:
+        pcs = truncated_pca(X[:, var_genes], n_components=n_pcs, seed=seed)
+        graph = snn_graph(knn(pcs, k=k))
+        clusters = louvain(graph, resolution=resolution, seed=seed)
+        logging.info('%s clusters' % (len(np.unique(clusters))))
+        coord = embedding(pcs, graph, seed=seed)
+
+    tsne = pd.DataFrame({'tSNE_1': coord[:, 0], 'tSNE_2': coord[:, 1], 'cluster': clusters,
+        'Gene_Counts': gene_counts}, index=barcodes, columns=['tSNE_1', 'tSNE_2', 'cluster', 'Gene_Counts'])
+    tsne.to_csv(outdir + '/tsne_coord.tsv', sep='\t')
+
+    markers = find_markers(X[:, var_genes], clusters, genes[var_genes], n_tests=X.shape[1], thread=thread)
+    markers.to_csv(outdir + '/markers.tsv', sep='\t', index=False)
@@ -2,15 +2,18 @@
 #coding=utf8
 
 import logging
-import pandas as pd
-import numpy as np
 #from scipy.stats.kde import gaussian_kde
 #from scipy.signal import argrelextrema
 import subprocess
 from collections import defaultdict
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+
+# numpy and matplotlib are imported by the functions that use them, every step
+# imports utils for getlogger/format_number and should not pay for them
+def get_plt():
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
 
 def getlogger():
     logging.basicConfig(level = logging.INFO,format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -22,7 +25,17 @@ def getlogger():
 def format_number(number:int) -> str:
     return format(number,",")
 
+def lane_files(prefix, suffix, n):
+    """
+    output files of a sample with n lanes: {prefix}{suffix} for one lane,
+    {prefix}_L1{suffix}, {prefix}_L2{suffix}, ... otherwise
+    """
+    if n == 1:
+        return [prefix + suffix]
+    return ['%s_L%s%s' % (prefix, i + 1, suffix) for i in range(n)]
+
 def barcode_filter_with_magnitude(df, plot='magnitude.pdf', col='UMI', percent=0.1, expected_cell_num=3000):
+    plt = get_plt()
     # col can be readcount or UMI
     # determine validated barcodes
     df = df.sort_values(col, ascending=False)
@@ -30,7 +43,7 @@ def barcode_filter_with_magnitude(df, plot='magnitude.pdf', col='UMI', percent=0
     idx = max(0, idx)
 
     # calculate read counts threshold
-    threshold = int(df.iloc[idx, df.columns==col] * 0.1)
+    threshold = int(df[col].iloc[idx] * 0.1)
     threshold = max(1, threshold)
     validated_barcodes = df[df[col]>threshold].index
 
@@ -45,6 +58,8 @@ def barcode_filter_with_magnitude(df, plot='magnitude.pdf', col='UMI', percent=0
     return (validated_barcodes, threshold, len(validated_barcodes))
 
 def barcode_filter_with_kde(df, plot='kde.pdf', col='UMI'):
+    import numpy as np
+    plt = get_plt()
     # col can be readcount or UMI
     # filter low values
     df = df.sort_values(col, ascending=False)
@@ -78,6 +93,7 @@ def barcode_filter_with_kde(df, plot='kde.pdf', col='UMI'):
 
 
 def get_slope(x, y, window=200, step=10):
+    import numpy as np
     assert len(x)==len(y)
     start=0
     last = len(x)
@@ -92,6 +108,8 @@ def get_slope(x, y, window=200, step=10):
     return res
 
 def barcode_filter_with_derivative(df, plot='derivative.pdf', col='UMI', window=500, step=5):
+    import numpy as np
+    plt = get_plt()
     # col can be readcount or UMI
     # filter low values
     df = df.sort_values(col, ascending=False)
@@ -141,6 +159,7 @@ def downsample(bam, barcodes, percent):
         n_deduped_reads = Number of unique (valid cell-barcode, valid UMI, gene) combinations among confidently mapped reads. 
         n_reads = Total number of confidently mapped, valid cell-barcode, valid UMI reads.
     """
+    import numpy as np
     logging.info ('working' + str(percent))
     cmd = ['samtools', 'view', '-s', str(percent), bam]
     p1 = subprocess.Popen(cmd, stdout=subprocess.PIPE)
@@ -183,6 +202,7 @@ def downsample(bam, barcodes, percent):
     return "%.2f\t%.2f\t%.2f\n"%(percent, median_geneNum, saturation), saturation
 
 if __name__ == '__main__':
+    import pandas as pd
 
     df = pd.read_table('SRR6954578_counts.txt', header=0)
 